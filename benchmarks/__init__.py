@@ -0,0 +1,10 @@
+"""Benchmarks for vodreassembler.
+
+Each module can be run as a script, e.g. ::
+
+  python -m benchmarks.parser
+
+benchmarks.suite runs the main stages over synthetic traffic from
+benchmarks.synthetic, and writes machine-readable results for comparison
+across commits.
+"""
@@ -0,0 +1,68 @@
+"""Benchmark for util.DataAssembler storage.
+
+Compares the number of chunks added per second with a preallocated buffer
+against io.BytesIO storage, for the chunk sizes used by requests (30 bytes)
+and responses (3 bytes). Also compares the cost of reading the assembled data
+with getbytes() and getbuffer().
+"""
+
+import argparse
+import io
+import os
+import random
+import timeit
+from vodreassembler import util
+
+
+def _chunks(length, alignment, seed=0):
+  data = os.urandom(length)
+  chunks = [util.DataChunk(data[i:i+alignment], i)
+            for i in range(0, length, alignment)]
+  random.Random(seed).shuffle(chunks)
+  return chunks
+
+
+def _assemble(alignment, length, chunks, storage_factory):
+  assembler = util.DataAssembler(alignment, storage=storage_factory(),
+                                 length=length)
+  for chunk in chunks:
+    assembler.add_chunk(chunk)
+  # Adding the same chunks again exercises the duplicate check.
+  for chunk in chunks:
+    assembler.add_chunk(chunk)
+  return assembler.getbytes()
+
+
+def run(length, repeat):
+  for alignment in (30, 3):
+    chunks = _chunks(length, alignment)
+    for name, storage_factory in [('BytesIO', io.BytesIO),
+                                  ('bytearray', lambda: None)]:
+      elapsed = min(timeit.repeat(
+          lambda: _assemble(alignment, length, chunks, storage_factory),
+          number=1, repeat=repeat))
+      print('alignment {:>2}, {:>9}: {:12.0f} chunks/s'.format(
+          alignment, name, 2 * len(chunks) / elapsed))
+
+  for name, storage_factory in [('BytesIO', io.BytesIO),
+                                ('bytearray', lambda: None)]:
+    assembler = util.DataAssembler(3, storage=storage_factory(), length=length)
+    for chunk in _chunks(length, 3):
+      assembler.add_chunk(chunk)
+    for method in ('getbytes', 'getbuffer'):
+      elapsed = min(timeit.repeat(getattr(assembler, method),
+                                  number=100, repeat=repeat)) / 100
+      print('{:>9}.{:<9}: {:12.0f} reads/s'.format(name, method, 1 / elapsed))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('-l', '--length', type=int, default=300000,
+                      help='Length of the assembled data.')
+  parser.add_argument('-r', '--repeat', type=int, default=3)
+  args = parser.parse_args()
+  run(args.length, args.repeat)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,48 @@
+"""Memory benchmark for parsed queries.
+
+Measures the number of bytes allocated per record with tracemalloc, for the
+records themselves, for protocol.Query objects parsed from them, and for
+protocol.CompactQuery objects, as held in flight by parallel builds.
+"""
+
+import argparse
+import gc
+import tracemalloc
+from benchmarks import parser as parser_benchmark
+from vodreassembler import protocol
+from vodreassembler import ticket
+
+
+def _measure(build):
+  gc.collect()
+  tracemalloc.start()
+  try:
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+  finally:
+    tracemalloc.stop()
+  return after - before, result
+
+
+def run(num_records):
+  size, records = _measure(
+      lambda: parser_benchmark.generate_records(num_records))
+  print('{:>8}: {:8.1f} bytes/record'.format('records', size / num_records))
+  for name, compact in [('query', False), ('compact', True)]:
+    size, queries = _measure(lambda: list(ticket.parse_records(
+        records, protocol.QueryParser(compact=compact))))
+    print('{:>8}: {:8.1f} bytes/record'.format(name, size / len(queries)))
+    del queries
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('-n', '--num_records', type=int, default=100000)
+  args = parser.parse_args()
+  run(args.num_records)
+
+
+if __name__ == '__main__':
+  main()
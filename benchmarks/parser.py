@@ -0,0 +1,60 @@
+"""Benchmark for protocol.QueryParser.
+
+Compares the number of records parsed per second by the fast path, by the
+regular expression, and by batch parsing, over queries only and over mixed
+traffic where most records are not queries, as in a resolver dump.
+"""
+
+import argparse
+import itertools
+import timeit
+from benchmarks import synthetic
+from vodreassembler import protocol
+
+
+# Fraction of records which are not queries in the mixed traffic.
+MIXED_NOISE_RATIO = 0.8
+
+
+def generate_records(num_records, noise_ratio=0, seed=0):
+  spec = synthetic.TrafficSpec(num_tickets=None, noise_ratio=noise_ratio,
+                               seed=seed)
+  return list(itertools.islice(synthetic.iter_records(spec), num_records))
+
+
+def _parse_all(parse, records):
+  # parse_regex() and parse() raise for records which are not queries.
+  for record in records:
+    try:
+      parse(record)
+    except (ValueError, protocol.Error):
+      pass
+
+
+def run(num_records, repeat):
+  parser = protocol.QueryParser()
+  for traffic, noise_ratio in [('queries', 0), ('mixed', MIXED_NOISE_RATIO)]:
+    records = generate_records(num_records, noise_ratio)
+    print('{} ({:.0%} noise):'.format(traffic, noise_ratio))
+    for name, parse in [('regex', parser.parse_regex),
+                        ('fast', parser.parse)]:
+      elapsed = min(timeit.repeat(lambda: _parse_all(parse, records),
+                                  number=1, repeat=repeat))
+      print('{:>8}: {:12.0f} records/s'.format(name, num_records / elapsed))
+    elapsed = min(timeit.repeat(lambda: parser.parse_batch(records),
+                                number=1, repeat=repeat))
+    print('{:>8}: {:12.0f} records/s{}'.format(
+        'batch', num_records / elapsed,
+        '' if protocol.numpy else ' (without NumPy)'))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('-n', '--num_records', type=int, default=100000)
+  parser.add_argument('-r', '--repeat', type=int, default=3)
+  args = parser.parse_args()
+  run(args.num_records, args.repeat)
+
+
+if __name__ == '__main__':
+  main()
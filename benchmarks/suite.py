@@ -0,0 +1,172 @@
+"""Benchmark suite over synthetic traffic, with machine-readable results.
+
+Times the main stages of processing a dump generated by benchmarks.synthetic:
+
+  from_dump: reading records from the dump line by line.
+  from_dump_batches: reading records from the dump in blocks.
+  parse: parsing records with QueryParser.try_parse().
+  parse_batch: parsing records with QueryParser.parse_batch().
+  build_from_records: building a TicketDatabase.
+  find_all: finding socket sessions with SocketSession.find_all().
+  ticketfile_save, ticketfile_load: saving and loading with ticketfile.
+  pickle_dumps, pickle_loads: saving and loading with pickle.
+
+Results are written as JSON, along with the commit and the environment, e.g. ::
+
+  python -m benchmarks.suite -o before.json
+  python -m benchmarks.suite -o after.json --compare before.json
+"""
+
+import argparse
+import io
+import json
+import os
+import pickle
+import platform
+import subprocess
+import sys
+import timeit
+from benchmarks import synthetic
+from vodreassembler import dnsrecord
+from vodreassembler import protocol
+from vodreassembler import socket
+from vodreassembler import ticket
+from vodreassembler import ticketfile
+
+RESULTS_VERSION = 1
+
+
+def _benchmarks(dump):
+  # Each benchmark is (name, number of items, unit, callable).
+  records = list(dnsrecord.from_dump(io.StringIO(dump.decode('utf-8'))))
+  ticket_db = ticket.TicketDatabase()
+  ticket_db.build_from_records(records)
+  saved = io.BytesIO()
+  ticketfile.save(ticket_db, saved)
+  saved = saved.getvalue()
+  pickled = pickle.dumps(ticket_db)
+
+  def from_dump():
+    return list(dnsrecord.from_dump(io.StringIO(dump.decode('utf-8'))))
+
+  def from_dump_batches():
+    return list(dnsrecord.from_dump_batches(io.BytesIO(dump)))
+
+  def parse():
+    parser = protocol.QueryParser()
+    return [parser.try_parse(r) for r in records]
+
+  def parse_batch():
+    return protocol.QueryParser().parse_batch(records)
+
+  def build_from_records():
+    ticket.TicketDatabase().build_from_records(records)
+
+  def ticketfile_save():
+    ticketfile.save(ticket_db, io.BytesIO())
+
+  num_tickets = len(ticket_db)
+  return [
+      ('from_dump', len(records), 'records', from_dump),
+      ('from_dump_batches', len(records), 'records', from_dump_batches),
+      ('parse', len(records), 'records', parse),
+      ('parse_batch', len(records), 'records', parse_batch),
+      ('build_from_records', len(records), 'records', build_from_records),
+      ('find_all', num_tickets, 'tickets',
+       lambda: socket.SocketSession.find_all(ticket_db)),
+      ('ticketfile_save', num_tickets, 'tickets', ticketfile_save),
+      ('ticketfile_load', num_tickets, 'tickets',
+       lambda: ticketfile.load(io.BytesIO(saved))),
+      ('pickle_dumps', num_tickets, 'tickets',
+       lambda: pickle.dumps(ticket_db)),
+      ('pickle_loads', num_tickets, 'tickets', lambda: pickle.loads(pickled)),
+  ]
+
+
+def run(spec, repeat, names=None):
+  """Run the benchmarks and return the results as a JSON serializable dict.
+
+  Args:
+    spec (synthetic.TrafficSpec): Traffic to be generated.
+    repeat (int): Number of runs of each benchmark. The fastest is reported.
+    names (collection, optional): Names of benchmarks to run. All are run if
+      not provided.
+  """
+  dump = synthetic.generate_dump(spec)
+  results = []
+  for name, num_items, unit, func in _benchmarks(dump):
+    if names and name not in names:
+      continue
+    seconds = min(timeit.repeat(func, number=1, repeat=repeat))
+    results.append({'name': name, 'seconds': seconds, 'items': num_items,
+                    'unit': unit, 'per_second': num_items / seconds})
+  return {
+      'version': RESULTS_VERSION,
+      'commit': _commit(),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'numpy': protocol.numpy is not None,
+      'spec': spec._asdict(),
+      'dump_size': len(dump),
+      'repeat': repeat,
+      'results': results,
+  }
+
+
+def _commit():
+  try:
+    return subprocess.run(
+        ['git', 'rev-parse', 'HEAD'], capture_output=True, check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        text=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def report(results, baseline=None):
+  """Return a human-readable table of results, compared with baseline."""
+  baseline_results = {}
+  if baseline is not None:
+    baseline_results = {r['name']: r for r in baseline['results']}
+  lines = ['{:<20} {:>10} {:>14} {:>9}'.format('benchmark', 'seconds',
+                                                'items/s', 'speedup')]
+  for result in results['results']:
+    previous = baseline_results.get(result['name'])
+    speedup = ('{:.2f}x'.format(previous['seconds'] / result['seconds'])
+               if previous else '-')
+    lines.append('{:<20} {:>10.4f} {:>14.0f} {:>9}'.format(
+        result['name'], result['seconds'], result['per_second'], speedup))
+  return '\n'.join(lines)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('-n', '--num_tickets', type=int, default=500)
+  parser.add_argument('-r', '--repeat', type=int, default=3)
+  parser.add_argument('-s', '--seed', type=int, default=0)
+  parser.add_argument('-b', '--benchmark', action='append', dest='names',
+                      help='Run only the named benchmark. May be repeated.')
+  parser.add_argument('-o', '--output', help='Write JSON results to the file '
+                                             'instead of stdout.')
+  parser.add_argument('--compare', metavar='JSON',
+                      help='Report speedups over results of an earlier run.')
+  args = parser.parse_args()
+  spec = synthetic.TrafficSpec(num_tickets=args.num_tickets, seed=args.seed)
+  results = run(spec, args.repeat, args.names)
+
+  baseline = None
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+  print(report(results, baseline), file=sys.stderr)
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
+  else:
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+  main()
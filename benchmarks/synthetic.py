@@ -0,0 +1,239 @@
+"""Generator of synthetic VPN over DNS traffic.
+
+Records are produced with protocol.Query.encode(), whose payloads are encoded
+by protocol.chunk_to_ipv4(), following the exchanges of real clients. Each
+ticket opens with an open_ticket query, sends its request in 30-byte
+request_data chunks, polls with check_request, fetches its zlib-compressed
+response in 48-byte segments of 3-byte chunks and is closed. Requests carry
+SocketData messages, so that SocketSession.find_all() finds sessions in them.
+
+Replies follow the server as well: open_ticket is answered with the 3-byte id
+of the new ticket, and check_request with the length of the compressed
+response in 2 bytes.
+
+Tickets are interleaved, and the following are mixed in at configurable rates:
+
+  retries: queries repeated with the retry flag.
+  duplicates: records repeated later in the stream.
+  collisions: tickets reusing the id of an earlier ticket.
+  noise: unrelated records, records of other types and malformed queries.
+
+Output is deterministic for a given TrafficSpec, including its seed.
+"""
+
+import argparse
+import collections
+import itertools
+import random
+import sys
+import zlib
+from vodreassembler import dnsrecord
+from vodreassembler import protocol
+from vodreassembler import util
+
+_OK = util.DataChunk(b'E\x00', 0)
+
+# Ticket ids are replied to open_ticket in 3 bytes.
+_MAX_TICKET_ID = 1 << 24
+# Compressed responses must fit the 2-byte length replied to check_request.
+# Payloads are up to twice the mean size, and doubled again by hex in text
+# messages; compression cannot be relied on for random payloads.
+MAX_RESPONSE_SIZE = 16000
+
+
+class TrafficSpec(collections.namedtuple('TrafficSpec', [
+    'num_tickets', 'request_size', 'response_size', 'binary_ratio',
+    'retry_ratio', 'duplicate_ratio', 'collision_ratio', 'noise_ratio',
+    'interleave', 'num_sessions', 'seed'])):
+  """Parameters of synthetic traffic.
+
+  Attributes:
+    num_tickets (int): Number of tickets, or None for an endless stream.
+    request_size (int): Mean size of request payloads in bytes.
+    response_size (int): Mean size of response payloads in bytes, up to
+      MAX_RESPONSE_SIZE.
+    binary_ratio (float): Fraction of tickets with binary messages.
+    retry_ratio (float): Fraction of queries which are retried.
+    duplicate_ratio (float): Fraction of records repeated later.
+    collision_ratio (float): Fraction of tickets reusing an earlier ticket id.
+    noise_ratio (float): Fraction of records which are noise.
+    interleave (int): Number of tickets in progress at once.
+    num_sessions (int): Number of socket sessions the tickets belong to.
+    seed: Seed of the random number generator.
+  """
+  pass
+
+TrafficSpec.__new__.__defaults__ = (
+    1000, 120, 500, 0.5, 0.02, 0.01, 0.005, 0.05, 16, 32, 0)
+
+
+def generate_records(spec=TrafficSpec()):
+  """Return a list of DnsRecord objects generated according to spec."""
+  if spec.num_tickets is None:
+    raise ValueError('endless traffic cannot be held in a list')
+  return list(iter_records(spec))
+
+
+def iter_records(spec=TrafficSpec(), on_ticket=None):
+  """Yield DnsRecord objects generated according to spec.
+
+  Args:
+    spec (TrafficSpec, optional): Parameters of the traffic.
+    on_ticket (callable, optional): Called with the ticket id, the raw request
+      and the compressed response of every ticket, as it is generated.
+
+  Raises:
+    ValueError: If spec.response_size exceeds MAX_RESPONSE_SIZE.
+  """
+  if spec.response_size > MAX_RESPONSE_SIZE:
+    raise ValueError('response_size must be at most {}'.format(
+        MAX_RESPONSE_SIZE))
+  rand = random.Random(spec.seed)
+  tickets = _iter_tickets(spec, rand, on_ticket)
+  active = list(itertools.islice(tickets, spec.interleave))
+  while active:
+    if rand.random() < spec.noise_ratio:
+      yield _noise_record(rand)
+      continue
+    i = rand.randrange(len(active))
+    queries = active[i]
+    query = queries.popleft()
+    yield query.encode()
+    # Query.encode() puts the retry variable before the ac flag, which is not
+    # parsed; close_ticket queries are not retried.
+    if (rand.random() < spec.retry_ratio
+        and query.type != protocol.QueryType.close_ticket):
+      variables = dict(query.variables, retry=1)
+      yield query._replace(variables=variables).encode()
+    if rand.random() < spec.duplicate_ratio:
+      queries.insert(rand.randrange(len(queries) + 1), query)
+    if not queries:
+      next_ticket = next(tickets, None)
+      if next_ticket is None:
+        active.pop(i)
+      else:
+        active[i] = next_ticket
+
+
+def write_dump(records, fileobj):
+  """Write records into a text file object in the DNS dump format."""
+  for record in records:
+    fileobj.write(' '.join(record) + '\n')
+
+
+def generate_dump(spec=TrafficSpec()):
+  """Return the records generated according to spec as dump bytes."""
+  lines = (' '.join(record) + '\n' for record in iter_records(spec))
+  return ''.join(lines).encode('utf-8')
+
+
+def _iter_tickets(spec, rand, on_ticket):
+  used_ids = []
+  seen_ids = set()
+  counter = itertools.count() if spec.num_tickets is None else range(
+      spec.num_tickets)
+  for _ in counter:
+    if used_ids and rand.random() < spec.collision_ratio:
+      ticket_id = rand.choice(used_ids)
+    else:
+      ticket_id = rand.randrange(_MAX_TICKET_ID)
+      while ticket_id in seen_ids:
+        ticket_id = rand.randrange(_MAX_TICKET_ID)
+      seen_ids.add(ticket_id)
+      used_ids.append(ticket_id)
+    yield collections.deque(_ticket_queries(spec, rand, ticket_id,
+                                            on_ticket))
+
+
+def _ticket_queries(spec, rand, ticket_id, on_ticket):
+  uuid = rand.randrange(spec.num_sessions)
+  message = '{}\xa7SocketData\xa7{}'.format(uuid, rand.randrange(4))
+  binary = rand.random() < spec.binary_ratio
+  request_payload = _random_bytes(rand, rand.randint(0, 2 * spec.request_size))
+  response_payload = _random_bytes(rand,
+                                   rand.randint(0, 2 * spec.response_size))
+  if binary:
+    request = _length_prefixed(message) + request_payload
+    response = _length_prefixed(message) + response_payload
+  else:
+    # Text messages carry their payloads as an extra hex field.
+    request = b'\x00' + '{}\xa7{}'.format(
+        message, request_payload.hex()).encode('utf-8')
+    response = '{}\xa7{}'.format(message,
+                                 response_payload.hex()).encode('utf-8')
+  response = zlib.compress(response)
+  if on_ticket is not None:
+    on_ticket(ticket_id, request, response)
+
+  # The reply is the id of the new ticket.
+  yield _query(protocol.QueryType.open_ticket,
+               {'sz': len(request), 'rn': rand.randrange(10**8),
+                'id': ticket_id},
+               util.DataChunk(ticket_id.to_bytes(3, 'big'), 0))
+  for offset in range(0, len(request), 30):
+    yield _query(protocol.QueryType.request_data,
+                 {'bf': request[offset:offset+30], 'wr': offset,
+                  'id': ticket_id}, _OK)
+  yield _query(protocol.QueryType.check_request,
+               {'ck': len(request), 'id': ticket_id},
+               util.DataChunk(b'L' + len(response).to_bytes(2, 'big'), 0))
+  for offset in range(0, len(response), 48):
+    segment = response[offset:offset+48]
+    variables = {'ln': len(segment), 'rd': offset, 'id': ticket_id}
+    for chunk_offset in range(0, len(segment), 3):
+      yield _query(protocol.QueryType.fetch_response, variables,
+                   util.DataChunk(segment[chunk_offset:chunk_offset+3],
+                                  chunk_offset))
+  yield _query(protocol.QueryType.close_ticket, {'ac': True, 'id': ticket_id},
+               _OK)
+
+
+def _query(query_type, variables, payload):
+  return protocol.Query('0', query_type, variables, payload)
+
+
+def _random_bytes(rand, size):
+  # Same as Random.randbytes() of Python 3.9.
+  if not size:
+    return b''
+  return rand.getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def _length_prefixed(text):
+  data = text.encode('utf-8')
+  return bytes((len(data),)) + data
+
+
+def _noise_record(rand):
+  kind = rand.randrange(4)
+  if kind == 0:
+    return dnsrecord.DnsRecord(
+        'www{}.example.com.'.format(rand.randrange(1000)), 'IN', 'A',
+        '10.0.{}.{}'.format(rand.randrange(256), rand.randrange(256)))
+  elif kind == 1:
+    return dnsrecord.DnsRecord('mail.example.com.', 'IN', 'CNAME',
+                               'mx.example.com.')
+  elif kind == 2:
+    return dnsrecord.DnsRecord(
+        'id-{:08d}.v0.{}'.format(rand.randrange(10**8),
+                                 protocol.DEFAULT_FQDN_SUFFIX),
+        'IN', 'TXT', 'noise')
+  return dnsrecord.DnsRecord(
+      'garbage-.v0.{}'.format(protocol.DEFAULT_FQDN_SUFFIX), 'IN', 'A',
+      '192.0.2.1')
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Write a synthetic DNS dump to stdout.')
+  for field, default in zip(TrafficSpec._fields,
+                            TrafficSpec.__new__.__defaults__):
+    parser.add_argument('--' + field, type=type(default), default=default)
+  args = parser.parse_args()
+  spec = TrafficSpec(**{field: getattr(args, field)
+                        for field in TrafficSpec._fields})
+  write_dump(iter_records(spec), sys.stdout)
+
+
+if __name__ == '__main__':
+  main()
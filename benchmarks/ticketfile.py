@@ -0,0 +1,59 @@
+"""Benchmark for ticketfile compared with pickle.
+
+Reports the size of the saved database, and the time taken to save it, load
+it entirely and load metadata of every ticket.
+"""
+
+import argparse
+import io
+import pickle
+import timeit
+from benchmarks import synthetic
+from vodreassembler import ticket
+from vodreassembler import ticketfile
+
+
+def _save(ticket_db):
+  f = io.BytesIO()
+  ticketfile.save(ticket_db, f)
+  return f.getvalue()
+
+
+def _load_metadata(data):
+  return list(ticketfile.TicketFileReader(io.BytesIO(data)))
+
+
+def run(num_tickets, request_size, response_size, repeat):
+  ticket_db = ticket.TicketDatabase()
+  ticket_db.build_from_records(synthetic.generate_records(
+      synthetic.TrafficSpec(num_tickets=num_tickets, request_size=request_size,
+                            response_size=response_size)))
+  pickled = pickle.dumps(ticket_db)
+  saved = _save(ticket_db)
+
+  def measure(func):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+  print('{:>10}: {:>12} {:>10} {:>10} {:>14}'.format(
+      'format', 'size (bytes)', 'save (s)', 'load (s)', 'metadata (s)'))
+  print('{:>10}: {:>12} {:>10.4f} {:>10.4f} {:>14}'.format(
+      'pickle', len(pickled), measure(lambda: pickle.dumps(ticket_db)),
+      measure(lambda: pickle.loads(pickled)), '-'))
+  print('{:>10}: {:>12} {:>10.4f} {:>10.4f} {:>14.4f}'.format(
+      'ticketfile', len(saved), measure(lambda: _save(ticket_db)),
+      measure(lambda: ticketfile.load(io.BytesIO(saved))),
+      measure(lambda: _load_metadata(saved))))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('-n', '--num_tickets', type=int, default=2000)
+  parser.add_argument('--request_size', type=int, default=120)
+  parser.add_argument('--response_size', type=int, default=500)
+  parser.add_argument('-r', '--repeat', type=int, default=3)
+  args = parser.parse_args()
+  run(args.num_tickets, args.request_size, args.response_size, args.repeat)
+
+
+if __name__ == '__main__':
+  main()
@@ -55,7 +55,8 @@ setup(
 
     # You can just specify the packages manually here if your project is
     # simple. Or you can use find_packages().
-    packages=find_packages(exclude=['contrib', 'docs', 'tests*']),
+    packages=find_packages(exclude=['benchmarks*', 'contrib', 'docs',
+                                    'tests*']),
 
     # List run-time dependencies here.  These will be installed by pip when
     # your project is installed. For an analysis of "install_requires" vs pip's
@@ -69,6 +70,7 @@ setup(
     # $ pip install -e .[dev,test]
     extras_require={
         'dev': ['check-manifest'],
+        'numpy': ['numpy'],
         'test': ['coverage'],
     },
 
@@ -80,6 +82,8 @@ setup(
     entry_points={
         'console_scripts': [
             'vodparse=vodreassembler.cli.parser:main',
+            'vodreplay=vodreassembler.cli.replay:main',
+            'vodserve=vodreassembler.cli.serve:main',
         ],
     },
 )
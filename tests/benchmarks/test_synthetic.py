@@ -0,0 +1,42 @@
+import io
+import unittest
+from benchmarks import synthetic
+from vodreassembler import dnsrecord
+from vodreassembler import ticket
+
+
+class TestSynthetic(unittest.TestCase):
+  def test_round_trip(self):
+    # Ticket ids are not reused, so that every ticket can be checked.
+    spec = synthetic.TrafficSpec(num_tickets=200, collision_ratio=0)
+    generated = {}
+
+    def on_ticket(ticket_id, request, response):
+      generated[ticket_id] = (request, response)
+
+    dump = io.StringIO()
+    synthetic.write_dump(synthetic.iter_records(spec, on_ticket), dump)
+    dump.seek(0)
+    ticket_db = ticket.TicketDatabase()
+    ticket_db.build_from_records(dnsrecord.from_dump(dump))
+    self.assertEqual(spec.num_tickets, len(generated))
+    self.assertEqual(sorted(generated), sorted(t.ticket_id for t in ticket_db))
+    for ticket_id, (request, response) in generated.items():
+      t = ticket_db[ticket_id]
+      self.assertFalse(t.collision)
+      self.assertEqual(request, t.raw_request_data)
+      self.assertEqual(response, t.raw_response_data)
+      self.assertEqual(len(response), t.raw_response_length)
+      self.assertIsNotNone(t.response_message)
+    self.assertEqual(synthetic.generate_dump(spec),
+                     dump.getvalue().encode('utf-8'))
+
+  def test_response_size(self):
+    spec = synthetic.TrafficSpec(
+        num_tickets=1, response_size=synthetic.MAX_RESPONSE_SIZE + 1)
+    with self.assertRaises(ValueError):
+      synthetic.generate_records(spec)
+
+
+if __name__ == '__main__':
+  unittest.main()
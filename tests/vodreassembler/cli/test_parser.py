@@ -0,0 +1,180 @@
+import binascii
+import contextlib
+import functools
+import io
+import itertools
+import os
+import signal
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from benchmarks import synthetic
+from vodreassembler import checkpoint
+from vodreassembler import dnsrecord
+from vodreassembler import protocol
+from vodreassembler import ticketfile
+from vodreassembler import util
+from vodreassembler.cli import parser
+
+
+def dump_lines(ticket_id, data):
+  payload = util.DataChunk(b'E\x00', 0)
+  return [' '.join(protocol.Query.create(
+              '0', {'bf': binascii.hexlify(data[i:i+30]).decode('ascii'),
+                    'wr': i, 'id': ticket_id}, payload).encode()) + '\n'
+          for i in range(0, len(data), 30)]
+
+
+class TestUpdate(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.TemporaryDirectory()
+    self._log = os.path.join(self._dir.name, 'dns.log')
+    self._db = os.path.join(self._dir.name, 'tickets.db')
+
+  def tearDown(self):
+    self._dir.cleanup()
+
+  def _write_log(self, ticket_id):
+    with open(self._log, 'w') as f:
+      f.writelines(dump_lines(ticket_id, os.urandom(60)))
+
+  def _update(self):
+    output = io.StringIO()
+    with mock.patch.object(sys, 'argv', ['vodparse', self._log, self._db,
+                                         '--update']), \
+         contextlib.redirect_stdout(output):
+      parser.main()
+    with open(self._db, 'rb') as f:
+      ticket_ids = sorted(t.ticket_id for t in ticketfile.load(f))
+    return ticket_ids, output.getvalue()
+
+  def test_skips_applied_sources(self):
+    self._write_log(1)
+    self.assertEqual([1], self._update()[0])
+    ticket_ids, output = self._update()
+    self.assertEqual([1], ticket_ids)
+    self.assertIn('Skipping', output)
+
+  def test_applies_rotated_source(self):
+    self._write_log(1)
+    self._update()
+    # Rotated; a new file reuses the name.
+    self._write_log(2)
+    ticket_ids, output = self._update()
+    self.assertEqual([1, 2], ticket_ids)
+    self.assertNotIn('Skipping', output)
+
+
+class TestFollow(unittest.TestCase):
+  def setUp(self):
+    self._dir = tempfile.TemporaryDirectory()
+    self._log = os.path.join(self._dir.name, 'dns.log')
+    self._dest = os.path.join(self._dir.name, 'tickets')
+
+  def tearDown(self):
+    self._dir.cleanup()
+
+  def _append_log(self, ticket_id):
+    close_ticket = protocol.Query.create('0', {'ac': True, 'id': ticket_id},
+                                         util.DataChunk(b'E\x00', 0))
+    with open(self._log, 'a') as f:
+      f.writelines(dump_lines(ticket_id, os.urandom(60)))
+      f.write(' '.join(close_ticket.encode()) + '\n')
+
+  def _follow(self):
+    # Follows until the log is idle, then stops as on SIGTERM.
+    handlers = {}
+    def sleep(_):
+      handlers[signal.SIGTERM](signal.SIGTERM, None)
+    follow_dump = functools.partial(dnsrecord.follow_dump, sleep=sleep)
+    output = io.StringIO()
+    with mock.patch.object(sys, 'argv', ['vodparse', self._log, self._dest,
+                                         '--follow']), \
+         mock.patch.object(parser.signal, 'signal',
+                           lambda signum, handler: handlers.update(
+                               {signum: handler})), \
+         mock.patch.object(parser.dnsrecord, 'follow_dump', follow_dump), \
+         contextlib.redirect_stdout(output):
+      parser.main()
+    return [sorted(t.ticket_id for t in tickets)
+            for tickets in self._written()], output.getvalue()
+
+  def _written(self):
+    # Tickets of every file written, in order.
+    for name in sorted(os.listdir(self._dest)):
+      if name.startswith('tickets-'):
+        with open(os.path.join(self._dest, name), 'rb') as f:
+          yield list(ticketfile.load(f))
+
+  def test_resumes(self):
+    self._append_log(1)
+    self.assertEqual([[1]], self._follow()[0])
+    self._append_log(2)
+    ticket_ids, output = self._follow()
+    self.assertIn('Resuming', output)
+    self.assertEqual([[1], [2]], ticket_ids)
+    _, saved = checkpoint.load(os.path.join(self._dest, 'follow.checkpoint'))
+    self.assertEqual(os.path.getsize(self._log), saved.source_offset)
+    self.assertEqual(6, saved.num_records)
+
+  def test_synthetic(self):
+    spec = synthetic.TrafficSpec(num_tickets=100, collision_ratio=0)
+    with open(self._log, 'w') as f:
+      synthetic.write_dump(synthetic.iter_records(spec), f)
+    self._follow()
+    tickets = list(itertools.chain.from_iterable(self._written()))
+    # Late records of finished tickets, e.g. their close_ticket queries and
+    # retries, do not make more tickets.
+    self.assertEqual(100, len(tickets))
+    self.assertEqual(100, len({t.ticket_id for t in tickets}))
+    for t in tickets:
+      self.assertIsNotNone(t.response_message)
+
+  def test_rotated(self):
+    self._append_log(1)
+    self._follow()
+    os.rename(self._log, self._log + '.1')
+    self._append_log(2)
+    ticket_ids, output = self._follow()
+    self.assertIn('replaced', output)
+    self.assertEqual([[1], [2]], ticket_ids)
+
+
+class TestDeduceType(unittest.TestCase):
+  # Built at runtime, as when read from argv, so it is not the interned
+  # literal, and only equal to it.
+  AUTO = ''.join(['au', 'to'])
+
+  def test_deduce_src_type(self):
+    with tempfile.NamedTemporaryFile('w', suffix='.log') as f:
+      f.writelines(dump_lines(1, b'data'))
+      f.flush()
+      self.assertEqual('dns_dump', parser.deduce_src_type(self.AUTO, f.name))
+    self.assertEqual('pcap', parser.deduce_src_type('pcap', None))
+
+  def test_deduce_dest_type(self):
+    self.assertEqual('ticket_db', parser.deduce_dest_type(self.AUTO))
+    self.assertEqual('sessions', parser.deduce_dest_type('sessions'))
+
+
+class TestConversionPath(unittest.TestCase):
+  def _steps(self, input_type, output_type):
+    return [transform.__name__ for transform in
+            parser.compute_conversion_path(input_type, output_type)]
+
+  def test_shortest_path(self):
+    # Dumps are built directly, which --checkpoint relies on, rather than by
+    # the longer path through __dns_records, which used to replace it.
+    self.assertEqual(['build_ticket_db_from_dump', 'save_ticket_db'],
+                     self._steps('dns_dump', 'ticket_db'))
+    self.assertEqual(['parse_pcap', 'generate_ticket_db', 'write_sessions'],
+                     self._steps('pcap', 'sessions'))
+
+  def test_no_cycle_through_input(self):
+    with self.assertRaises(Exception):
+      parser.compute_conversion_path('ticket_db', 'ticket_db')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,153 @@
+import binascii
+import io
+import os
+import tempfile
+import unittest
+from vodreassembler import checkpoint
+from vodreassembler import dnsrecord
+from vodreassembler import protocol
+from vodreassembler import ticket
+from vodreassembler import ticketfile
+from vodreassembler import util
+import zlib
+
+
+class TestCheckpoint(unittest.TestCase):
+  REQUEST = b'\x00' + b'hello world' * 10
+  RESPONSE = zlib.compress(b'\x00' + os.urandom(200))
+
+  def _request_records(self, ticket_id, data):
+    payload = util.DataChunk(b'E\x00', 0)
+    return [protocol.Query.create(
+                '0', {'bf': binascii.hexlify(data[i:i+30]).decode('ascii'),
+                      'wr': i, 'id': ticket_id}, payload).encode()
+            for i in range(0, len(data), 30)]
+
+  def _response_records(self, ticket_id, data):
+    records = []
+    for i in range(0, len(data), 48):
+      segment = data[i:i+48]
+      query_vars = {'ln': len(segment), 'rd': i, 'id': ticket_id}
+      for off in range(0, len(segment), 3):
+        records.append(protocol.Query.create(
+            '0', query_vars, util.DataChunk(segment[off:off+3], off)).encode())
+    return records
+
+  def setUp(self):
+    self._dir = tempfile.TemporaryDirectory()
+    self._path = os.path.join(self._dir.name, 'build.checkpoint')
+    records = []
+    for ticket_id in (1, 2, 3):
+      records += self._request_records(ticket_id, self.REQUEST)
+      records += self._response_records(ticket_id, self.RESPONSE)
+    records.append(dnsrecord.DnsRecord('foo.example.com.', 'IN', 'A',
+                                       '1.2.3.4'))
+    records.append(dnsrecord.DnsRecord('id-00000004.v0.tun.vpnoverdns.com.',
+                                       'IN', 'TXT', 'unknown'))
+    self._records = records
+    self._lines = [' '.join(r).encode('utf-8') + b'\n' for r in records]
+
+  def tearDown(self):
+    self._dir.cleanup()
+
+  def _dump(self):
+    return io.BytesIO(b''.join(self._lines))
+
+  def _expected(self):
+    ticket_db = ticket.TicketDatabase()
+    ticket_db.build_from_records(self._records)
+    return ticket_db
+
+  def assertSameTickets(self, expected, actual):
+    self.assertEqual([t.ticket_id for t in expected],
+                     [t.ticket_id for t in actual])
+    for t in expected:
+      self.assertEqual(t.raw_request_data, actual[t.ticket_id].raw_request_data)
+      self.assertEqual(t.raw_response_data,
+                       actual[t.ticket_id].raw_response_data)
+    self.assertEqual(expected.rejections, actual.rejections)
+
+  def test_build_from_dump(self):
+    ticket_db = ticket.TicketDatabase()
+    last = checkpoint.build_from_dump(ticket_db, self._dump(), self._path)
+    self.assertEqual(checkpoint.Checkpoint(
+        len(b''.join(self._lines)), len(self._records),
+        checkpoint.SourceIdentity.of_file(self._dump())), last)
+    self.assertSameTickets(self._expected(), ticket_db)
+    loaded, saved = checkpoint.load(self._path)
+    self.assertEqual(last, saved)
+    self.assertSameTickets(ticket_db, loaded)
+    self.assertFalse(os.path.exists(self._path + '.tmp'))
+
+  def test_resume(self):
+    # Checkpoint in the middle of the response of ticket 2, as if the build
+    # was interrupted after saving it.
+    num_records = len(self._records) // 2
+    partial = ticket.TicketDatabase()
+    partial.build_from_records(self._records[:num_records])
+    offset = len(b''.join(self._lines[:num_records]))
+    checkpoint.save(partial, self._path,
+                    checkpoint.Checkpoint(offset, num_records))
+
+    ticket_db, start = checkpoint.load(self._path)
+    self.assertEqual(num_records, start.num_records)
+    self.assertLess(len(ticket_db[2].partial_response),
+                    len(zlib.decompress(self.RESPONSE)))
+    last = checkpoint.build_from_dump(ticket_db, self._dump(), self._path,
+                                      start=start)
+    self.assertEqual(len(self._records), last.num_records)
+    self.assertSameTickets(self._expected(), ticket_db)
+
+  def test_resume_other_source(self):
+    num_records = len(self._records) // 2
+    partial = ticket.TicketDatabase()
+    partial.build_from_records(self._records[:num_records])
+    offset = len(b''.join(self._lines[:num_records]))
+    source = checkpoint.SourceIdentity.of_file(self._dump())
+    checkpoint.save(partial, self._path,
+                    checkpoint.Checkpoint(offset, num_records, source))
+    ticket_db, start = checkpoint.load(self._path)
+    self.assertEqual(source, start.source)
+    # A rotated dump reusing the name.
+    rotated = io.BytesIO(b''.join(reversed(self._lines)))
+    with self.assertRaises(checkpoint.SourceMismatchError):
+      checkpoint.build_from_dump(ticket_db, rotated, self._path, start=start)
+    # The dump grown since.
+    grown = io.BytesIO(self._dump().getvalue() + self._lines[0])
+    last = checkpoint.build_from_dump(ticket_db, grown, self._path,
+                                      start=start)
+    self.assertEqual(len(self._records) + 1, last.num_records)
+    self.assertEqual(source, last.source)
+
+  def test_resume_dedup(self):
+    # Every record is repeated, and the build is interrupted between the two
+    # copies of a record of ticket 2.
+    lines = [line for line in self._lines for _ in range(2)]
+    split = 2 * (len(self._records) // 2) + 1
+    dedup = protocol.DuplicateFilter(16)
+    ticket_db = ticket.TicketDatabase()
+    checkpoint.build_from_dump(ticket_db, io.BytesIO(b''.join(lines[:split])),
+                               self._path, dedup=dedup)
+    partial_hits = dedup.hits
+
+    ticket_db, start = checkpoint.load(self._path)
+    self.assertEqual(dedup.recent_keys(), start.dedup_keys)
+    resumed = protocol.DuplicateFilter(16)
+    checkpoint.build_from_dump(ticket_db, io.BytesIO(b''.join(lines)),
+                               self._path, start=start, dedup=resumed)
+    uninterrupted = protocol.DuplicateFilter(16)
+    expected = ticket.TicketDatabase()
+    expected.build_from_records(
+        [r for r in self._records for _ in range(2)], dedup=uninterrupted)
+    self.assertEqual(uninterrupted.hits, partial_hits + resumed.hits)
+    self.assertSameTickets(expected, ticket_db)
+
+  def test_load_not_checkpoint(self):
+    with open(self._path, 'wb') as f:
+      ticketfile.save(ticket.TicketDatabase(), f)
+    with self.assertRaises(checkpoint.Error):
+      checkpoint.load(self._path)
+
+
+if __name__ == '__main__':
+  unittest.main()
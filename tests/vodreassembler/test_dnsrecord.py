@@ -0,0 +1,173 @@
+import io
+import itertools
+import os
+import tempfile
+import unittest
+from vodreassembler import dnsrecord
+
+
+class TestFromDump(unittest.TestCase):
+  DUMP = ('foo.example.com. IN A 1.2.3.4\n'
+          'id-00000001.v0.tun.vpnoverdns.com. IN A 192.178.115.214\n'
+          'bar.example.com. IN CNAME baz.example.com.\n'
+          '  ac.id-00000001.v0.tun.vpnoverdns.com.\tIN A 128.69.0.255  \n'
+          'id-00000002.v0.tun.vpnoverdns.com. IN A 192.178.115.215')
+
+  def _expected(self, contains=None):
+    return [r for r in dnsrecord.from_dump(io.StringIO(self.DUMP))
+            if contains is None or contains in r.fqdn]
+
+  def _read_batches(self, block_size, **kwargs):
+    src = io.BytesIO(self.DUMP.encode('utf-8'))
+    return list(dnsrecord.from_dump_batches(src, block_size=block_size,
+                                            **kwargs))
+
+  def test_from_dump_batches(self):
+    for block_size in (1, 7, 64, 4096):
+      batches = self._read_batches(block_size)
+      self.assertTrue(all(batches))
+      self.assertEqual(self._expected(), sum(batches, []))
+
+  def test_from_dump_batches_contains(self):
+    for block_size in (1, 7, 64, 4096):
+      batches = self._read_batches(block_size,
+                                   contains='tun.vpnoverdns.com.')
+      self.assertEqual(self._expected('tun.vpnoverdns.com.'),
+                       sum(batches, []))
+    self.assertEqual([], self._read_batches(4096, contains='illinois.edu.'))
+
+  def test_from_dump_columns(self):
+    src = io.BytesIO(self.DUMP.encode('utf-8') + b'\n')
+    columns, = dnsrecord.from_dump_columns(src, contains='vpnoverdns')
+    self.assertEqual(['IN', 'IN', 'IN'], columns.classes)
+    self.assertEqual(['A', 'A', 'A'], columns.types)
+    self.assertEqual(['192.178.115.214', '128.69.0.255', '192.178.115.215'],
+                     columns.values)
+    self.assertEqual(self._expected('vpnoverdns'), columns.records())
+
+  def test_from_dump_columns_empty_lines(self):
+    src = io.BytesIO(b'\n\na.com. IN A 1.2.3.4\r\n\n')
+    columns, = dnsrecord.from_dump_columns(src)
+    self.assertEqual([dnsrecord.DnsRecord('a.com.', 'IN', 'A', '1.2.3.4')],
+                     columns.records())
+    self.assertEqual([], list(dnsrecord.from_dump_columns(io.BytesIO(b''))))
+
+  def test_from_dump_blocks(self):
+    data = self.DUMP.encode('utf-8')
+    for block_size in (1, 7, 64, 4096):
+      blocks = list(dnsrecord.from_dump_blocks(io.BytesIO(data),
+                                               block_size=block_size))
+      self.assertEqual(self._expected(), sum((r for r, _ in blocks), []))
+      self.assertEqual(len(data), blocks[-1][1])
+      # Resuming from any offset reads the rest of the records.
+      num_records = 0
+      for records, offset in blocks:
+        num_records += len(records)
+        src = io.BytesIO(data)
+        src.seek(offset)
+        rest = dnsrecord.from_dump_blocks(src, block_size=block_size)
+        self.assertEqual(self._expected()[num_records:],
+                         sum((r for r, _ in rest), []))
+
+  def test_follow_dump(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      path = os.path.join(tmpdir, 'dns.log')
+      with open(path, 'w') as f:
+        f.write('a.com. IN A 1.2.3.4\nb.com. IN')
+      records = dnsrecord.follow_dump(path, sleep=lambda _: None)
+      self.assertEqual(dnsrecord.DnsRecord('a.com.', 'IN', 'A', '1.2.3.4'),
+                       next(records))
+      # The incomplete line is held until its newline is written.
+      self.assertIsNone(next(records))
+      with open(path, 'a') as f:
+        f.write(' A 1.2.3.5\nc.com. IN A')
+      self.assertEqual('b.com.', next(records).fqdn)
+      self.assertIsNone(next(records))
+
+      # Rotated; the rest of the old file is read before the new one.
+      with open(path, 'a') as f:
+        f.write(' 1.2.3.6\nd.com. IN A 1.2.3.7')
+      os.rename(path, path + '.1')
+      self.assertEqual('c.com.', next(records).fqdn)
+      self.assertIsNone(next(records))
+      with open(path, 'w') as f:
+        f.write('e.com. IN A 1.2.3.8\n')
+      self.assertEqual(['d.com.', 'e.com.'],
+                       [next(records).fqdn for _ in range(2)])
+      self.assertIsNone(next(records))
+
+      # Truncated in place, and shorter than what has been read.
+      with open(path, 'w') as f:
+        f.write('f. IN A 1.2.3.9\n')
+      self.assertEqual('f.', next(records).fqdn)
+      self.assertIsNone(next(records))
+      records.close()
+
+  def test_follow_dump_heartbeats_while_flowing(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      path = os.path.join(tmpdir, 'dns.log')
+      with open(path, 'w') as f:
+        f.write('a.com. IN A 1.2.3.4\nb.com. IN A 1.2.3.5\n')
+      times = iter([0, 1, 1, 1, 1])
+      records = dnsrecord.follow_dump(path, block_size=20,
+                                      sleep=lambda _: None,
+                                      clock=lambda: next(times))
+      self.assertEqual('a.com.', next(records).fqdn)
+      # A second has passed by the end of the first block.
+      self.assertIsNone(next(records))
+      self.assertEqual('b.com.', next(records).fqdn)
+      records.close()
+
+  def test_follow_dump_position(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      path = os.path.join(tmpdir, 'dns.log')
+      with open(path, 'w') as f:
+        f.write('a.com. IN A 1.2.3.4\nb.com. IN')
+      position = dnsrecord.FollowPosition()
+      records = dnsrecord.follow_dump(path, sleep=lambda _: None,
+                                      position=position)
+      next(records)
+      self.assertIsNone(next(records))
+      records.close()
+      self.assertEqual(20, position.offset)
+      self.assertEqual(1, position.num_records)
+
+      # Resumed at the position, after the incomplete line is completed.
+      with open(path, 'a') as f:
+        f.write(' A 1.2.3.5\n')
+      records = dnsrecord.follow_dump(path, sleep=lambda _: None,
+                                      position=position)
+      self.assertEqual('b.com.', next(records).fqdn)
+      self.assertIsNone(next(records))
+      records.close()
+      self.assertEqual(2, position.num_records)
+
+      # Started from the beginning of another file.
+      os.rename(path, path + '.1')
+      with open(path, 'w') as f:
+        f.write('c.com. IN A 1.2.3.6\n')
+      records = dnsrecord.follow_dump(path, sleep=lambda _: None,
+                                      position=position)
+      self.assertEqual('c.com.', next(records).fqdn)
+      records.close()
+
+  def test_follow_dump_contains(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      path = os.path.join(tmpdir, 'dns.log')
+      with open(path, 'w') as f:
+        f.write(self.DUMP + '\n')
+      records = dnsrecord.follow_dump(path, contains='vpnoverdns',
+                                      sleep=lambda _: None)
+      self.assertEqual(self._expected('vpnoverdns'),
+                       list(itertools.takewhile(lambda r: r is not None,
+                                                records)))
+      records.close()
+
+  def test_from_dump_columns_malformed(self):
+    src = io.BytesIO(b'a.com. IN A\nb.com. IN A 1.2.3.4 5\n')
+    with self.assertRaises(TypeError):
+      list(dnsrecord.from_dump_columns(src))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,182 @@
+import asyncio
+import binascii
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from vodreassembler import ingest
+from vodreassembler import protocol
+from vodreassembler import ticket
+from vodreassembler import util
+
+
+def dump_lines(records):
+  return ['{} {} {} {}\n'.format(*r).encode('ascii') for r in records]
+
+
+def ticket_contents(ticket_db):
+  return {t.ticket_id: (t.raw_request_data, t.raw_response_data)
+          for t in ticket_db}
+
+
+class TestIngestServer(unittest.TestCase):
+  def setUp(self):
+    payload = util.DataChunk(b'E\x00', 0)
+    self._records = []
+    for ticket_id in range(1, 21):
+      data = os.urandom(60)
+      self._records += [
+          protocol.Query.create(
+              '0', {'bf': binascii.hexlify(data[i:i+30]).decode('ascii'),
+                    'wr': i, 'id': ticket_id}, payload).encode()
+          for i in range(0, len(data), 30)]
+    expected_db = ticket.TicketDatabase()
+    expected_db.build_from_records(self._records)
+    self._expected = ticket_contents(expected_db)
+    self._lines = dump_lines(self._records)
+    # Lines which are skipped.
+    self._lines.insert(3, b'foo.example.com. IN A 1.2.3.4\n')
+    self._lines.insert(7, b'malformed.tun.vpnoverdns.com. IN A\n')
+
+  def _serve(self, start, address, **kwargs):
+    ticket_db = ticket.TicketDatabase()
+    server = ingest.IngestServer(ticket_db, max_delay=0.01,
+                                 contains='tun.vpnoverdns.com.', **kwargs)
+
+    async def run():
+      bound = await start(server)
+      replayed = await asyncio.get_running_loop().run_in_executor(
+          None, lambda: ingest.replay(self._lines, address or bound,
+                                      send_size=100))
+      # Datagrams may still be in flight.
+      while server.stats.received_lines < replayed.records - 2:
+        await asyncio.sleep(0.01)
+      await server.close()
+      return replayed
+
+    replayed = asyncio.run(run())
+    return ticket_db, server.stats, replayed
+
+  def test_unix(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      path = os.path.join(tmpdir, 'ingest.sock')
+      # A single queued read makes the stream wait while a batch is applied.
+      ticket_db, stats, replayed = self._serve(
+          lambda server: server.start_unix(path), path, batch_size=7,
+          queue_size=1)
+    self.assertEqual(self._expected, ticket_contents(ticket_db))
+    self.assertEqual(len(self._lines), replayed.records)
+    self.assertEqual(sum(map(len, self._lines)), stats.received_bytes)
+    self.assertEqual(len(self._lines), stats.received_lines)
+    self.assertEqual(len(self._records), stats.applied_records)
+    self.assertEqual(1, stats.malformed_lines)
+    self.assertGreaterEqual(stats.batches, 1)
+    self.assertGreaterEqual(stats.max_latency, stats.mean_latency)
+
+  def test_failing_batches(self):
+    def on_applied(ticket_db):
+      raise OSError('No space left on device')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+      path = os.path.join(tmpdir, 'ingest.sock')
+      # Senders would be blocked for good if the queue stopped draining.
+      ticket_db, stats, _ = self._serve(
+          lambda server: server.start_unix(path), path, batch_size=7,
+          queue_size=1, on_applied=on_applied)
+    self.assertEqual(self._expected, ticket_contents(ticket_db))
+    self.assertEqual(0, stats.batches)
+    self.assertGreaterEqual(stats.failed_batches, 1)
+    self.assertEqual(len(self._lines), stats.failed_lines)
+    self.assertIsInstance(stats.last_error, OSError)
+    self.assertIn('No space left', stats.report())
+
+  def test_udp(self):
+    ticket_db, stats, replayed = self._serve(
+        lambda server: server.start_udp('127.0.0.1', 0), None)
+    self.assertEqual(self._expected, ticket_contents(ticket_db))
+    self.assertGreater(replayed.sends, 1)
+    self.assertEqual(replayed.bytes, stats.received_bytes)
+    self.assertEqual(0, stats.dropped_datagrams)
+    self.assertEqual(len(self._records), stats.applied_records)
+
+  @unittest.skipUnless(socket.has_ipv6, 'IPv6 is not supported')
+  def test_udp_ipv6(self):
+    try:
+      ticket_db, stats, _ = self._serve(
+          lambda server: server.start_udp('::1', 0), None)
+    except OSError as e:
+      self.skipTest('IPv6 loopback is unavailable: {}'.format(e))
+    self.assertEqual(self._expected, ticket_contents(ticket_db))
+    self.assertEqual(len(self._records), stats.applied_records)
+
+  def test_udp_drops_when_full(self):
+    blocked = threading.Event()
+    released = threading.Event()
+
+    def on_applied(ticket_db):
+      blocked.set()
+      released.wait()
+
+    ticket_db = ticket.TicketDatabase()
+    server = ingest.IngestServer(ticket_db, batch_size=1, queue_size=1,
+                                 on_applied=on_applied)
+
+    async def run():
+      loop = asyncio.get_running_loop()
+      address = await server.start_udp('127.0.0.1', 0)
+      replay = lambda lines: ingest.replay(lines, address, send_size=1)
+      await loop.run_in_executor(None, replay, self._lines[:1])
+      # The worker is stuck on the first batch; one datagram is queued and
+      # the rest are dropped.
+      await loop.run_in_executor(None, blocked.wait)
+      await loop.run_in_executor(None, replay, self._lines[1:3])
+      while (server.stats.received_bytes
+             < sum(map(len, self._lines[:3]))):
+        await asyncio.sleep(0.01)
+      released.set()
+      await server.close()
+
+    asyncio.run(run())
+    self.assertEqual(1, server.stats.dropped_datagrams)
+    self.assertEqual(2, server.stats.applied_records)
+
+
+class TestReplay(unittest.TestCase):
+  def test_rate(self):
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+      sleeps.append(seconds)
+      now[0] += seconds
+
+    lines = [b'a.com. IN A 1.2.3.4\n', b'\n', b'b.com. IN A 1.2.3.4'] * 2
+    with tempfile.TemporaryDirectory() as tmpdir:
+      path = os.path.join(tmpdir, 'replay.sock')
+      received = []
+
+      async def run():
+        async def handle(reader, writer):
+          received.append(await reader.read())
+          writer.close()
+        server = await asyncio.start_unix_server(handle, path)
+        stats = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: ingest.replay(lines, path, rate=2.0,
+                                        clock=lambda: now[0], sleep=sleep))
+        while not received:
+          await asyncio.sleep(0.01)
+        server.close()
+        return stats
+
+      stats = asyncio.run(run())
+    self.assertEqual(4, stats.records)
+    self.assertEqual([0.5, 0.5, 0.5], sleeps)
+    self.assertEqual(4, stats.sends)
+    self.assertEqual(1.5, stats.elapsed)
+    self.assertEqual(b'a.com. IN A 1.2.3.4\nb.com. IN A 1.2.3.4\n' * 2,
+                     received[0])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,198 @@
+import io
+import os
+import struct
+import unittest
+from vodreassembler import dnsrecord
+from vodreassembler import pcap
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+RECORDS = [
+    dnsrecord.DnsRecord('id-00000001.v0.tun.vpnoverdns.com.', 'IN', 'A',
+                        '192.178.115.214'),
+    dnsrecord.DnsRecord('ac.id-00000001.v0.tun.vpnoverdns.com.', 'IN', 'A',
+                        '128.69.0.255'),
+]
+
+
+def _name(fqdn):
+  return b''.join(bytes([len(label)]) + label.encode('ascii')
+                  for label in fqdn.rstrip('.').split('.')) + b'\0'
+
+
+def dns_response(record, compress=True, query_id=0x1234):
+  """DNS response with a single A record answering a question for it."""
+  question = _name(record.fqdn) + struct.pack('!HH', 1, 1)
+  # Pointer to the name in the question section.
+  name = b'\xc0\x0c' if compress else _name(record.fqdn)
+  answer = name + struct.pack('!HHIH', 1, 1, 300, 4) + bytes(
+      int(octet) for octet in record.value.split('.'))
+  return struct.pack('!HHHHHH', query_id, 0x8180, 1, 1, 0, 0) + (
+      question + answer)
+
+
+def udp(payload, source_port=53):
+  return struct.pack('!HHHH', source_port, 40000, 8 + len(payload),
+                     0) + payload
+
+
+def ipv4(datagram, fragment=0):
+  return struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(datagram), 0,
+                     fragment, 64, 17, 0, bytes((8, 8, 8, 8)),
+                     bytes((10, 0, 0, 1))) + datagram
+
+
+def ipv6(datagram):
+  return struct.pack('!IHBB16s16s', 6 << 28, len(datagram), 17, 64,
+                     bytes(15) + b'\1', bytes(15) + b'\2') + datagram
+
+
+def ethernet(packet, ethertype=0x0800, vlan=False):
+  header = bytes(12)
+  if vlan:
+    header += struct.pack('!HH', 0x8100, 1)
+  return header + struct.pack('!H', ethertype) + packet
+
+
+def pcap_file(packets, linktype=1, byte_order='<', nanoseconds=False):
+  magic = 0xa1b23c4d if nanoseconds else 0xa1b2c3d4
+  out = struct.pack(byte_order + 'IHHiIII', magic, 2, 4, 0, 0, 65535,
+                    linktype)
+  for i, packet in enumerate(packets):
+    out += struct.pack(byte_order + 'IIII', 1000 + i, 500, len(packet),
+                       len(packet)) + packet
+  return out
+
+
+def _pcapng_block(block_type, body, byte_order):
+  body += bytes(-len(body) % 4)
+  length = 12 + len(body)
+  return struct.pack(byte_order + 'II', block_type, length) + body + (
+      struct.pack(byte_order + 'I', length))
+
+
+def pcapng_file(packets, linktype=1, byte_order='<', simple=False):
+  out = _pcapng_block(0x0a0d0d0a, struct.pack(byte_order + 'IHHq',
+                                              0x1a2b3c4d, 1, 0, -1),
+                      byte_order)
+  out += _pcapng_block(1, struct.pack(byte_order + 'HHI', linktype, 0, 0),
+                       byte_order)
+  for i, packet in enumerate(packets):
+    if simple:
+      body = struct.pack(byte_order + 'I', len(packet)) + packet
+      out += _pcapng_block(3, body, byte_order)
+    else:
+      timestamp = (1000 + i) * 1000000 + 500
+      body = struct.pack(byte_order + 'IIIII', 0, timestamp >> 32,
+                         timestamp & 0xffffffff, len(packet),
+                         len(packet)) + packet
+      out += _pcapng_block(6, body, byte_order)
+  return out
+
+
+def ethernet_packets():
+  return [ethernet(ipv4(udp(dns_response(r)))) for r in RECORDS]
+
+
+class TestFromPcap(unittest.TestCase):
+  def _read(self, data, **kwargs):
+    return list(pcap.from_pcap(io.BytesIO(data), **kwargs))
+
+  def test_pcap(self):
+    for byte_order in '<>':
+      for nanoseconds in (False, True):
+        data = pcap_file(ethernet_packets(), byte_order=byte_order,
+                         nanoseconds=nanoseconds)
+        self.assertEqual(RECORDS, self._read(data))
+
+  def test_pcapng(self):
+    for byte_order in '<>':
+      for simple in (False, True):
+        data = pcapng_file(ethernet_packets(), byte_order=byte_order,
+                           simple=simple)
+        self.assertEqual(RECORDS, self._read(data))
+
+  def test_timestamps(self):
+    for data in (pcap_file(ethernet_packets()),
+                 pcapng_file(ethernet_packets())):
+      timestamps = [timestamp for timestamp, _ in
+                    pcap.from_pcap_with_timestamps(io.BytesIO(data))]
+      self.assertEqual(2, len(timestamps))
+      self.assertAlmostEqual(1000.0005, timestamps[0])
+      self.assertAlmostEqual(1001.0005, timestamps[1])
+
+  def test_link_types(self):
+    datagrams = [udp(dns_response(r)) for r in RECORDS]
+    cases = [
+        (1, [ethernet(ipv4(d), vlan=True) for d in datagrams]),
+        (1, [ethernet(ipv6(d), ethertype=0x86dd) for d in datagrams]),
+        (0, [struct.pack('<I', 2) + ipv4(d) for d in datagrams]),
+        (101, [ipv4(d) for d in datagrams]),
+        (229, [ipv6(d) for d in datagrams]),
+        (113, [bytes(14) + b'\x08\x00' + ipv4(d) for d in datagrams]),
+        (276, [b'\x08\x00' + bytes(18) + ipv4(d) for d in datagrams]),
+    ]
+    for linktype, packets in cases:
+      self.assertEqual(RECORDS,
+                       self._read(pcap_file(packets, linktype=linktype)),
+                       'linktype {}'.format(linktype))
+
+  def test_uncompressed_names(self):
+    packets = [ethernet(ipv4(udp(dns_response(r, compress=False))))
+               for r in RECORDS]
+    self.assertEqual(RECORDS, self._read(pcap_file(packets)))
+
+  def test_skips_irrelevant_packets(self):
+    response = dns_response(RECORDS[0])
+    query = bytearray(response)
+    query[2] &= 0x7f  # clear the response flag
+    packets = [
+        ethernet(ipv4(udp(response, source_port=5353))),
+        ethernet(ipv4(udp(bytes(query)))),
+        ethernet(ipv4(udp(response), fragment=0x2000)),
+        ethernet(b'\0' * 28, ethertype=0x0806),
+        ethernet(ipv4(udp(response))[:-3]),
+        ethernet(ipv4(udp(response))),
+    ]
+    self.assertEqual(RECORDS[:1], self._read(pcap_file(packets)))
+    self.assertEqual(2, len(self._read(pcap_file(packets),
+                                       ports=(53, 5353))))
+
+  def test_compression_loop(self):
+    message = bytearray(dns_response(RECORDS[0]))
+    # Make the answer name point at itself.
+    offset = message.rindex(b'\xc0\x0c')
+    message[offset+1] = offset
+    self.assertEqual([], self._read(pcap_file(
+        [ethernet(ipv4(udp(bytes(message))))])))
+
+  def test_invalid_file(self):
+    with self.assertRaises(pcap.FormatError):
+      self._read(b'id-1.v0.tun.vpnoverdns.com. IN A 1.2.3.4\n')
+    with self.assertRaises(pcap.FormatError):
+      self._read(pcap_file(ethernet_packets())[:-1])
+
+  def test_undescribed_interface(self):
+    data = bytearray(pcapng_file(ethernet_packets()))
+    # Interface id of the first enhanced packet block, after the section
+    # header and the interface description.
+    struct.pack_into('<I', data, 28 + 20 + 8, 1)
+    with self.assertRaises(pcap.FormatError):
+      self._read(bytes(data))
+    with self.assertRaises(pcap.FormatError):
+      self._read(pcapng_file(ethernet_packets(), simple=True)[:28] +
+                 pcapng_file(ethernet_packets(), simple=True)[48:])
+
+  def test_is_capture(self):
+    self.assertTrue(pcap.is_capture(pcap_file([])))
+    self.assertTrue(pcap.is_capture(pcapng_file([])))
+    self.assertFalse(pcap.is_capture(b'id-1.v0.tun.vpnoverdns.com.'))
+
+  def test_fixtures(self):
+    for name in ('dns.pcap', 'dns.pcapng'):
+      with open(os.path.join(DATA_DIR, name), 'rb') as f:
+        self.assertEqual(RECORDS, list(pcap.from_pcap(f)), name)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+from vodreassembler import dnsrecord
+from vodreassembler import pipeline
+from vodreassembler import protocol
+from vodreassembler import ticket
+from vodreassembler import util
+
+
+class TestPipeline(unittest.TestCase):
+  def _records(self, num_tickets):
+    records = [dnsrecord.DnsRecord('foo.example.com.', 'IN', 'A', '1.2.3.4')]
+    for ticket_id in range(num_tickets):
+      data = bytes([ticket_id % 256]) * 100
+      for i in range(0, len(data), 30):
+        records.append(protocol.Query.create(
+            '0', {'bf': data[i:i+30].hex(), 'wr': i, 'id': ticket_id},
+            util.DataChunk(b'E\x00', 0)).encode())
+    return records
+
+  def test_build_ticket_db(self):
+    records = self._records(50)
+    expected = ticket.TicketDatabase()
+    expected.build_from_records(records)
+    ticket_db, stats = pipeline.build_ticket_db(
+        iter(records), processes=2, batch_size=7, queue_size=2)
+    self.assertEqual(repr(expected), repr(ticket_db))
+    self.assertEqual([t.raw_request_data for t in expected],
+                     [t.raw_request_data for t in ticket_db])
+    self.assertEqual({'suffix': 1}, dict(ticket_db.rejections))
+    for stage in stats.stages:
+      self.assertEqual(len(records), stage.records)
+      self.assertEqual(-(-len(records) // 7), stage.batches)
+    for queue in stats.queues:
+      self.assertLessEqual(queue.max_occupancy, 2)
+    self.assertIn('assemble', stats.report())
+
+  def test_build_ticket_db_existing(self):
+    records = self._records(10)
+    expected = ticket.TicketDatabase()
+    expected.build_from_records(records)
+    ticket_db = ticket.TicketDatabase()
+    ticket_db.build_from_records(records[:20])
+    result, _ = pipeline.build_ticket_db(records[20:], ticket_db)
+    self.assertIs(ticket_db, result)
+    self.assertEqual(repr(expected), repr(ticket_db))
+
+  def test_empty(self):
+    ticket_db, stats = pipeline.build_ticket_db([])
+    self.assertEqual(0, len(ticket_db))
+    self.assertIsNone(stats.stages[0].throughput)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,3 +1,4 @@
+import pickle
 import unittest
 from vodreassembler import dnsrecord
 from vodreassembler import protocol
@@ -58,6 +59,35 @@ class TestProtocol(unittest.TestCase):
     with self.assertRaises(ValueError):
       protocol.ipv4_to_chunk('1.128.64.1999')
 
+  @unittest.skipIf(protocol.numpy is None, 'requires NumPy')
+  def test_ipv4_to_chunks(self):
+    addrs = ['192.168.0.0', '129.63.3.8', '66.91.9.70', '0.0.0.0',
+             '255.255.255.255', '01.2.3.0004']
+    chunks = protocol.ipv4_to_chunks(addrs)
+    self.assertEqual([protocol.ipv4_to_chunk(a) for a in addrs],
+                     chunks.to_chunks())
+    self.assertEqual([3, 2, 1, 0, 3, 0], chunks.lengths.tolist())
+    self.assertEqual([0, 3, 6, 0, 189, 3], chunks.offsets.tolist())
+    ints = [int.from_bytes(bytes(map(int, a.split('.'))), 'big')
+            for a in addrs]
+    self.assertEqual(chunks.to_chunks(),
+                     protocol.ipv4_to_chunks(ints).to_chunks())
+    self.assertEqual([], protocol.ipv4_to_chunks([]).to_chunks())
+    for invalid in ['', '1.2.3', '1.2.3.4.5', '127.256.0.1', '-1.128.0.1',
+                    '1.128.64.1999', '1..2.3', 'a.b.c.d', '1.2.3.4\n5']:
+      with self.assertRaises(ValueError):
+        protocol.ipv4_to_chunks(['1.2.3.4', invalid])
+    with self.assertRaises(ValueError):
+      protocol.ipv4_to_chunks([1, 2**32])
+
+  @unittest.skipIf(protocol.numpy is None, 'requires NumPy')
+  def test_ipv4_to_octet_array(self):
+    octets, valid = protocol.ipv4_to_octet_array(
+        ['1.2.3.4', 'ns1.example.com.', '+5.6.7.8', '1.2.3.256'])
+    self.assertEqual([True, False, True, False], valid.tolist())
+    self.assertEqual([[1, 2, 3, 4], [0, 0, 0, 0], [5, 6, 7, 8], [0, 0, 0, 0]],
+                     octets.tolist())
+
   def test_chunk_to_ipv4(self):
     self.assertEqual('192.168.0.0',
                      protocol.chunk_to_ipv4((b'\xa8\x00\x00', 0)))
@@ -115,6 +145,55 @@ class TestQueryParser(unittest.TestCase):
     self.assertEqual(self.VARIABLES, query.variables)
     self.assertEqual(self.DATA, query.payload)
 
+  def test_multiple_suffixes(self):
+    parser = protocol.QueryParser(
+        fqdn_suffix=['illinois.edu', 'vpnoverdns.com', 'tun.vpnoverdns.com.'])
+    query = parser.parse(self.DEFAULT_RECORD)
+    # The longest of overlapping suffixes is chosen.
+    self.assertEqual('tun.vpnoverdns.com.', query.fqdn_suffix)
+    self.assertEqual(protocol.QueryParser().parse(self.DEFAULT_RECORD),
+                     query._replace(fqdn_suffix=None))
+    query = parser.parse(self.CUSTOM_RECORD)
+    self.assertEqual('illinois.edu.', query.fqdn_suffix)
+    record = dnsrecord.DnsRecord('ac.id-00000001.v0.vpnoverdns.com.', 'IN',
+                                 'A', '64.69.255.255')
+    query = parser.parse(record)
+    self.assertEqual('vpnoverdns.com.', query.fqdn_suffix)
+    # Queries are encoded with the suffix they were sent to.
+    self.assertEqual(record, query.encode())
+    self.assertIsNone(parser.try_parse(dnsrecord.DnsRecord(
+        'id-00000001.v0.example.com.', 'IN', 'A', '1.2.3.4')))
+    self.assertEqual({'suffix': 1}, parser.rejections)
+    # Parsers of a single suffix do not tag queries.
+    self.assertIsNone(
+        protocol.QueryParser().parse(self.DEFAULT_RECORD).fqdn_suffix)
+    with self.assertRaises(ValueError):
+      protocol.QueryParser(fqdn_suffix=[])
+
+  def test_multiple_suffixes_fast_path_matches_regex(self):
+    parser = protocol.QueryParser(
+        fqdn_suffix=['vpnoverdns.com', 'tun.vpnoverdns.com'])
+    fqdns = [
+        'id-00000001.v0.tun.vpnoverdns.com.',
+        'id-00000001.v0.xtun.vpnoverdns.com.',
+        'id-00000001.v0.vpnoverdns.com.',
+        '  id-00000001.v0.tun.vpnoverdns.com.  ',
+        'id-00000001.tun.vpnoverdns.com.',
+        'v0.tun.vpnoverdns.com.',
+        'tun.vpnoverdns.com.',
+        '.vpnoverdns.com.',
+        'id-00000001.v0.example.com.',
+    ]
+    for fqdn in fqdns:
+      record = dnsrecord.DnsRecord(fqdn, 'IN', 'A', '192.178.115.214')
+      try:
+        expected = parser.parse_regex(record)
+      except Exception as e:
+        with self.assertRaises(type(e), msg=fqdn):
+          parser.parse(record)
+      else:
+        self.assertEqual(expected, parser.parse(record), msg=fqdn)
+
   def test_flags(self):
     parser = protocol.QueryParser()
     record = dnsrecord.DnsRecord('ac.' + self.DEFAULT_RECORD.fqdn,
@@ -126,6 +205,114 @@ class TestQueryParser(unittest.TestCase):
     self.assertEqual(expected_vars, query.variables)
     self.assertEqual(self.DATA, query.payload)
 
+  def test_fast_path_matches_regex(self):
+    parser = protocol.QueryParser()
+    fqdns = [
+        'sz-00000044.rn-12345678.id-00000001.v0.tun.vpnoverdns.com.',
+        'bf-abcdef.wr-00000030.id-00000001.v0.tun.vpnoverdns.com.',
+        'retry-1.ck-00000020.id-98765432.v0.tun.vpnoverdns.com.',
+        'ac.id-98765432.v0.tun.vpnoverdns.com.',
+        'ac.foo.x-1.y-2.v0.tun.vpnoverdns.com.',
+        'a-1.a-2.v0.tun.vpnoverdns.com.',
+        '  ac.id-98765432.v0.tun.vpnoverdns.com.  ',
+        'id.x-1.v0.tun.vpnoverdns.com.',
+        'x-1.ac.v0.tun.vpnoverdns.com.',
+        'x-1-2.v0.tun.vpnoverdns.com.',
+        'x-.v0.tun.vpnoverdns.com.',
+        'x-1..v0.tun.vpnoverdns.com.',
+        'x-1.v.tun.vpnoverdns.com.',
+        'x-1.0.tun.vpnoverdns.com.',
+        'v0.tun.vpnoverdns.com.',
+        'x-1.v0.tun.vpnoverdns.com',
+        'x-1.v0.TUN.vpnoverdns.com.',
+        'x-1.v0.xtun.vpnoverdns.com.',
+        'id-abc.v0.tun.vpnoverdns.com.',
+        'bf-abc.wr-0.id-1.v0.tun.vpnoverdns.com.',
+        '\u00e9t\u00e9-1.v0.tun.vpnoverdns.com.',
+        'www.example.com.',
+    ]
+    for fqdn in fqdns:
+      record = dnsrecord.DnsRecord(fqdn, 'IN', 'A', '192.178.115.214')
+      try:
+        expected = parser.parse_regex(record)
+      except Exception as e:
+        with self.assertRaises(type(e), msg=fqdn):
+          parser.parse(record)
+      else:
+        self.assertEqual(expected, parser.parse(record), msg=fqdn)
+
+  def test_fast_path_rejects_other_names(self):
+    parser = protocol.QueryParser()
+    regex_fqdns = []
+    parse_regex = parser.parse_regex
+    def counting_parse_regex(record, payload=None):
+      regex_fqdns.append(record.fqdn)
+      return parse_regex(record, payload)
+    parser.parse_regex = counting_parse_regex
+    for fqdn in ['www.example.com.', 'x-1.v0.tun.vpnoverdns.com',
+                 'tun.vpnoverdns.com.']:
+      with self.assertRaises(ValueError, msg=fqdn):
+        parser.parse(dnsrecord.DnsRecord(fqdn, 'IN', 'A', '1.2.3.4'))
+    # Trailing whitespace is left to the regular expression.
+    parser.parse(dnsrecord.DnsRecord(self.DEFAULT_RECORD.fqdn + ' ',
+                                     *self.DEFAULT_RECORD[1:]))
+    self.assertEqual([self.DEFAULT_RECORD.fqdn + ' '], regex_fqdns)
+
+  def test_parse_batch(self):
+    parser = protocol.QueryParser()
+    records = [
+        self.DEFAULT_RECORD,
+        dnsrecord.DnsRecord('www.example.com.', 'IN', 'A', '1.2.3.4'),
+        dnsrecord.DnsRecord(self.DEFAULT_RECORD.fqdn, 'IN', 'CNAME',
+                            'example.com.'),
+        dnsrecord.DnsRecord(' ' + self.DEFAULT_RECORD.fqdn, 'IN', 'A',
+                            '192.178.115.214'),
+    ]
+    expected = parser.parse(self.DEFAULT_RECORD)
+    self.assertEqual([expected, None, None, expected],
+                     parser.parse_batch(records))
+
+  def test_try_parse(self):
+    parser = protocol.QueryParser()
+    self.assertEqual(parser.parse(self.DEFAULT_RECORD),
+                     parser.try_parse(self.DEFAULT_RECORD))
+    fqdn = self.DEFAULT_RECORD.fqdn
+    records = [
+        dnsrecord.DnsRecord(fqdn, 'IN', 'CNAME', 'example.com.'),
+        dnsrecord.DnsRecord(fqdn, 'IN', 'AAAA', '::1'),
+        dnsrecord.DnsRecord('www.example.com.', 'IN', 'A', '1.2.3.4'),
+        dnsrecord.DnsRecord('id-1.v0.xtun.vpnoverdns.com.', 'IN', 'A',
+                            '1.2.3.4'),
+        dnsrecord.DnsRecord(fqdn, 'IN', 'A', '1.2.3'),
+        dnsrecord.DnsRecord('id-00000001.v1.tun.vpnoverdns.com.', 'IN', 'A',
+                            '1.2.3.4'),
+    ]
+    self.assertEqual([None] * len(records),
+                     [parser.try_parse(r) for r in records])
+    self.assertEqual({'type': 2, 'suffix': 2, 'format': 1, 'version': 1},
+                     parser.rejections)
+    parser = protocol.QueryParser()
+    self.assertEqual([None] * len(records), parser.parse_batch(records))
+    self.assertEqual({'type': 2, 'suffix': 2, 'format': 1, 'version': 1},
+                     parser.rejections)
+
+  def test_accepts(self):
+    parser = protocol.QueryParser()
+    self.assertTrue(parser.accepts(self.DEFAULT_RECORD))
+    self.assertTrue(parser.accepts(dnsrecord.DnsRecord(
+        self.DEFAULT_RECORD.fqdn + ' ', 'IN', 'A', '1.2.3.4')))
+    self.assertFalse(parser.accepts(self.CUSTOM_RECORD))
+    self.assertFalse(parser.accepts(dnsrecord.DnsRecord(
+        'tun.vpnoverdns.com.', 'IN', 'A', '1.2.3.4')))
+    self.assertEqual({'suffix': 2}, parser.rejections)
+
+  def test_unknown_version(self):
+    parser = protocol.QueryParser()
+    record = dnsrecord.DnsRecord('id-00000001.v1.tun.vpnoverdns.com.',
+                                 'IN', 'A', '192.178.115.214')
+    with self.assertRaises(protocol.UnknownVersionError):
+      parser.parse(record)
+
 
 class TestQuery(unittest.TestCase):
   OPEN_TICKET_VARS = {'sz': '44', 'rn': '12345678', 'id': '00000001'}
@@ -266,5 +453,120 @@ class TestQuery(unittest.TestCase):
     self.assertEqual(protocol.chunk_to_ipv4(payload), record.value)
 
 
+
+class TestCompactQuery(unittest.TestCase):
+  PAYLOAD = util.DataChunk(b'\x01\x02\x03', 3)
+
+  def _queries(self):
+    return [protocol.Query.create('0', variables, self.PAYLOAD)
+            for variables in (TestQuery.OPEN_TICKET_VARS,
+                              TestQuery.REQUEST_DATA_VARS,
+                              TestQuery.CHECK_REQUEST_VARS,
+                              TestQuery.FETCH_RESPONSE_VARS,
+                              TestQuery.CLOSE_TICKET_VARS)]
+
+  def test_from_query(self):
+    for query in self._queries():
+      compact = protocol.CompactQuery.from_query(query)
+      self.assertIs(query.type, compact.type)
+      self.assertEqual(query.type.value, compact.type_code)
+      self.assertEqual(query.variables['id'], compact.id)
+      self.assertEqual(self.PAYLOAD, compact.payload)
+      self.assertIsNone(compact.error)
+      self.assertEqual(query, compact.to_query())
+
+  def test_from_query_drops_retry(self):
+    query = protocol.Query.create('0', TestQuery.OPEN_TICKET_VARS_RETRY,
+                                  self.PAYLOAD)
+    compact = protocol.CompactQuery.from_query(query)
+    self.assertNotIn('retry', compact.to_query().variables)
+    self.assertEqual(query.encode().value, compact.to_query().encode().value)
+
+  def test_error(self):
+    query = protocol.Query.create('0', TestQuery.OPEN_TICKET_VARS,
+                                  util.DataChunk(b'E\x0a', 0))
+    self.assertEqual(10, protocol.CompactQuery.from_query(query).error)
+
+  def test_pickle(self):
+    for query in self._queries():
+      compact = protocol.CompactQuery.from_query(query)
+      self.assertEqual(compact, pickle.loads(pickle.dumps(compact)))
+
+  def test_slots(self):
+    compact = protocol.CompactQuery.from_query(self._queries()[0])
+    with self.assertRaises(AttributeError):
+      compact.retry = 1
+
+  def test_parser(self):
+    records = [query.encode() for query in self._queries()]
+    # Trailing whitespace defers the record to the regular expression.
+    records.append(records[0]._replace(fqdn=records[0].fqdn + ' '))
+    for suffix in (None, [protocol.DEFAULT_FQDN_SUFFIX, 'example.com.']):
+      parser = protocol.QueryParser(suffix)
+      compact_parser = protocol.QueryParser(suffix, compact=True)
+      for record in records:
+        compact = compact_parser.parse(record)
+        self.assertIsInstance(compact, protocol.CompactQuery)
+        self.assertEqual(protocol.CompactQuery.from_query(
+            parser.parse(record)), compact)
+      self.assertEqual(
+          [protocol.CompactQuery.from_query(q)
+           for q in parser.parse_batch(records)],
+          compact_parser.parse_batch(records))
+
+
+
+class TestDuplicateFilter(unittest.TestCase):
+  def _record(self, fqdn, value='192.178.115.214'):
+    return dnsrecord.DnsRecord(fqdn, 'IN', 'A', value)
+
+  def test_filter(self):
+    records = [
+        self._record('ln-00000048.rd-00000000.id-00000001.v0.a.com.'),
+        self._record('ln-00000048.rd-00000000.id-00000001.v0.a.com.'),
+        self._record('retry-1.ln-00000048.rd-00000000.id-00000001.v0.a.com.'),
+        self._record('ln-00000048.rd-00000000.id-00000001.v0.a.com.',
+                     '192.178.115.215'),
+        self._record('ln-00000048.rd-00000000.id-00000002.v0.a.com.'),
+    ]
+    dedup = protocol.DuplicateFilter(10)
+    self.assertIsNone(dedup.hit_rate)
+    self.assertEqual([records[0], records[3], records[4]],
+                     list(dedup.filter(records)))
+    self.assertEqual(2, dedup.hits)
+    self.assertEqual(3, dedup.misses)
+    self.assertEqual(0.4, dedup.hit_rate)
+    self.assertEqual(3, len(dedup))
+
+  def test_filter_heartbeats(self):
+    a = self._record('a.com.')
+    dedup = protocol.DuplicateFilter(2)
+    self.assertEqual([a, None, None], list(dedup.filter([a, None, a, None])))
+    self.assertEqual(1, dedup.hits)
+
+  def test_filter_evicts_least_recently_seen(self):
+    a, b, c = (self._record(name + '.com.') for name in 'abc')
+    dedup = protocol.DuplicateFilter(2)
+    self.assertEqual([a, b, c, b, a], list(dedup.filter([a, b, a, c, b, a])))
+    self.assertEqual(2, len(dedup))
+
+  def test_filter_accepts(self):
+    query = self._record('ln-00000048.rd-00000000.id-00000001.v0.a.com.')
+    # Nine records of noise for every query.
+    noise = [self._record('www{}.example.com.'.format(i)) for i in range(9)]
+    records = [query] + noise + [query] + noise
+    parser = protocol.QueryParser('a.com')
+    dedup = protocol.DuplicateFilter(2)
+    self.assertEqual([query] + noise * 2,
+                     list(dedup.filter(records, parser.may_be_query)))
+    self.assertEqual(1, dedup.hits)
+    self.assertEqual(1, dedup.misses)
+    self.assertEqual(1, len(dedup))
+    self.assertEqual({}, parser.rejections)
+
+  def test_invalid_size(self):
+    with self.assertRaises(ValueError):
+      protocol.DuplicateFilter(0)
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,146 @@
+import binascii
+import os
+import pickle
+import struct
+import tempfile
+import unittest
+from vodreassembler import protocol
+from vodreassembler import socket
+from vodreassembler import ticket
+from vodreassembler import ticketfile
+from vodreassembler import util
+import zlib
+
+
+def length_prefixed(message, payload):
+  message = message.encode('utf-8')
+  return struct.pack('B', len(message)) + message + payload
+
+
+class TestReconstructSessions(unittest.TestCase):
+  def _request_records(self, ticket_id, data):
+    payload = util.DataChunk(b'E\x00', 0)
+    return [protocol.Query.create(
+                '0', {'bf': binascii.hexlify(data[i:i+30]).decode('ascii'),
+                      'wr': i, 'id': ticket_id}, payload).encode()
+            for i in range(0, len(data), 30)]
+
+  def _response_records(self, ticket_id, data):
+    records = []
+    for i in range(0, len(data), 48):
+      segment = data[i:i+48]
+      query_vars = {'ln': len(segment), 'rd': i, 'id': ticket_id}
+      for off in range(0, len(segment), 3):
+        records.append(protocol.Query.create(
+            '0', query_vars, util.DataChunk(segment[off:off+3], off)).encode())
+    return records
+
+  def _ticket_records(self, ticket_id, uuid, socket_id, request, response):
+    message = '{}\xa7SocketData\xa7{}'.format(uuid, socket_id)
+    records = self._request_records(ticket_id,
+                                    length_prefixed(message, request))
+    if response is not None:
+      records += self._response_records(
+          ticket_id, zlib.compress(length_prefixed('OK', response)))
+    return records
+
+  def setUp(self):
+    self._requests = [os.urandom(40) for _ in range(3)]
+    self._responses = [os.urandom(100) for _ in range(3)]
+    records = []
+    # Ids of the tickets of session (7, 1) are random, unlike the order of
+    # their records.
+    for ticket_id, i in [(30, 0), (10, 1), (20, 2)]:
+      records += self._ticket_records(ticket_id, 7, 1, self._requests[i],
+                                      self._responses[i])
+    records += self._ticket_records(40, 7, 2, b'other', b'session')
+    # Response is missing.
+    records += self._ticket_records(50, 8, 1, b'no response', None)
+    self._records = records
+    self._db = ticket.TicketDatabase()
+    self._db.build_from_records(records)
+
+  def _reconstruct(self, processes, ticket_db=None):
+    with tempfile.TemporaryDirectory() as output_dir:
+      results = socket.reconstruct_sessions(
+          self._db if ticket_db is None else ticket_db, output_dir,
+          processes=processes)
+      contents = {}
+      for result in results:
+        with open(result.request_path, 'rb') as f:
+          request = f.read()
+        with open(result.response_path, 'rb') as f:
+          response = f.read()
+        contents[result.uuid, result.session_id] = (request, response)
+      return results, contents
+
+  def test_reconstruct_sessions(self):
+    for processes in (None, 2):
+      results, contents = self._reconstruct(processes)
+      self.assertEqual([(7, 1), (7, 2), (8, 1)],
+                       [(r.uuid, r.session_id) for r in results])
+      self.assertEqual([3, 1, 1], [r.num_tickets for r in results])
+      self.assertEqual([0, 0, 1], [r.incomplete_tickets for r in results])
+      self.assertEqual((b''.join(self._requests), b''.join(self._responses)),
+                       contents[7, 1])
+      self.assertEqual(120, results[0].request_length)
+      self.assertEqual(300, results[0].response_length)
+      self.assertEqual((b'other', b'session'), contents[7, 2])
+      self.assertEqual((b'no response', b''), contents[8, 1])
+
+  def test_other_ticket_sources(self):
+    _, expected = self._reconstruct(None)
+    self.assertEqual(expected, self._reconstruct(2, list(self._db))[1])
+    with tempfile.TemporaryDirectory() as tmpdir:
+      path = os.path.join(tmpdir, 'tickets.db')
+      with open(path, 'wb') as f:
+        ticketfile.save(self._db, f)
+      # Workers map the file again instead of receiving the tickets.
+      with ticketfile.MappedTicketDatabase(path) as mapped_db:
+        for processes in (None, 2):
+          self.assertEqual(expected,
+                           self._reconstruct(processes, mapped_db)[1])
+
+  def test_ordered_tickets(self):
+    self.assertEqual([30, 10, 20], self._ordered_ticket_ids(self._db))
+
+  def test_ordered_tickets_other_sources(self):
+    records = self._records
+    parallel_db = ticket.TicketDatabase()
+    parallel_db.build_from_records(records, processes=2, batch_size=7)
+    with tempfile.TemporaryDirectory() as tmpdir:
+      path = os.path.join(tmpdir, 'tickets.db')
+      with open(path, 'wb') as f:
+        ticketfile.save(self._db, f)
+      with open(path, 'rb') as f:
+        loaded_db = ticketfile.load(f)
+      with ticketfile.MappedTicketDatabase(path) as mapped_db:
+        for ticket_db in (parallel_db, pickle.loads(pickle.dumps(self._db)),
+                          loaded_db, mapped_db):
+          self.assertEqual([30, 10, 20], self._ordered_ticket_ids(ticket_db))
+
+  def _ordered_ticket_ids(self, ticket_db):
+    # Tickets are not kept, so that a mapped ticket_db can be closed.
+    session, = [s for s in socket.SocketSession.find_all(ticket_db)
+                if s.session_id == 1 and s.uuid == 7]
+    return [t.ticket_id for t in session.ordered_tickets]
+
+  def test_multiple_suffixes(self):
+    records = []
+    for fqdn_suffix, response in [('b.example.com', b'b'),
+                                  ('a.example.com', b'a')]:
+      records += [
+          r._replace(fqdn=r.fqdn.replace('tun.vpnoverdns.com', fqdn_suffix))
+          for r in self._ticket_records(10, 7, 1, b'request', response)]
+    self._db = ticket.TicketDatabase(['a.example.com', 'b.example.com'])
+    self._db.build_from_records(records)
+    results, _ = self._reconstruct(None)
+    self.assertEqual(['a.example.com.', 'b.example.com.'],
+                     [r.fqdn_suffix for r in results])
+    self.assertEqual('a.example.com-7-1.request',
+                     os.path.basename(results[0].request_path))
+    self.assertEqual([1, 1], [r.response_length for r in results])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,8 +1,11 @@
 import binascii
+import itertools
 import os
+import pickle
 import random
 import struct
 import unittest
+from unittest import mock
 from vodreassembler import dnsrecord
 from vodreassembler import protocol
 from vodreassembler import ticket
@@ -17,6 +20,10 @@ def length_prefixed_utf8(text):
   result = text.encode('utf-8')
   return struct.pack('B', len(result)) + result
 
+def _exit_shard(queue, results):
+  # Stands in for a shard process killed before sending its results.
+  os._exit(1)
+
 
 class TestTicketDatabase(unittest.TestCase):
   OPEN_TICKET_RECORD = dnsrecord.DnsRecord(
@@ -121,6 +128,39 @@ class TestTicketDatabase(unittest.TestCase):
     self.assertEqual(self.BINARY_REQUEST_DATA,
                      self._db[12345678].request_data)
 
+  def test_ticket_cache(self):
+    payload = util.DataChunk(b'E\x00', 0)  # E0 means no error (success)
+    records = [
+        protocol.Query.create(
+            '0',
+            {'bf': binascii.hexlify(
+                self.BINARY_REQUEST[i:i+30]).decode('ascii'),
+             'wr': i,'id': 12345678},
+            payload).encode()
+        for i in range(0, len(self.BINARY_REQUEST), 30)]
+    self._db.build_from_records(records[1:])
+    t = self._db[12345678]
+    self.assertIsNone(t.is_binary)
+    with self.assertRaises(util.IncompleteDataError):
+      t.raw_request_data
+    # Updating the ticket data invalidates cached values.
+    self._db.build_from_records(records[:1])
+    self.assertTrue(t.is_binary)
+    self.assertEqual(self.BINARY_REQUEST, t.raw_request_data)
+    self.assertIs(t.raw_request_data, t.raw_request_data)
+    self.assertIs(t.request_data, t.request_data)
+    self.assertEqual(self.BINARY_REQUEST_DATA, t.request_data)
+
+  def test_ticket_cache_not_pickled(self):
+    self._db.build_from_records(self._generate_records(1))
+    size = len(pickle.dumps(self._db))
+    t = self._db[1]
+    self.assertEqual(self.BINARY_REQUEST, t.raw_request_data)
+    self.assertEqual(self.BINARY_RESPONSE_MESSAGE, t.response_message)
+    self.assertEqual(size, len(pickle.dumps(self._db)))
+    restored = pickle.loads(pickle.dumps(t))
+    self.assertEqual(self.BINARY_RESPONSE_MESSAGE, restored.response_message)
+
   def test_build_from_records_text_response_data(self):
     compressed_length = len(self.COMPRESSED_TEXT_RESPONSE)
     response_segments = [self.COMPRESSED_TEXT_RESPONSE[i:i+48]
@@ -149,6 +189,55 @@ class TestTicketDatabase(unittest.TestCase):
     self.assertEqual(self.TEXT_RESPONSE_MESSAGE,
                      self._db[12345678].response_message)
 
+  def test_partial_response(self):
+    response = random_string(3000).encode('utf-8')
+    compressed = zlib.compress(response)
+    records = []
+    for i in range(0, len(compressed), 48):
+      segment = compressed[i:i+48]
+      query_vars = {'ln': len(segment), 'rd': i, 'id': 12345678}
+      for off in range(0, len(segment), 3):
+        query = protocol.Query.create('0', query_vars,
+                                      util.DataChunk(segment[off:off+3], off))
+        records.append(query.encode())
+    middle = len(records) // 2
+    # The last record makes the length known.
+    self._db.build_from_records(records[:middle] + records[-1:])
+    t = self._db[12345678]
+    partial = t.partial_response
+    self.assertTrue(partial)
+    self.assertTrue(response.startswith(partial))
+    with self.assertRaises(util.IncompleteDataError):
+      t.response_message
+    self._db.build_from_records(records[middle:])
+    self.assertEqual(response, t.partial_response)
+    self.assertEqual(response.decode('utf-8'), t.response_message)
+
+  def test_stream_response(self):
+    response = random_string(3000).encode('utf-8')
+    compressed = zlib.compress(response)
+    records = []
+    for i in range(0, len(compressed), 48):
+      segment = compressed[i:i+48]
+      query_vars = {'ln': len(segment), 'rd': i, 'id': 12345678}
+      for off in range(0, len(segment), 3):
+        query = protocol.Query.create('0', query_vars,
+                                      util.DataChunk(segment[off:off+3], off))
+        records.append(query.encode())
+    middle = len(records) // 2
+    self._db.build_from_records(records[:middle])
+    output = []
+    stream = self._db[12345678].stream_response(output.append)
+    self.assertTrue(response.startswith(b''.join(output)))
+    # Streams are not pickled.
+    restored = pickle.loads(pickle.dumps(self._db))
+    self.assertIsNone(restored._ticket_data[12345678].response_stream)
+    for record in records[middle:]:
+      self._db.build_from_records([record])
+      self.assertTrue(response.startswith(b''.join(output)))
+    self.assertTrue(stream.eof)
+    self.assertEqual(response, b''.join(output))
+
   def test_build_from_records_binary_response_data(self):
     compressed_length = len(self.COMPRESSED_BINARY_RESPONSE)
     response_segments = [self.COMPRESSED_BINARY_RESPONSE[i:i+48]
@@ -178,6 +267,397 @@ class TestTicketDatabase(unittest.TestCase):
     self.assertEqual(self.BINARY_RESPONSE_MESSAGE,
                      self._db[12345678].response_message)
 
+  def _generate_records(self, num_tickets):
+    records = []
+    for ticket_id in range(1, num_tickets + 1):
+      request = self.BINARY_REQUEST if ticket_id % 2 else self.TEXT_REQUEST
+      response = (self.COMPRESSED_BINARY_RESPONSE if ticket_id % 2
+                  else self.COMPRESSED_TEXT_RESPONSE)
+      payload = util.DataChunk(b'E\x00', 0)
+      for i in range(0, len(request), 30):
+        query = protocol.Query.create(
+            '0', {'bf': binascii.hexlify(request[i:i+30]).decode('ascii'),
+                  'wr': i, 'id': ticket_id}, payload)
+        records.append(query.encode())
+      for i in range(0, len(response), 48):
+        segment = response[i:i+48]
+        query_vars = {'ln': len(segment), 'rd': i, 'id': ticket_id}
+        for off in range(0, len(segment), 3):
+          query = protocol.Query.create(
+              '0', query_vars, util.DataChunk(segment[off:off+3], off))
+          records.append(query.encode())
+    self._random.shuffle(records)
+    return records
+
+  def _assert_same_tickets(self, expected_db, actual_db):
+    self.assertEqual([t.ticket_id for t in expected_db],
+                     [t.ticket_id for t in actual_db])
+    for expected in expected_db:
+      actual = actual_db[expected.ticket_id]
+      self.assertEqual(expected.collision, actual.collision)
+      self.assertEqual(expected.raw_request_data, actual.raw_request_data)
+      self.assertEqual(expected.raw_response_data, actual.raw_response_data)
+      self.assertEqual(expected.request_message, actual.request_message)
+      self.assertEqual(expected.response_message, actual.response_message)
+
+  def test_build_from_records_parallel(self):
+    records = self._generate_records(20)
+    self._db.build_from_records(records)
+    parallel_db = ticket.TicketDatabase()
+    parallel_db.build_from_records(records, processes=3, batch_size=50)
+    self._assert_same_tickets(self._db, parallel_db)
+
+  def test_check_request_response_length(self):
+    records = [protocol.Query.create('0', {'ck': 0, 'id': 3},
+                                     util.DataChunk(b'L\x01\x2c', 0)).encode()]
+    self._db.build_from_records(records)
+    self.assertEqual(300, self._db[3].raw_response_length)
+    parallel_db = ticket.TicketDatabase()
+    parallel_db.build_from_records(records, processes=2, batch_size=1)
+    self.assertEqual(300, parallel_db[3].raw_response_length)
+
+  def test_checked_response_length(self):
+    # Replies of 3 bytes used to be ignored, and those of 4 bytes raised
+    # TypeError.
+    self.assertEqual(300, ticket._checked_response_length(b'L\x01\x2c'))
+    self.assertEqual(0, ticket._checked_response_length(b'L\x00\x00'))
+    self.assertIsNone(ticket._checked_response_length(b'L\x00\x01\x2c'))
+    self.assertIsNone(ticket._checked_response_length(b'E\x01\x2c'))
+    self.assertIsNone(ticket._checked_response_length(b''))
+
+  def test_build_from_records_parallel_shard_dies(self):
+    records = self._generate_records(4)
+    with mock.patch.object(ticket, '_assemble_shard', _exit_shard):
+      with self.assertRaises(ticket.ShardError):
+        ticket.TicketDatabase().build_from_records(records, processes=2,
+                                                   batch_size=1)
+
+  def test_build_from_records_rejections(self):
+    records = [self.OPEN_TICKET_RECORD,
+               dnsrecord.DnsRecord('www.example.com.', 'IN', 'A', '1.2.3.4'),
+               dnsrecord.DnsRecord('www.example.com.', 'IN', 'CNAME', 'a.')]
+    self._db.build_from_records(records)
+    self.assertEqual({'type': 1, 'suffix': 1}, self._db.rejections)
+    self._db.build_from_records(records, processes=2, batch_size=1)
+    self.assertEqual({'type': 2, 'suffix': 2}, self._db.rejections)
+    list(self._db.stream_from_records(records))
+    self.assertEqual({'type': 3, 'suffix': 3}, self._db.rejections)
+
+  def test_build_from_records_stats(self):
+    records = self._generate_records(4)
+    records += [
+        dnsrecord.DnsRecord('www.example.com.', 'IN', 'A', '1.2.3.4'),
+        # Error reply
+        protocol.Query.create('0', {'ck': 0, 'id': 3},
+                              util.DataChunk(b'E\x01', 0)).encode(),
+        # Retransmitted chunk with different data
+        protocol.Query.create(
+            '0', {'bf': '00' * 30, 'wr': 0, 'id': 1},
+            util.DataChunk(b'E\x00', 0)).encode(),
+    ]
+    stats = ticket.BuildStats()
+    self._db.build_from_records(records, stats=stats)
+    expected_db = ticket.TicketDatabase()
+    expected_db.build_from_records(records)
+    self._assert_same_tickets(expected_db, self._db)
+    self.assertEqual(expected_db.rejections, self._db.rejections)
+
+    self.assertEqual(len(records), stats.records)
+    # The retransmitted chunk is dropped, and only counted in drops.
+    num_request_queries = sum(
+        (len(request) + 29) // 30 for request in
+        [self.BINARY_REQUEST, self.TEXT_REQUEST] * 2)
+    self.assertEqual({'request_data': num_request_queries,
+                      'fetch_response': len(records) - 3
+                                        - num_request_queries},
+                     stats.queries)
+    self.assertEqual({'suffix': 1, 'error': 1, 'unexpected_chunk': 1},
+                     stats.drops)
+    self.assertEqual(1, stats.collisions)
+    self.assertEqual(2 * len(self.BINARY_REQUEST) + 2 * len(self.TEXT_REQUEST),
+                     stats.request_bytes)
+    self.assertEqual(2 * len(self.COMPRESSED_BINARY_RESPONSE)
+                     + 2 * len(self.COMPRESSED_TEXT_RESPONSE),
+                     stats.response_bytes)
+    self.assertEqual(set(ticket.BuildStats.STAGES), set(stats.timers))
+    self.assertTrue(all(t > 0 for t in stats.timers.values()))
+    self.assertEqual(stats.records, stats.as_dict()['records'])
+    with self.assertRaises(ValueError):
+      self._db.build_from_records(records, processes=2, stats=stats)
+
+  def test_build_from_records_dedup(self):
+    records = self._generate_records(4)
+    retried = [r._replace(fqdn='retry-1.' + r.fqdn) for r in records[::3]]
+    repeated = records[::2]
+    records = records + repeated + retried
+    self._random.shuffle(records)
+    expected_db = ticket.TicketDatabase()
+    expected_db.build_from_records(records)
+    dedup = protocol.DuplicateFilter(len(records))
+    stats = ticket.BuildStats()
+    self._db.build_from_records(records, dedup=dedup, stats=stats)
+    self._assert_same_tickets(expected_db, self._db)
+    duplicates = len(repeated) + len(retried)
+    self.assertEqual(duplicates, dedup.hits)
+    self.assertEqual(duplicates, stats.drops['duplicate'])
+    self.assertEqual(len(records), stats.records)
+
+    parallel_db = ticket.TicketDatabase()
+    parallel_db.build_from_records(records, processes=2, batch_size=50,
+                                   dedup=protocol.DuplicateFilter(16))
+    self._assert_same_tickets(expected_db, parallel_db)
+
+  def test_build_from_records_dedup_noise(self):
+    records = self._generate_records(2)
+    noise = [dnsrecord.DnsRecord('www{}.example.com.'.format(i), 'IN', 'A',
+                                 '1.2.3.4') for i in range(len(records) * 20)]
+    # Every query is repeated after many more records of noise than the
+    # filter remembers.
+    noisy = records + noise + records
+    dedup = protocol.DuplicateFilter(len(records))
+    stats = ticket.BuildStats()
+    self._db.build_from_records(noisy, dedup=dedup, stats=stats)
+    self.assertEqual(len(records), dedup.hits)
+    self.assertEqual(len(records), stats.drops['duplicate'])
+    self.assertEqual(len(noise), self._db.rejections['suffix'])
+
+  def test_build_from_records_parallel_existing(self):
+    records = self._generate_records(10)
+    half = len(records) // 2
+    self._db.build_from_records(records)
+    parallel_db = ticket.TicketDatabase()
+    parallel_db.build_from_records(records[:half])
+    existing = parallel_db[1]
+    parallel_db.build_from_records(records[half:], processes=2, batch_size=50)
+    self._assert_same_tickets(self._db, parallel_db)
+    self.assertIs(existing, parallel_db[1])
+
+  def test_build_from_records_multiple_suffixes(self):
+    records = []
+    for fqdn_suffix in ('a.example.com', 'b.example.com'):
+      records += [r._replace(fqdn=r.fqdn.replace('tun.vpnoverdns.com',
+                                                 fqdn_suffix))
+                  for r in self._generate_records(4)]
+    records.append(self.OPEN_TICKET_RECORD)
+    ticket_db = ticket.TicketDatabase(['b.example.com', 'a.example.com.'])
+    self.assertEqual(('a.example.com.', 'b.example.com.'),
+                     ticket_db.fqdn_suffix)
+    ticket_db.build_from_records(records)
+    # Tickets of both suffixes are kept apart, despite sharing ids.
+    self.assertEqual(8, len(ticket_db))
+    self.assertEqual({'suffix': 1}, ticket_db.rejections)
+    single_db = ticket.TicketDatabase('a.example.com')
+    single_db.build_from_records(records)
+    self.assertEqual(4, len(single_db))
+    for expected in single_db:
+      actual = ticket_db[('a.example.com.', expected.ticket_id)]
+      self.assertEqual('a.example.com.', actual.fqdn_suffix)
+      self.assertEqual(expected.ticket_id, actual.ticket_id)
+      self.assertEqual(expected.raw_request_data, actual.raw_request_data)
+      self.assertEqual(expected.raw_response_data, actual.raw_response_data)
+    self.assertEqual(4, len(ticket_db.find(fqdn_suffix='b.example.com.')))
+    self.assertIsNone(single_db[1].fqdn_suffix)
+
+    parallel_db = ticket.TicketDatabase(['a.example.com', 'b.example.com'])
+    parallel_db.build_from_records(records, processes=2, batch_size=50)
+    self.assertEqual(list(ticket_db._tickets), list(parallel_db._tickets))
+    for expected in ticket_db:
+      actual = parallel_db[(expected.fqdn_suffix, expected.ticket_id)]
+      self.assertEqual(expected.raw_request_data, actual.raw_request_data)
+      self.assertEqual(expected.raw_response_data, actual.raw_response_data)
+
+  def _request_records(self, ticket_id, data):
+    payload = util.DataChunk(b'E\x00', 0)
+    return [protocol.Query.create(
+                '0', {'bf': binascii.hexlify(data[i:i+30]).decode('ascii'),
+                      'wr': i, 'id': ticket_id}, payload).encode()
+            for i in range(0, len(data), 30)]
+
+  def test_find(self):
+    records = []
+    for ticket_id, message in [(1, '7\xa7SocketData\xa71'),
+                               (2, '7\xa7SocketData\xa72'),
+                               (3, '8\xa7SocketData\xa71'),
+                               (4, '8\xa7Connect'),
+                               (5, 'no separators')]:
+      records += self._request_records(
+          ticket_id, length_prefixed_utf8(message) + b'payload')
+    # Incomplete request
+    records += self._request_records(6, length_prefixed_utf8(
+        '9\xa7SocketData\xa71' + 'x' * 40))[1:]
+    self._db.build_from_records(records)
+
+    def find(**kwargs):
+      return sorted(t.ticket_id for t in self._db.find(**kwargs))
+    self.assertEqual([1, 2, 3], find(message_type='SocketData'))
+    self.assertEqual([4], find(message_type='Connect'))
+    self.assertEqual([1, 2], find(uuid=7))
+    self.assertEqual([1, 3], find(socket_id=1))
+    self.assertEqual([3], find(uuid=8, socket_id=1))
+    self.assertEqual([], find(uuid=9))
+    self.assertEqual([1, 2, 3, 4, 5, 6], find(complete=False))
+    self.assertEqual([], find(collision=True))
+    self.assertEqual([1, 2, 3, 4, 5, 6], find())
+    self.assertEqual([7, 8], sorted(self._db.index_values('uuid')))
+
+    # Indexes follow updates of the tickets.
+    self._db.build_from_records(self._request_records(6, length_prefixed_utf8(
+        '9\xa7SocketData\xa71' + 'x' * 40))[:1])
+    self.assertEqual([6], find(uuid=9))
+
+    # Indexes are not pickled, but rebuilt.
+    restored = pickle.loads(pickle.dumps(self._db))
+    self.assertNotIn('_index', restored.__getstate__())
+    self.assertEqual([1, 2], sorted(t.ticket_id
+                                    for t in restored.find(uuid=7)))
+
+  def test_find_stream_evicts(self):
+    records = self._request_records(
+        1, length_prefixed_utf8('7\xa7SocketData\xa71') + b'payload')
+    records.append(self._close_ticket_record(1))
+    self.assertEqual(1, len(list(self._db.stream_from_records(records))))
+    self.assertEqual([], self._db.find(uuid=7))
+    self.assertEqual([], self._db.find(complete=False))
+
+  def _close_ticket_record(self, ticket_id):
+    return protocol.Query.create('0', {'ac': True, 'id': ticket_id},
+                                 util.DataChunk(b'E\x00', 0)).encode()
+
+  def test_stream_from_records_closed(self):
+    records = [r for r in self._generate_records(2)
+               if protocol.QueryParser().parse(r).variables['id'] == 1]
+    records.insert(0, self._close_ticket_record(2))
+    stream = self._db.stream_from_records(records)
+    closed = next(stream)
+    self.assertEqual(2, closed.ticket_id)
+    self.assertTrue(closed.closed)
+    self.assertNotIn(2, self._db)
+    tickets = list(stream)
+    self.assertEqual([1], [t.ticket_id for t in tickets])
+    self.assertFalse(tickets[0].closed)
+    self.assertEqual(self.BINARY_REQUEST, tickets[0].raw_request_data)
+    self.assertEqual(self.BINARY_REQUEST_MESSAGE, tickets[0].request_message)
+    self.assertEqual(0, len(self._db))
+
+  def test_stream_from_records_idle_records(self):
+    records = [self.OPEN_TICKET_RECORD, self._close_ticket_record(1),
+               self._close_ticket_record(2)]
+    stream = self._db.stream_from_records(records, max_idle_records=2)
+    self.assertEqual([1, 2, 0xb273d6], [t.ticket_id for t in stream])
+    self.assertEqual(0, len(self._db))
+
+  def _exchange_records(self, ticket_id, request, response):
+    # Queries of a whole ticket, in the order clients send them.
+    records = [protocol.Query.create(
+        '0', {'sz': len(request), 'rn': 12345678, 'id': ticket_id},
+        util.DataChunk(ticket_id.to_bytes(3, 'big'), 0)).encode()]
+    records += self._request_records(ticket_id, request)
+    records.append(protocol.Query.create(
+        '0', {'ck': len(request), 'id': ticket_id},
+        util.DataChunk(b'L' + len(response).to_bytes(2, 'big'), 0)).encode())
+    for i in range(0, len(response), 48):
+      segment = response[i:i+48]
+      query_vars = {'ln': len(segment), 'rd': i, 'id': ticket_id}
+      for off in range(0, len(segment), 3):
+        records.append(protocol.Query.create(
+            '0', query_vars, util.DataChunk(segment[off:off+3], off)).encode())
+    records.append(self._close_ticket_record(ticket_id))
+    return records
+
+  def test_stream_from_records_late_records(self):
+    exchanges = [
+        self._exchange_records(1, self.BINARY_REQUEST,
+                               self.COMPRESSED_BINARY_RESPONSE),
+        self._exchange_records(2, self.TEXT_REQUEST,
+                               self.COMPRESSED_TEXT_RESPONSE)]
+    # Interleaved, with every query retried after its ticket has finished.
+    records = [r for pair in itertools.zip_longest(*exchanges) for r in pair
+               if r is not None]
+    records += records
+    tickets = list(self._db.stream_from_records(records))
+    self.assertEqual([1, 2], sorted(t.ticket_id for t in tickets))
+    for t in tickets:
+      self.assertIsNotNone(t.response_message)
+    # The close_ticket queries arrive after the responses are complete.
+    self.assertEqual(len(records) // 2 + 2, self._db.rejections['late'])
+
+  def test_stream_from_records_reopened(self):
+    records = self._exchange_records(1, self.BINARY_REQUEST,
+                                     self.COMPRESSED_BINARY_RESPONSE)
+    # Same id, with another random number.
+    records.append(protocol.Query.create(
+        '0', {'sz': 1, 'rn': 1, 'id': 1},
+        util.DataChunk((1).to_bytes(3, 'big'), 0)).encode())
+    tickets = list(self._db.stream_from_records(records))
+    self.assertEqual([12345678, 1], [t.random_number for t in tickets])
+
+  def test_stream_from_records_idle_time(self):
+    times = iter([0, 5, 10, 20])
+    records = [self.OPEN_TICKET_RECORD] + [
+        self._close_ticket_record(i) for i in range(3)]
+    stream = self._db.stream_from_records(records, max_idle_time=10,
+                                          clock=lambda: next(times))
+    self.assertEqual([0, 1, 0xb273d6, 2],
+                     [t.ticket_id for t in stream])
+
+  def test_stream_from_records_heartbeats(self):
+    times = iter([0, 5, 10, 11])
+    records = [self.OPEN_TICKET_RECORD, None, None,
+               self._close_ticket_record(1)]
+    stream = self._db.stream_from_records(records, max_idle_time=10,
+                                          clock=lambda: next(times))
+    self.assertIsNone(next(stream))
+    # Evicted at the heartbeat, before any further records arrive.
+    self.assertEqual(0xb273d6, next(stream).ticket_id)
+    self.assertIsNone(next(stream))
+    self.assertEqual([1], [t.ticket_id for t in stream])
+
+  def test_stream_from_records_resumed(self):
+    self._db.build_from_records([self.OPEN_TICKET_RECORD])
+    times = iter([0, 10])
+    stream = self._db.stream_from_records([None], max_idle_time=10,
+                                          clock=lambda: next(times))
+    # Tickets already in progress go idle as well.
+    self.assertEqual(0xb273d6, next(stream).ticket_id)
+    self.assertIsNone(next(stream))
+    self.assertEqual([], list(stream))
+
+  def test_add(self):
+    tickets = list(self._db.stream_from_records(
+        [self.OPEN_TICKET_RECORD, self._close_ticket_record(1)]))
+    ticket_db = ticket.TicketDatabase()
+    for t in tickets:
+      ticket_db.add(t)
+    self.assertEqual([1, 0xb273d6], sorted(t.ticket_id for t in ticket_db))
+    self.assertEqual([1], [t.ticket_id for t in ticket_db.find(
+        complete=False, collision=False) if t.closed])
+    with self.assertRaises(ValueError):
+      ticket_db.add(tickets[0])
+
+  def test_ticket_states_restore(self):
+    self._db.build_from_records(self._generate_records(3))
+    restored = ticket.TicketDatabase()
+    for state in self._db.ticket_states():
+      restored.restore(state)
+    self._assert_same_tickets(self._db, restored)
+    self.assertEqual(sorted(t.ticket_id for t in self._db.find(complete=True)),
+                     sorted(t.ticket_id for t in restored.find(complete=True)))
+    with self.assertRaises(ValueError):
+      restored.restore(next(self._db.ticket_states()))
+
+  def test_add_first_seen(self):
+    # Ticket 1 is closed, and evicted, before the other ticket.
+    tickets = list(self._db.stream_from_records(
+        [self.OPEN_TICKET_RECORD, self._close_ticket_record(1)]))
+    self.assertEqual([1, 0xb273d6], [t.ticket_id for t in tickets])
+    ticket_db = ticket.TicketDatabase()
+    for t in tickets:
+      ticket_db.add(t)
+    ticket_db.build_from_records([self._close_ticket_record(2)])
+    self.assertEqual([0xb273d6, 1, 2],
+                     [t.ticket_id for t in sorted(
+                         ticket_db, key=lambda t: t.first_seen)])
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,218 @@
+import binascii
+import io
+import os
+import tempfile
+import unittest
+from vodreassembler import dnsrecord
+from vodreassembler import protocol
+from vodreassembler import ticket
+from vodreassembler import ticketfile
+from vodreassembler import util
+import zlib
+
+
+class TestTicketFile(unittest.TestCase):
+  REQUEST = b'\x00' + b'hello world' * 10
+  RESPONSE = zlib.compress(b'\x00' + os.urandom(200))
+
+  def _request_records(self, ticket_id, data):
+    payload = util.DataChunk(b'E\x00', 0)
+    return [protocol.Query.create(
+                '0', {'bf': binascii.hexlify(data[i:i+30]).decode('ascii'),
+                      'wr': i, 'id': ticket_id}, payload).encode()
+            for i in range(0, len(data), 30)]
+
+  def _response_records(self, ticket_id, data):
+    records = []
+    for i in range(0, len(data), 48):
+      segment = data[i:i+48]
+      query_vars = {'ln': len(segment), 'rd': i, 'id': ticket_id}
+      for off in range(0, len(segment), 3):
+        records.append(protocol.Query.create(
+            '0', query_vars, util.DataChunk(segment[off:off+3], off)).encode())
+    return records
+
+  def setUp(self):
+    self._db = ticket.TicketDatabase()
+    records = [dnsrecord.DnsRecord(
+        'sz-00000121.rn-12345678.id-00000001.v0.tun.vpnoverdns.com.',
+        'IN', 'A', '192.178.115.214')]
+    records += self._request_records(30, self.REQUEST)
+    records += self._response_records(30, self.RESPONSE)
+    records += protocol.Query.create('0', {'ac': True, 'id': 30},
+                                     util.DataChunk(b'E\x00', 0)).encode(),
+    # Partial request and response
+    records += self._request_records(20, self.REQUEST)[1:]
+    records += self._response_records(20, self.RESPONSE)[2:]
+    self._db.build_from_records(records)
+
+  def _save(self, metadata=None):
+    f = io.BytesIO()
+    ticketfile.save(self._db, f, metadata=metadata)
+    f.seek(0)
+    return f
+
+  def test_round_trip(self):
+    loaded = ticketfile.load(self._save())
+    self.assertEqual([t.ticket_id for t in self._db],
+                     [t.ticket_id for t in loaded])
+    for expected in self._db:
+      actual = loaded[expected.ticket_id]
+      self.assertEqual(expected.collision, actual.collision)
+      self.assertEqual(expected.closed, actual.closed)
+      self.assertEqual(expected.random_number, actual.random_number)
+      self.assertEqual(expected.raw_request_length, actual.raw_request_length)
+      self.assertEqual(expected.raw_response_length,
+                       actual.raw_response_length)
+      if expected.ticket_id == 20:
+        with self.assertRaises(util.IncompleteDataError):
+          actual.raw_request_data
+      else:
+        self.assertEqual(expected.raw_request_data, actual.raw_request_data)
+        self.assertEqual(expected.raw_response_data, actual.raw_response_data)
+    self.assertEqual(self.REQUEST, loaded[30].raw_request_data)
+    self.assertEqual(self.RESPONSE, loaded[30].raw_response_data)
+    self.assertTrue(loaded[30].closed)
+    self.assertEqual([30], [t.ticket_id for t in loaded.find(complete=True)])
+
+  def test_first_seen(self):
+    # Tickets added in another order than they were first seen.
+    collected = ticket.TicketDatabase()
+    for t in reversed(list(self._db)):
+      collected.add(t)
+    self._db = collected
+    with tempfile.TemporaryDirectory() as tmpdir:
+      path = os.path.join(tmpdir, 'tickets.db')
+      with open(path, 'wb') as f:
+        ticketfile.save(self._db, f)
+      with open(path, 'rb') as f:
+        loaded = ticketfile.load(f)
+      with ticketfile.MappedTicketDatabase(path) as mapped:
+        for ticket_db in (loaded, mapped):
+          self.assertEqual([0xb273d6, 30, 20], [
+              t.ticket_id for t in sorted(ticket_db,
+                                          key=lambda t: t.first_seen)])
+          self.assertEqual(1, ticket_db[30].first_seen)
+
+  def test_round_trip_continue_partial(self):
+    loaded = ticketfile.load(self._save())
+    loaded.build_from_records(self._request_records(20, self.REQUEST)[:1])
+    loaded.build_from_records(self._response_records(20, self.RESPONSE)[:2])
+    self.assertEqual(self.REQUEST, loaded[20].raw_request_data)
+    self.assertEqual(self.RESPONSE, loaded[20].raw_response_data)
+    self.assertFalse(loaded[20].collision)
+
+  def test_reader_metadata(self):
+    reader = ticketfile.TicketFileReader(self._save(metadata={'foo': 1}))
+    self.assertEqual({'foo': 1}, reader.metadata)
+    self.assertIsNone(reader.fqdn_suffix)
+    self.assertEqual(3, len(reader))
+    entries = list(reader)
+    self.assertEqual([0xb273d6, 30, 20], [e.ticket_id for e in entries])
+    self.assertEqual(12345678, entries[0].random_number)
+    self.assertEqual(121, entries[0].raw_request_length)
+    self.assertIsNone(entries[0].request)
+    self.assertFalse(entries[1].request.partial)
+    self.assertTrue(entries[2].request.partial)
+    self.assertEqual(len(self.RESPONSE), entries[1].raw_response_length)
+
+  def test_rejections(self):
+    self._db.build_from_records([dnsrecord.DnsRecord(
+        'id-00000001.v0.tun.vpnoverdns.com.', 'IN', 'TXT', 'unknown')])
+    self.assertTrue(self._db.rejections)
+    self.assertEqual(self._db.rejections,
+                     ticketfile.TicketFileReader(self._save()).rejections)
+    self.assertEqual(self._db.rejections,
+                     ticketfile.load(self._save()).rejections)
+
+  def test_reader_find(self):
+    reader = ticketfile.TicketFileReader(self._save())
+    entry = reader.find(30)
+    self.assertEqual(30, entry.ticket_id)
+    self.assertEqual(self.REQUEST, reader.read_request(entry))
+    self.assertEqual(self.RESPONSE, reader.read_response(entry))
+    self.assertIsNone(reader.read_request(reader.find(0xb273d6)))
+    self.assertIsNone(reader.find(31))
+    self.assertIsNone(reader.find(0))
+
+  def test_empty(self):
+    self._db = ticket.TicketDatabase('illinois.edu')
+    loaded = ticketfile.load(self._save())
+    self.assertEqual(0, len(loaded))
+    reader = ticketfile.TicketFileReader(self._save())
+    self.assertEqual('illinois.edu', reader.fqdn_suffix)
+    self.assertIsNone(reader.find(1))
+
+  def test_multiple_suffixes(self):
+    self._db = ticket.TicketDatabase(['a.example.com', 'b.example.com'])
+    for fqdn_suffix in ('a.example.com', 'b.example.com'):
+      self._db.build_from_records(
+          [r._replace(fqdn=r.fqdn.replace('tun.vpnoverdns.com', fqdn_suffix))
+           for r in self._request_records(30, self.REQUEST)])
+    key = ('b.example.com.', 30)
+    loaded = ticketfile.load(self._save())
+    self.assertEqual(('a.example.com.', 'b.example.com.'), loaded.fqdn_suffix)
+    self.assertEqual(list(self._db._tickets), list(loaded._tickets))
+    self.assertEqual(self.REQUEST, loaded[key].raw_request_data)
+    self.assertEqual('b.example.com.', loaded[key].fqdn_suffix)
+    reader = ticketfile.TicketFileReader(self._save())
+    self.assertEqual(key, reader.find(key).key)
+    self.assertEqual(30, reader.find(key).ticket_id)
+    self.assertIsNone(reader.find(30))
+    self.assertIsNone(reader.find(('c.example.com.', 30)))
+    with tempfile.TemporaryDirectory() as tmpdir:
+      path = os.path.join(tmpdir, 'tickets.db')
+      with open(path, 'wb') as f:
+        ticketfile.save(self._db, f)
+      with ticketfile.MappedTicketDatabase(path) as mapped_db:
+        self.assertIn(key, mapped_db)
+        self.assertEqual('b.example.com.', mapped_db[key].fqdn_suffix)
+        self.assertEqual(self.REQUEST, bytes(mapped_db[key].raw_request_data))
+    self._db.build_from_records(
+        [r._replace(fqdn=r.fqdn.replace('tun.vpnoverdns.com', 'a.example.com'))
+         for r in self._request_records(2**48, self.REQUEST)[:1]])
+    with self.assertRaises(ValueError):
+      self._save()
+
+  def test_bad_header(self):
+    with self.assertRaises(ticketfile.FormatError):
+      ticketfile.TicketFileReader(io.BytesIO(b'VODT'))
+    data = bytearray(self._save().getvalue())
+    data[0:4] = b'XXXX'
+    with self.assertRaises(ticketfile.FormatError):
+      ticketfile.TicketFileReader(io.BytesIO(data))
+    data[0:6] = b'VODT\xff\x00'
+    with self.assertRaises(ticketfile.UnsupportedVersionError):
+      ticketfile.TicketFileReader(io.BytesIO(data))
+
+  def test_mapped(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      path = os.path.join(tmpdir, 'tickets.db')
+      with open(path, 'wb') as f:
+        ticketfile.save(self._db, f)
+      mapped_db = ticketfile.MappedTicketDatabase(path)
+      self.assertEqual(3, len(mapped_db))
+      self.assertEqual([0xb273d6, 30, 20], [t.ticket_id for t in mapped_db])
+      self.assertIn(30, mapped_db)
+      self.assertNotIn(31, mapped_db)
+      with self.assertRaises(KeyError):
+        mapped_db[31]
+      mapped = mapped_db[30]
+      self.assertIsInstance(mapped.raw_request_data, memoryview)
+      self.assertEqual(self.REQUEST, mapped.raw_request_data)
+      self.assertEqual(self.RESPONSE, mapped.raw_response_data)
+      self.assertEqual(self._db[30].request_message, mapped.request_message)
+      self.assertEqual(self._db[30].response_data, mapped.response_data)
+      self.assertEqual(zlib.decompress(self.RESPONSE), mapped.partial_response)
+      self.assertEqual(b'', mapped_db[20].partial_response)
+      self.assertTrue(mapped.closed)
+      self.assertEqual(121, mapped_db[0xb273d6].raw_request_length)
+      with self.assertRaises(util.IncompleteDataError):
+        mapped_db[20].raw_request_data
+      self.assertEqual(repr(self._db), repr(mapped_db))
+      del mapped
+      mapped_db.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,7 +1,10 @@
+import io
 import itertools
 import os
+import pickle
 import unittest
 from vodreassembler import util
+import zlib
 
 
 class TestDataAssembler(unittest.TestCase):
@@ -139,6 +142,95 @@ class TestDataAssembler(unittest.TestCase):
     with self.assertRaises(util.ChunkPastEndError):
       assembler.add(b'\x00\x00\x00', 6)
 
+  def test_getbuffer(self):
+    assembler = util.DataAssembler(3, length=5)
+    with self.assertRaises(util.IncompleteDataError):
+      assembler.getbuffer()
+    view = assembler.getbuffer(incomplete=True)
+    self.assertTrue(view.readonly)
+    assembler.add(b'\x01\x02\x03', 0)
+    assembler.add(b'\x04\x05', 3)
+    self.assertEqual(b'\x01\x02\x03\x04\x05', view)
+    self.assertEqual(b'\x01\x02\x03\x04\x05', assembler.getbuffer())
+    self.assertIsInstance(assembler.getbytes(), bytes)
+
+  def test_getbuffer_unsized(self):
+    assembler = util.DataAssembler(3)
+    assembler.add(b'\x01\x02\x03', 3)
+    self.assertEqual(b'\x00\x00\x00\x01\x02\x03',
+                     assembler.getbuffer(incomplete=True))
+    # Length becomes known with the last chunk.
+    assembler.add(b'\x04', 6)
+    assembler.length = 7
+    assembler.add(b'\xff\xfe\xfd', 0)
+    self.assertEqual(b'\xff\xfe\xfd\x01\x02\x03\x04', assembler.getbuffer())
+    with self.assertRaises(util.ChunkCollisionError):
+      assembler.add(b'\x01\x02\x04', 3)
+
+  def test_custom_storage(self):
+    storage = io.BytesIO()
+    assembler = util.DataAssembler(3, storage=storage, length=4)
+    assembler.add(b'\x01', 3)
+    assembler.add(b'\xff\xfe\xfd', 0)
+    self.assertEqual(b'\xff\xfe\xfd\x01', storage.getvalue())
+    self.assertEqual(b'\xff\xfe\xfd\x01', assembler.getbuffer())
+
+  def test_restore(self):
+    assembler = util.DataAssembler(3, length=7)
+    assembler.add(b'\x01\x02\x03', 3)
+    restored = util.DataAssembler.restore(
+        3, assembler.getbytes(incomplete=True), assembler.chunk_bitmap,
+        length=assembler.length)
+    self.assertFalse(restored.complete)
+    with self.assertRaises(util.ChunkCollisionError):
+      restored.add(b'\x01\x02\x04', 3)
+    restored.add(b'\xff\xfe\xfd', 0)
+    restored.add(b'\x04', 6)
+    self.assertEqual(b'\xff\xfe\xfd\x01\x02\x03\x04', restored.getbytes())
+
+  def test_filled_prefix_length(self):
+    assembler = util.DataAssembler(3)
+    self.assertEqual(0, assembler.filled_prefix_length)
+    assembler.add(b'\x01\x02\x03', 3)
+    self.assertEqual(0, assembler.filled_prefix_length)
+    assembler.add(b'\xff\xfe\xfd', 0)
+    self.assertEqual(6, assembler.filled_prefix_length)
+    assembler.add(b'\x04', 6)
+    self.assertEqual(7, assembler.filled_prefix_length)
+
+  def test_missing_ranges(self):
+    assembler = util.DataAssembler(3, length=14)
+    self.assertEqual([(0, 14)], assembler.missing_ranges())
+    assembler.add(b'\x01\x02\x03', 3)
+    assembler.add(b'\x01\x02', 12)
+    self.assertEqual([(0, 3), (6, 6)], assembler.missing_ranges())
+    self.assertEqual(2, assembler.num_filled_chunks)
+    assembler.add(b'\x01\x02\x03', 0)
+    assembler.add(b'\x01\x02\x03', 0)
+    self.assertEqual(3, assembler.num_filled_chunks)
+    self.assertEqual(6, assembler.filled_prefix_length)
+    self.assertEqual([(6, 6)], assembler.missing_ranges())
+    assembler.add(b'\x01\x02\x03', 9)
+    assembler.add(b'\x01\x02\x03', 6)
+    self.assertEqual([], assembler.missing_ranges())
+    self.assertEqual(14, assembler.filled_prefix_length)
+    self.assertTrue(assembler.complete)
+
+  def test_missing_ranges_unsized(self):
+    assembler = util.DataAssembler(3)
+    self.assertEqual([], assembler.missing_ranges())
+    assembler.add(b'\x01\x02\x03', 6)
+    self.assertEqual([(0, 6)], assembler.missing_ranges())
+    self.assertFalse(assembler.complete)
+    restored = util.DataAssembler.restore(
+        3, assembler.getbytes(incomplete=True), assembler.chunk_bitmap)
+    self.assertEqual([(0, 6)], restored.missing_ranges())
+    self.assertEqual(1, restored.num_filled_chunks)
+    restored.add(b'\x01\x02\x03', 0)
+    restored.add(b'\x01\x02\x03', 3)
+    self.assertTrue(restored.complete)
+    self.assertEqual(9, restored.filled_prefix_length)
+
   def _generate_data(self, length, alignment):
     assert length > 0
     assert alignment > 0
@@ -211,5 +303,59 @@ class TestDataAssembler(unittest.TestCase):
     self._test_unsized_add(11, 4)
 
 
+
+class TestPrefixDecompressor(unittest.TestCase):
+  DATA = os.urandom(1000) * 10
+  COMPRESSED = zlib.compress(DATA)
+
+  def _chunks(self):
+    return [util.DataChunk(self.COMPRESSED[i:i+3], i)
+            for i in range(0, len(self.COMPRESSED), 3)]
+
+  def test_incremental(self):
+    for length in (None, len(self.COMPRESSED)):
+      assembler = util.DataAssembler(3, length=length)
+      output = []
+      decompressor = util.PrefixDecompressor(output.append)
+      chunks = self._chunks()
+      middle = len(chunks) // 2
+      for chunk in chunks[middle:]:
+        assembler.add_chunk(chunk)
+        decompressor.update(assembler)
+      self.assertEqual([], output)
+      self.assertEqual(0, decompressor.consumed)
+      for chunk in chunks[:middle]:
+        assembler.add_chunk(chunk)
+        decompressor.update(assembler)
+        self.assertTrue(self.DATA.startswith(b''.join(output)))
+      self.assertEqual(len(self.COMPRESSED), decompressor.consumed)
+      self.assertTrue(decompressor.eof)
+      self.assertEqual(self.DATA, b''.join(output))
+      self.assertEqual(len(self.DATA), decompressor.decompressed_length)
+
+  def test_reads_only_new_data(self):
+    assembler = util.DataAssembler(3)
+    reads = []
+    getrange = assembler.getrange
+    assembler.getrange = lambda offset, length: (
+        reads.append((offset, length)) or getrange(offset, length))
+    decompressor = util.PrefixDecompressor()
+    for chunk in self._chunks():
+      assembler.add_chunk(chunk)
+      decompressor.update(assembler)
+    self.assertEqual(len(self.COMPRESSED), sum(n for _, n in reads))
+    self.assertEqual(len(self.DATA), decompressor.decompressed_length)
+
+  def test_corrupted(self):
+    assembler = util.DataAssembler(3, length=6)
+    assembler.add(b'\xff\xff\xff', 0)
+    decompressor = util.PrefixDecompressor()
+    with self.assertRaises(zlib.error):
+      decompressor.update(assembler)
+    self.assertIsInstance(decompressor.error, zlib.error)
+    with self.assertRaises(zlib.error):
+      decompressor.update(assembler)
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,203 @@
+"""Checkpoints of ticket databases being built from DNS record dumps.
+
+A checkpoint is a ticket file (see ticketfile) holding the partially built
+database, including partially assembled requests and responses, along with
+the position in the dump up to which records have been applied. Building can
+be resumed from the position after a failure, instead of starting over.
+
+Checkpoints also identify the dump by a digest of its head, so that a build is
+not resumed on another file, e.g. after the dump has been rotated.
+"""
+
+import collections
+import hashlib
+import os
+from vodreassembler import dnsrecord
+from vodreassembler import ticketfile
+
+DEFAULT_INTERVAL = 1000000
+
+# Maximum number of bytes at the start of a source hashed by SourceIdentity.
+_HEAD_SIZE = 1 << 16
+
+
+class Error(Exception):
+  pass
+
+
+class SourceMismatchError(Error):
+  pass
+
+
+class SourceIdentity(collections.namedtuple('SourceIdentity', [
+    'head_length', 'head_digest'])):
+  """Identity of a source file, by the SHA-256 digest of its head.
+
+  Files which are only appended to keep their identity, while files replaced
+  by others, e.g. on rotation, do not, unless their heads are identical.
+
+  Attributes:
+    head_length (int): Number of bytes hashed, up to 64 KiB.
+    head_digest (str): Hex digest of the bytes.
+  """
+  @classmethod
+  def of_file(cls, fileobj):
+    """Identify a seekable binary file; its position is kept."""
+    head = _read_head(fileobj, _HEAD_SIZE)
+    return cls(len(head), hashlib.sha256(head).hexdigest())
+
+  @classmethod
+  def of_path(cls, path):
+    with open(path, 'rb') as f:
+      return cls.of_file(f)
+
+  def matches(self, fileobj):
+    """Whether a seekable binary file is the source, possibly grown since."""
+    head = _read_head(fileobj, self.head_length)
+    return (len(head) == self.head_length
+            and hashlib.sha256(head).hexdigest() == self.head_digest)
+
+
+def _read_head(fileobj, length):
+  position = fileobj.tell()
+  fileobj.seek(0)
+  head = fileobj.read(length)
+  fileobj.seek(position)
+  return head
+
+
+class Checkpoint(collections.namedtuple('Checkpoint', [
+    'source_offset', 'num_records', 'source', 'source_inode',
+    'dedup_keys'])):
+  """Progress of a build.
+
+  Attributes:
+    source_offset (int): Position in the dump up to which records have been
+      applied.
+    num_records (int): Number of records applied so far.
+    source (SourceIdentity): Identity of the dump, or None if unknown, as in
+      checkpoints written by earlier versions.
+    source_inode (tuple): (st_dev, st_ino) of the dump, or None. Only saved
+      when following a dump, whose path may be rotated to another file.
+    dedup_keys (list): Keys kept by the protocol.DuplicateFilter of the
+      build (see DuplicateFilter.recent_keys()), or None without one.
+  """
+  pass
+
+Checkpoint.__new__.__defaults__ = (None, None, None)
+
+
+def save(ticket_db, path, checkpoint):
+  """Atomically write ticket_db and checkpoint into a file at path.
+
+  The previous checkpoint at path, if any, stays intact until the new one is
+  completely written.
+  """
+  metadata = {'checkpoint': checkpoint._asdict()}
+  if checkpoint.source is not None:
+    metadata['checkpoint']['source'] = checkpoint.source._asdict()
+  temp_path = path + '.tmp'
+  with open(temp_path, 'wb') as f:
+    ticketfile.save(ticket_db, f, metadata=metadata)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(temp_path, path)
+
+
+def load(path):
+  """Load a checkpoint written by save().
+
+  Returns:
+    Tuple of the ticket.TicketDatabase and the Checkpoint.
+
+  Raises:
+    Error: If the file is a ticket file but not a checkpoint.
+  """
+  with open(path, 'rb') as f:
+    reader = ticketfile.TicketFileReader(f)
+    metadata = reader.metadata
+    if not isinstance(metadata, dict) or 'checkpoint' not in metadata:
+      raise Error('{} is not a checkpoint'.format(path))
+    ticket_db = reader.load()
+  fields = metadata['checkpoint']
+  if fields.get('source') is not None:
+    fields['source'] = SourceIdentity(**fields['source'])
+  if fields.get('source_inode') is not None:
+    fields['source_inode'] = tuple(fields['source_inode'])
+  if fields.get('dedup_keys') is not None:
+    fields['dedup_keys'] = [tuple(key) for key in fields['dedup_keys']]
+  return ticket_db, Checkpoint(**fields)
+
+
+def build_from_dump(ticket_db, src, path, interval=DEFAULT_INTERVAL,
+                    processes=None, contains=None, start=None, stats=None,
+                    dedup=None):
+  """Apply records from a dump to ticket_db, saving checkpoints periodically.
+
+  A checkpoint is saved after every interval records or more, at the end of a
+  block of the dump, and once the dump is exhausted.
+
+  Args:
+    ticket_db (ticket.TicketDatabase): Database to be updated.
+    src: seekable binary file object of the dump.
+    path (str): Path of the checkpoint file.
+    interval (int, optional): Minimum number of records between checkpoints.
+    processes (int, optional): Passed to TicketDatabase.build_from_records().
+    contains (str, optional): Passed to dnsrecord.from_dump_blocks().
+    start (Checkpoint, optional): Checkpoint to resume from. ticket_db must be
+      the database loaded with it, and src the dump it was saved for.
+    stats (ticket.BuildStats, optional): Passed to
+      TicketDatabase.build_from_records().
+    dedup (protocol.DuplicateFilter, optional): Passed to
+      TicketDatabase.build_from_records(). Its keys are saved in every
+      checkpoint, and restored from start, so that records repeated across
+      the resume point are suppressed as in an uninterrupted build.
+
+  Returns:
+    The last Checkpoint saved.
+
+  Raises:
+    SourceMismatchError: If src is not the dump of start.
+  """
+  checkpoint = start or Checkpoint(0, 0)
+  source = checkpoint.source
+  if source is None:
+    source = SourceIdentity.of_file(src)
+  elif not source.matches(src):
+    raise SourceMismatchError('the dump differs from that of the checkpoint')
+  if dedup is not None and checkpoint.dedup_keys is not None:
+    dedup.remember(checkpoint.dedup_keys)
+  src.seek(checkpoint.source_offset)
+  blocks = dnsrecord.from_dump_blocks(src, contains=contains)
+  progress = _Progress(checkpoint)
+  while not progress.exhausted:
+    ticket_db.build_from_records(_next_segment(blocks, interval, progress),
+                                 processes=processes, stats=stats,
+                                 dedup=dedup)
+    checkpoint = Checkpoint(
+        progress.source_offset, progress.num_records, source,
+        dedup_keys=dedup.recent_keys() if dedup is not None else None)
+    save(ticket_db, path, checkpoint)
+  return checkpoint
+
+
+class _Progress:
+  def __init__(self, checkpoint):
+    self.source_offset = checkpoint.source_offset
+    self.num_records = checkpoint.num_records
+    self.exhausted = False
+
+
+def _next_segment(blocks, interval, progress):
+  # Yields records of whole blocks, and updates progress only after all records
+  # of a block have been taken, so that progress never covers records which
+  # have not been applied.
+  count = 0
+  for records, offset in blocks:
+    yield from records
+    count += len(records)
+    progress.source_offset = offset
+    progress.num_records += len(records)
+    if count >= interval:
+      return
+  progress.exhausted = True
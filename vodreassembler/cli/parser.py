@@ -1,23 +1,50 @@
 """Command line tool for parsing vpnoverdata sources.
 
-Currently, only conversion from DNS text dumps to ticket database is supported.
+Currently, DNS text dumps or packet captures can be converted to ticket
+databases, and ticket databases to the byte streams of socket sessions.
+Records from several sources are applied to a single ticket database in the
+order given, and can be applied on top of an existing ticket database. A DNS
+dump which keeps growing can be followed, writing tickets as they finish.
 """
 
 import argparse
 import collections
+import itertools
+import json
+import os
 import pickle
-from vodreassembler import dnsrecord, ticket
+import re
+import signal
+import sys
+import time
+from vodreassembler import checkpoint, dnsrecord, pcap, pipeline, protocol
+from vodreassembler import socket, ticket
+from vodreassembler import ticketfile
 
 _SRC_TYPES = {
   'auto',
   'dns_dump',
+  'pcap',
+  'ticket_db',
 }
 
 _DEST_TYPES = {
   'auto',
+  'sessions',
   'ticket_db',
+  'ticket_pickle',
 }
 
+# Defaults of --follow, in seconds.
+DEFAULT_FLUSH_INTERVAL = 10.0
+DEFAULT_MAX_IDLE_TIME = 300.0
+
+# Ticket databases written by --follow.
+_FOLLOW_FILE_FORMAT = 'tickets-{:06d}.db'
+_FOLLOW_FILE_RE = re.compile(r'tickets-(\d+)\.db')
+# Checkpoint of --follow, next to the ticket databases.
+_FOLLOW_CHECKPOINT = 'follow.checkpoint'
+
 # Datapaths from one type to another. Key is a tuple defining a directed edge
 # from one datatype to another, and value is the callable performing the
 # conversion.
@@ -25,57 +52,423 @@ _DEST_TYPES = {
 # representations.
 _TRANSFORMERS = {
   ('dns_dump', '__dns_records') : 'parse_dns_dump',
+  ('dns_dump', '__ticket_db') : 'build_ticket_db_from_dump',
+  ('pcap', '__dns_records') : 'parse_pcap',
   ('__dns_records', '__ticket_db') : 'generate_ticket_db',
-  ('__ticket_db', 'ticket_db') : 'pickle_ticket_db',
+  ('__ticket_db', 'ticket_db') : 'save_ticket_db',
+  ('__ticket_db', 'ticket_pickle') : 'pickle_ticket_db',
+  ('ticket_db', '__ticket_db') : 'load_ticket_db',
+  ('__ticket_db', 'sessions') : 'write_sessions',
 }
 
 def parse_args():
   parser = argparse.ArgumentParser(description='VPN-over-DNS data parser.')
-  parser.add_argument('source', metavar='src', type=str,
-                      help='Source file to be parsed.')
+  parser.add_argument('sources', metavar='src', type=str, nargs='+',
+                      help='Source files to be parsed, in order.')
   parser.add_argument('dest', metavar='dest', type=str,
                       help='Destination file for the results.')
-  parser.add_argument('--src_type', choices=['auto', 'dns_dump'],
+  parser.add_argument('--src_type',
+                      choices=['auto', 'dns_dump', 'pcap', 'ticket_db'],
                       type=str, default='auto',
                       help='Type of source data. Default is auto.')
-  parser.add_argument('--dest_type', choices=['auto', 'ticket_db'],
+  parser.add_argument('--dest_type',
+                      choices=['auto', 'sessions', 'ticket_db',
+                               'ticket_pickle'],
                       type=str, default='auto',
-                      help='Type of destination data. Default is auto.')
-  return parser.parse_args()
+                      help='Type of destination data. Default is auto. For '
+                           'sessions, dest is a directory receiving the byte '
+                           'streams of every socket session.')
+  parser.add_argument('--fqdn_suffix', metavar='SUFFIX', action='append',
+                      help='FQDN suffix of the queries. May be repeated, in '
+                           'which case the queries of all the suffixes are '
+                           'read in a single pass, and tickets are keyed by '
+                           'suffix and id. Default is {}.'.format(
+                               protocol.DEFAULT_FQDN_SUFFIX))
+  parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                      help='Number of worker processes used for generating '
+                           'tickets. Default is 1.')
+  parser.add_argument('--pipeline', action='store_true',
+                      help='Read, parse and assemble records concurrently, '
+                           'and report statistics of each stage.')
+  parser.add_argument('--checkpoint', metavar='PATH', type=str,
+                      help='Periodically save the partially built ticket '
+                           'database and the position in the source into '
+                           'PATH. Only supported for DNS dumps.')
+  parser.add_argument('--checkpoint_interval', metavar='N', type=int,
+                      default=checkpoint.DEFAULT_INTERVAL,
+                      help='Minimum number of records between checkpoints. '
+                           'Default is {}.'.format(checkpoint.DEFAULT_INTERVAL))
+  parser.add_argument('--resume', action='store_true',
+                      help='Continue from the checkpoint given by '
+                           '--checkpoint, if it exists.')
+  parser.add_argument('--update', action='store_true',
+                      help='Apply the sources on top of the ticket database '
+                           'in dest, if it exists, and write the result back. '
+                           'Sources already applied to it are skipped.')
+  parser.add_argument('--stats_json', metavar='PATH', type=str,
+                      help='Write counters and timers of generating tickets '
+                           'into PATH as JSON. Only supported for serial '
+                           'builds.')
+  parser.add_argument('--dedup_size', metavar='N', type=int, default=0,
+                      help='Suppress records repeated within the last N '
+                           'distinct records, such as retries, before '
+                           'parsing them. Default is 0, which disables it.')
+  parser.add_argument('--follow', action='store_true',
+                      help='Keep reading the DNS dump as it grows, across '
+                           'rotations, until interrupted. Tickets are written '
+                           'as they finish into numbered ticket databases in '
+                           'dest, which is a directory.')
+  parser.add_argument('--flush_interval', metavar='SECONDS', type=float,
+                      default=DEFAULT_FLUSH_INTERVAL,
+                      help='Maximum delay before finished tickets are '
+                           'written with --follow. Default is {}.'.format(
+                               DEFAULT_FLUSH_INTERVAL))
+  parser.add_argument('--max_idle_time', metavar='SECONDS', type=float,
+                      default=DEFAULT_MAX_IDLE_TIME,
+                      help='Write tickets not updated for this long with '
+                           '--follow, even if they are incomplete. Default is '
+                           '{}.'.format(DEFAULT_MAX_IDLE_TIME))
+  args = parser.parse_args()
+  if args.fqdn_suffix is not None:
+    if len(args.fqdn_suffix) == 1:
+      args.fqdn_suffix = protocol.normalize_fqdn_suffix(args.fqdn_suffix[0])
+    else:
+      args.fqdn_suffix = protocol.normalize_fqdn_suffixes(args.fqdn_suffix)
+  if args.stats_json and (args.pipeline or args.jobs > 1):
+    parser.error('--stats_json cannot be used with --pipeline or --jobs')
+  if args.resume and not args.checkpoint:
+    parser.error('--resume requires --checkpoint')
+  if args.checkpoint and args.pipeline:
+    parser.error('--checkpoint cannot be used with --pipeline')
+  if args.checkpoint and len(args.sources) > 1:
+    parser.error('--checkpoint can only be used with a single source')
+  if args.follow:
+    if len(args.sources) > 1:
+      parser.error('--follow can only be used with a single source')
+    if (args.checkpoint or args.update or args.pipeline or args.stats_json
+        or args.jobs > 1):
+      parser.error('--follow cannot be used with --checkpoint, --update, '
+                   '--pipeline, --stats_json or --jobs')
+    if args.dest_type not in ('auto', 'ticket_db'):
+      parser.error('--follow only writes ticket databases')
+  return args
 
-def deduce_src_type(src_type):
-  if src_type is not 'auto':
+def deduce_src_type(src_type, source):
+  if src_type != 'auto':
     return src_type
-  # The only possible type is currently dns_dump
+  with open(source, mode='rb') as srcf:
+    header = srcf.read(4)
+  if pcap.is_capture(header):
+    return 'pcap'
+  elif header == ticketfile.MAGIC:
+    return 'ticket_db'
   return 'dns_dump'
 
 def deduce_dest_type(dest_type):
-  if dest_type is not 'auto':
+  if dest_type != 'auto':
     return dest_type
   # The only possible type is currently ticket_db
   return 'ticket_db'
 
+def is_directory_type(data_type):
+  return data_type == 'sessions'
+
 def is_binary_type(data_type):
   if data_type == 'dns_dump':
-    return False
-  elif data_type == 'ticket_db':
+    # Text, but read in binary by dnsrecord.from_dump_batches().
+    return True
+  elif data_type in {'pcap', 'ticket_db', 'ticket_pickle'}:
     return True
   raise ValueError("Unknown or unsupported datatype: '{}'".format(data_type))
 
-def parse_dns_dump(dns_dump):
+def parse_dns_dump(dns_dump, args):
   print('Loading DNS records from file...')
-  return dnsrecord.from_dump(dns_dump)
+  # Lines without the suffix cannot be parsed, and are skipped while reading.
+  return itertools.chain.from_iterable(
+      dnsrecord.from_dump_batches(dns_dump, contains=_dump_filter(args)))
+
+def follow_dump(source, args):
+  """Apply records of a growing DNS dump, writing tickets as they finish.
+
+  Finished tickets, and tickets idle for args.max_idle_time, are collected and
+  written into a new ticket database in args.dest at most args.flush_interval
+  seconds after the first of them.
+
+  The position in the dump and the tickets in progress are saved along with
+  the written files into a checkpoint in args.dest, from which a restarted run
+  resumes, unless the dump has been replaced since. SIGINT and SIGTERM stop
+  following once the current block of records is applied, saving the
+  checkpoint.
+  """
+  os.makedirs(args.dest, exist_ok=True)
+  checkpoint_path = os.path.join(args.dest, _FOLLOW_CHECKPOINT)
+  position = dnsrecord.FollowPosition()
+  if os.path.exists(checkpoint_path):
+    ticket_db, saved = checkpoint.load(checkpoint_path)
+    if (args.fqdn_suffix is not None
+        and _normalized_suffix(ticket_db.fqdn_suffix)
+            != _normalized_suffix(args.fqdn_suffix)):
+      sys.exit('--fqdn_suffix differs from that of {}'.format(checkpoint_path))
+    if _follows_source(source, saved):
+      position = dnsrecord.FollowPosition(saved.source_inode,
+                                          saved.source_offset,
+                                          saved.num_records)
+      if args.dedup is not None and saved.dedup_keys is not None:
+        args.dedup.remember(saved.dedup_keys)
+      print('Resuming {} at offset {}...'.format(source, position.offset))
+    else:
+      print('{} has been replaced since the last run; following it from '
+            'the start...'.format(source))
+  else:
+    ticket_db = ticket.TicketDatabase(args.fqdn_suffix)
+    print('Following DNS records in {}...'.format(source))
+  # Stop as gracefully on termination by service managers as on Ctrl-C, at a
+  # heartbeat, where the position in the dump is exact.
+  stop = _StopRequest()
+  signal.signal(signal.SIGINT, stop)
+  signal.signal(signal.SIGTERM, stop)
+  records = dnsrecord.follow_dump(source, contains=_dump_filter(args),
+                                  position=position)
+  if args.dedup is not None:
+    records = args.dedup.filter(records, _may_be_query(ticket_db))
+  writer = _FollowWriter(ticket_db, args.dest, [os.path.abspath(source)])
+  last_saved, saved_records = time.monotonic(), position.num_records
+  for finished in ticket_db.stream_from_records(
+      records, max_idle_time=args.max_idle_time):
+    if finished is not None:
+      writer.add(finished)
+    elif stop.requested:
+      break
+    # Heartbeats come at least every poll interval, even while records keep
+    # coming, so that no ticket waits much longer than args.flush_interval.
+    elif writer.age() >= args.flush_interval or (
+        time.monotonic() - last_saved >= args.flush_interval
+        and position.num_records != saved_records):
+      writer.close()
+      _save_follow_checkpoint(ticket_db, checkpoint_path, source, position,
+                              args.dedup)
+      last_saved, saved_records = time.monotonic(), position.num_records
+  print('Interrupted; saving tickets in progress...')
+  writer.close()
+  _save_follow_checkpoint(ticket_db, checkpoint_path, source, position,
+                          args.dedup)
+
+class _StopRequest:
+  """Signal handler recording that a stop has been requested."""
+  def __init__(self):
+    self.requested = False
+
+  def __call__(self, signum, frame):
+    self.requested = True
+
+def _save_follow_checkpoint(ticket_db, path, source, position, dedup):
+  # The dump is identified by its inode, and by its head once path is known to
+  # still be the file being read; otherwise, it has been rotated, and the next
+  # run starts from the beginning of path anyway.
+  identity = None
+  try:
+    with open(source, 'rb') as f:
+      stat = os.fstat(f.fileno())
+      if (stat.st_dev, stat.st_ino) == position.inode:
+        identity = checkpoint.SourceIdentity.of_file(f)
+  except FileNotFoundError:
+    # Moved away, and the new file is not created yet.
+    pass
+  dedup_keys = dedup.recent_keys() if dedup is not None else None
+  checkpoint.save(ticket_db, path,
+                  checkpoint.Checkpoint(position.offset, position.num_records,
+                                        identity, position.inode, dedup_keys))
+
+def _follows_source(source, saved):
+  # Whether the checkpoint was saved while following the file at source.
+  if saved.source is None or saved.source_inode is None:
+    return False
+  with open(source, 'rb') as f:
+    stat = os.fstat(f.fileno())
+    return ((stat.st_dev, stat.st_ino) == saved.source_inode
+            and saved.source_offset <= stat.st_size
+            and saved.source.matches(f))
+
+class _FollowWriter:
+  """Collects tickets streamed from ticket_db into numbered ticket files."""
+  def __init__(self, ticket_db, dest, sources):
+    self._ticket_db = ticket_db
+    self._dest = dest
+    self._sources = sources
+    # Rejections up to here, e.g. in a resumed checkpoint, were written by
+    # earlier runs.
+    self._rejections = ticket_db.rejections.copy()
+    self._pending = None
+    self._first_added = None
+    # Tickets reusing the key of a pending one, e.g. records arriving after
+    # their ticket was finished, which go to a later file.
+    self._deferred = []
+    # Continue the numbering of files written by earlier runs.
+    matches = filter(None, map(_FOLLOW_FILE_RE.fullmatch, os.listdir(dest)))
+    self._next_number = max((int(m.group(1)) for m in matches),
+                            default=-1) + 1
+
+  def add(self, finished):
+    if self._pending is None:
+      self._pending = ticket.TicketDatabase(self._ticket_db.fqdn_suffix)
+      self._first_added = time.monotonic()
+    if finished.key in self._pending:
+      self._deferred.append(finished)
+    else:
+      self._pending.add(finished)
+
+  def age(self):
+    """Seconds since the oldest pending ticket was added, or 0."""
+    if self._pending is None:
+      return 0
+    return time.monotonic() - self._first_added
 
-def generate_ticket_db(dns_records):
+  def flush(self):
+    """Write the pending tickets, except for deferred ones."""
+    if self._pending is None:
+      return
+    # Each file holds the records rejected since the previous one.
+    self._pending.rejections.update(self._ticket_db.rejections
+                                    - self._rejections)
+    self._rejections = self._ticket_db.rejections.copy()
+    path = os.path.join(self._dest,
+                        _FOLLOW_FILE_FORMAT.format(self._next_number))
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+      ticketfile.save(self._pending, f, metadata={'sources': self._sources})
+    os.replace(temp_path, path)
+    print('Wrote {} tickets into {}.'.format(len(self._pending), path))
+    self._next_number += 1
+    self._pending = None
+    deferred, self._deferred = self._deferred, []
+    for finished in deferred:
+      self.add(finished)
+
+  def close(self):
+    """Write all the pending tickets."""
+    while self._pending is not None:
+      self.flush()
+
+def _dump_filter(args):
+  fqdn_suffix = args.fqdn_suffix or protocol.DEFAULT_FQDN_SUFFIX
+  if not protocol.is_suffix_set(fqdn_suffix):
+    return protocol.normalize_fqdn_suffix(fqdn_suffix)
+  # Every suffix ends with the longest suffix common to all of them.
+  reversed_common = os.path.commonprefix([s[::-1] for s in fqdn_suffix])
+  return reversed_common[::-1] or None
+
+def parse_pcap(capture, args):
+  print('Loading DNS records from capture...')
+  # Records are decoded lazily, so the ticket database is built while reading.
+  return pcap.from_pcap(capture)
+
+def generate_ticket_db(dns_records, args):
   print('Generating ticket database from DNS records...')
-  ticket_db = ticket.TicketDatabase()
-  ticket_db.build_from_records(dns_records)
+  ticket_db = _base_ticket_db(args)
+  if args.pipeline:
+    if args.dedup is not None:
+      dns_records = args.dedup.filter(dns_records, _may_be_query(ticket_db))
+    ticket_db, stats = pipeline.build_ticket_db(dns_records, ticket_db,
+                                                processes=args.jobs)
+    print(stats.report())
+  else:
+    ticket_db.build_from_records(dns_records, processes=args.jobs,
+                                 stats=args.build_stats, dedup=args.dedup)
+  _print_rejections(ticket_db)
   return ticket_db
 
-def pickle_ticket_db(ticket_db):
-  print('Saving ticket database...')
-  # TODO(toukoaozaki): try considering a different format.
-  return pickle.dumps(ticket_db)
+def _may_be_query(ticket_db):
+  # Check of records remembered by args.dedup; see DuplicateFilter.
+  return protocol.QueryParser(ticket_db.fqdn_suffix).may_be_query
+
+def _print_rejections(ticket_db):
+  if ticket_db.rejections:
+    print('Rejected records: {}'.format(', '.join(
+        '{}={}'.format(reason, count)
+        for reason, count in sorted(ticket_db.rejections.items()))))
+
+def build_ticket_db_from_dump(dns_dump, args):
+  if not args.checkpoint:
+    return generate_ticket_db(parse_dns_dump(dns_dump, args), args)
+  start = None
+  if args.resume and os.path.exists(args.checkpoint):
+    print('Resuming from checkpoint...')
+    ticket_db, start = checkpoint.load(args.checkpoint)
+    print('Skipping {} records already applied.'.format(start.num_records))
+  else:
+    ticket_db = _base_ticket_db(args)
+  print('Generating ticket database from DNS records with checkpoints...')
+  try:
+    last = checkpoint.build_from_dump(ticket_db, dns_dump, args.checkpoint,
+                                      interval=args.checkpoint_interval,
+                                      processes=args.jobs,
+                                      contains=_dump_filter(args),
+                                      start=start, stats=args.build_stats,
+                                      dedup=args.dedup)
+  except checkpoint.SourceMismatchError:
+    sys.exit('{} was not saved for this source; remove it to start '
+             'over'.format(args.checkpoint))
+  print('Applied {} records.'.format(last.num_records))
+  _print_rejections(ticket_db)
+  return ticket_db
+
+def save_ticket_db(ticket_db, args):
+  # Returns a function writing into the destination file; see main().
+  def write(destf):
+    print('Saving ticket database...')
+    ticketfile.save(ticket_db, destf,
+                    metadata={'sources': args.applied_sources})
+  return write
+
+def pickle_ticket_db(ticket_db, args):
+  def write(destf):
+    print('Saving ticket database as pickle...')
+    pickle.dump(ticket_db, destf)
+  return write
+
+def load_ticket_db(ticket_db_file, args):
+  if args.base_ticket_db is not None:
+    raise Exception('ticket databases cannot be applied to another')
+  print('Loading ticket database...')
+  reader = ticketfile.TicketFileReader(ticket_db_file)
+  args.applied_sources.extend(_applied_sources(reader))
+  return reader.load()
+
+def _base_ticket_db(args):
+  # Database the records are applied to; see main().
+  if args.base_ticket_db is not None:
+    return args.base_ticket_db
+  return ticket.TicketDatabase(args.fqdn_suffix)
+
+def _normalized_suffix(fqdn_suffix):
+  if protocol.is_suffix_set(fqdn_suffix):
+    return fqdn_suffix
+  return protocol.normalize_fqdn_suffix(
+      fqdn_suffix or protocol.DEFAULT_FQDN_SUFFIX)
+
+def _source_id(source):
+  # Identifies a source in the metadata of databases it has been applied to,
+  # so that it is skipped by later updates, but not once it is replaced by
+  # another file of the same name, e.g. on rotation, or has grown. Entries of
+  # earlier versions are absolute paths, and never match.
+  identity = checkpoint.SourceIdentity.of_path(source)
+  return {'path': os.path.abspath(source), 'size': os.path.getsize(source),
+          'head_length': identity.head_length,
+          'head_digest': identity.head_digest}
+
+def _applied_sources(reader):
+  metadata = reader.metadata
+  if isinstance(metadata, dict):
+    return metadata.get('sources', [])
+  return []
+
+def write_sessions(ticket_db, args):
+  print('Writing socket sessions...')
+  os.makedirs(args.dest, exist_ok=True)
+  results = socket.reconstruct_sessions(ticket_db, args.dest,
+                                        processes=args.jobs)
+  print('Wrote {} sessions; {} tickets without responses.'.format(
+      len(results), sum(r.incomplete_tickets for r in results)))
 
 def compute_conversion_path(input_type, output_type):
   """Compute series of transformation for converting input to output."""
@@ -89,6 +482,9 @@ def compute_conversion_path(input_type, output_type):
   while queue:
     node_type = queue.pop()
     for next_type in adjacency_list[node_type]:
+      if next_type in prev or next_type == input_type:
+        # Already reached with fewer steps.
+        continue
       prev[next_type] = node_type
       if next_type == output_type:
         queue.clear()
@@ -119,18 +515,74 @@ def compute_conversion_path(input_type, output_type):
 
 def main():
   args = parse_args()
-  src_type = deduce_src_type(args.src_type)
+  sources = [(source, deduce_src_type(args.src_type, source))
+             for source in args.sources]
   dest_type = deduce_dest_type(args.dest_type)
-  conversion_path = compute_conversion_path(src_type, dest_type)
-  src_mode = 'rb' if is_binary_type(src_type) else 'rt'
+  if args.checkpoint and sources[0][1] != 'dns_dump':
+    sys.exit('--checkpoint is only supported for DNS dumps')
+  if args.follow and sources[0][1] != 'dns_dump':
+    sys.exit('--follow is only supported for DNS dumps')
+  # Transformers apply records to args.base_ticket_db, and save_ticket_db
+  # records args.applied_sources, so that they are skipped on later updates.
+  args.base_ticket_db = None
+  args.applied_sources = []
+  args.build_stats = ticket.BuildStats() if args.stats_json else None
+  args.dedup = (protocol.DuplicateFilter(args.dedup_size)
+                if args.dedup_size > 0 else None)
+  if args.follow:
+    follow_dump(args.sources[0], args)
+    return
+  if args.update and os.path.exists(args.dest):
+    if dest_type != 'ticket_db':
+      sys.exit('--update requires a ticket_db destination')
+    print('Loading ticket database to be updated...')
+    with open(args.dest, mode='rb') as destf:
+      reader = ticketfile.TicketFileReader(destf)
+      args.applied_sources.extend(_applied_sources(reader))
+      args.base_ticket_db = reader.load()
+    if (args.fqdn_suffix is not None
+        and _normalized_suffix(args.base_ticket_db.fqdn_suffix)
+            != _normalized_suffix(args.fqdn_suffix)):
+      sys.exit('--fqdn_suffix differs from that of the ticket database '
+               'being updated')
+
+  for source, src_type in sources:
+    source_id = _source_id(source)
+    if source_id in args.applied_sources:
+      print('Skipping {}, which has already been applied.'.format(source))
+      continue
+    src_mode = 'rb' if is_binary_type(src_type) else 'rt'
+    with open(source, mode=src_mode) as srcf:
+      last_data = srcf
+      # Apply series of steps
+      for transform in compute_conversion_path(src_type, '__ticket_db'):
+        last_data = transform(last_data, args)
+    args.base_ticket_db = last_data
+    args.applied_sources.append(source_id)
+  if args.dedup is not None and args.dedup.hit_rate is not None:
+    print('Suppressed {} duplicate records; hit rate {:.1%}.'.format(
+        args.dedup.hits, args.dedup.hit_rate))
+  if args.stats_json:
+    with open(args.stats_json, 'w') as statsf:
+      json.dump(args.build_stats.as_dict(), statsf, indent=2)
+  if args.base_ticket_db is None:
+    # Nothing to be written.
+    return
+
+  last_data = args.base_ticket_db
+  for transform in compute_conversion_path('__ticket_db', dest_type):
+    last_data = transform(last_data, args)
+  if is_directory_type(dest_type):
+    # Written by the last step.
+    return
   dest_mode = 'wb' if is_binary_type(dest_type) else 'wt'
-  with open(args.source, mode=src_mode) as srcf:
-    last_data = srcf
-    # Apply series of steps
-    for transform in conversion_path:
-      last_data = transform(last_data)
-    with open(args.dest, mode=dest_mode) as destf:
-      destf.write(last_data)
+  # Write into a temporary file first, so that a failure does not destroy the
+  # database being updated. The last step returns a function writing into
+  # the file, rather than the contents, so that they are not buffered.
+  temp_dest = args.dest + '.tmp'
+  with open(temp_dest, mode=dest_mode) as destf:
+    last_data(destf)
+  os.replace(temp_dest, args.dest)
 
 if __name__ == '__main__':
   main()
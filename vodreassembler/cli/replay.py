@@ -0,0 +1,55 @@
+"""Command line tool for replaying DNS dumps to vodserve.
+
+Lines of a DNS dump are sent at a controlled rate over UDP or a unix socket,
+standing in for a resolver streaming its query log, e.g. to load test the
+throughput and latency of vodserve.
+"""
+
+import argparse
+from vodreassembler import ingest
+from vodreassembler.cli import serve
+
+def parse_args():
+  parser = argparse.ArgumentParser(
+      description='Send the lines of a DNS dump over UDP or a unix socket.')
+  parser.add_argument('source', metavar='src', type=str,
+                      help='DNS dump to be sent.')
+  target = parser.add_mutually_exclusive_group(required=True)
+  target.add_argument('--udp', metavar='HOST:PORT',
+                      type=serve.parse_host_port,
+                      help='Send datagrams to HOST:PORT.')
+  target.add_argument('--unix', metavar='PATH', type=str,
+                      help='Send a stream to the unix socket at PATH.')
+  parser.add_argument('--rate', metavar='N', type=float,
+                      help='Lines sent per second. Default is as fast as '
+                           'possible.')
+  parser.add_argument('--send_size', metavar='BYTES', type=int,
+                      default=ingest.DEFAULT_SEND_SIZE,
+                      help='Maximum number of bytes sent at once. Default is '
+                           '{}.'.format(ingest.DEFAULT_SEND_SIZE))
+  parser.add_argument('--repeat', metavar='N', type=int, default=1,
+                      help='Number of times the dump is sent. Default is 1.')
+  args = parser.parse_args()
+  if args.rate is not None and args.rate <= 0:
+    parser.error('--rate must be positive')
+  if args.repeat < 1:
+    parser.error('--repeat must be positive')
+  return args
+
+def _lines(source, repeat):
+  for _ in range(repeat):
+    with open(source, 'rb') as srcf:
+      yield from srcf
+
+def main():
+  args = parse_args()
+  address = args.unix if args.unix is not None else args.udp
+  stats = ingest.replay(_lines(args.source, args.repeat), address,
+                        rate=args.rate, send_size=args.send_size)
+  rate = stats.rate
+  print('Sent {} lines ({} bytes) in {} sends over {:.3f}s, {} lines/s.'.format(
+      stats.records, stats.bytes, stats.sends, stats.elapsed,
+      '-' if rate is None else '{:.0f}'.format(rate)))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,142 @@
+"""Command line tool for building a ticket database from live DNS records.
+
+DNS records are received in the format of DNS dumps over UDP or a unix socket,
+e.g. from the query log of a resolver, and applied to a ticket database which
+is saved periodically and when interrupted.
+"""
+
+import argparse
+import asyncio
+import os
+import signal
+import time
+from vodreassembler import ingest, protocol, ticket, ticketfile
+
+DEFAULT_SAVE_INTERVAL = 60.0
+
+def parse_args():
+  parser = argparse.ArgumentParser(
+      description='Build a VPN-over-DNS ticket database from DNS records '
+                  'received over UDP or a unix socket.')
+  parser.add_argument('dest', metavar='dest', type=str,
+                      help='Destination file for the ticket database.')
+  parser.add_argument('--udp', metavar='HOST:PORT', type=parse_host_port,
+                      help='Receive datagrams of DNS dump lines on HOST:PORT.')
+  parser.add_argument('--unix', metavar='PATH', type=str,
+                      help='Receive streams of DNS dump lines on a unix '
+                           'socket created at PATH.')
+  parser.add_argument('--fqdn_suffix', metavar='SUFFIX', action='append',
+                      help='FQDN suffix of the queries. May be repeated, in '
+                           'which case tickets are keyed by suffix and id. '
+                           'Default is {}.'.format(
+                               protocol.DEFAULT_FQDN_SUFFIX))
+  parser.add_argument('--update', action='store_true',
+                      help='Apply the records on top of the ticket database '
+                           'in dest, if it exists, with its FQDN suffix.')
+  parser.add_argument('--batch_size', metavar='N', type=int,
+                      default=ingest.DEFAULT_BATCH_SIZE,
+                      help='Number of lines collected before they are '
+                           'parsed and applied at once. Default is {}.'.format(
+                               ingest.DEFAULT_BATCH_SIZE))
+  parser.add_argument('--max_delay', metavar='SECONDS', type=float,
+                      default=ingest.DEFAULT_MAX_DELAY,
+                      help='Maximum time a record waits for its batch to '
+                           'fill. Default is {}.'.format(
+                               ingest.DEFAULT_MAX_DELAY))
+  parser.add_argument('--queue_size', metavar='N', type=int,
+                      default=ingest.DEFAULT_QUEUE_SIZE,
+                      help='Maximum number of datagrams or reads waiting to '
+                           'be applied. Beyond it, unix socket senders are '
+                           'blocked and datagrams dropped. Default is '
+                           '{}.'.format(ingest.DEFAULT_QUEUE_SIZE))
+  parser.add_argument('--save_interval', metavar='SECONDS', type=float,
+                      default=DEFAULT_SAVE_INTERVAL,
+                      help='Minimum time between saves of the ticket '
+                           'database. Default is {}.'.format(
+                               DEFAULT_SAVE_INTERVAL))
+  args = parser.parse_args()
+  if args.udp is None and args.unix is None:
+    parser.error('at least one of --udp and --unix is required')
+  if args.batch_size < 1 or args.queue_size < 1:
+    parser.error('--batch_size and --queue_size must be positive')
+  if args.update and args.fqdn_suffix is not None:
+    parser.error('--fqdn_suffix cannot be used with --update')
+  if args.fqdn_suffix is not None:
+    if len(args.fqdn_suffix) == 1:
+      args.fqdn_suffix = protocol.normalize_fqdn_suffix(args.fqdn_suffix[0])
+    else:
+      args.fqdn_suffix = protocol.normalize_fqdn_suffixes(args.fqdn_suffix)
+  return args
+
+def parse_host_port(value):
+  host, sep, port = value.rpartition(':')
+  if not sep or not port.isdigit():
+    raise argparse.ArgumentTypeError('expected HOST:PORT')
+  return host.strip('[]') or '0.0.0.0', int(port)
+
+def save_ticket_db(ticket_db, dest):
+  # Written into a temporary file first, so that readers never see a partial
+  # database.
+  temp_dest = dest + '.tmp'
+  with open(temp_dest, 'wb') as destf:
+    ticketfile.save(ticket_db, destf)
+  os.replace(temp_dest, dest)
+
+class _PeriodicSaver:
+  """Saves the ticket database at most every interval seconds."""
+  def __init__(self, dest, interval):
+    self._dest = dest
+    self._interval = interval
+    self._last_saved = time.monotonic()
+
+  def __call__(self, ticket_db):
+    if time.monotonic() - self._last_saved >= self._interval:
+      save_ticket_db(ticket_db, self._dest)
+      self._last_saved = time.monotonic()
+
+async def serve(ticket_db, args):
+  """Receive records until SIGINT or SIGTERM, and return the statistics."""
+  # Lines without the suffix cannot be parsed, and are skipped while reading.
+  contains = None
+  if not protocol.is_suffix_set(ticket_db.fqdn_suffix):
+    contains = protocol.normalize_fqdn_suffix(
+        ticket_db.fqdn_suffix or protocol.DEFAULT_FQDN_SUFFIX)
+  server = ingest.IngestServer(
+      ticket_db, batch_size=args.batch_size, max_delay=args.max_delay,
+      queue_size=args.queue_size, contains=contains,
+      on_applied=_PeriodicSaver(args.dest, args.save_interval))
+  stopped = asyncio.Event()
+  loop = asyncio.get_running_loop()
+  for signum in (signal.SIGINT, signal.SIGTERM):
+    loop.add_signal_handler(signum, stopped.set)
+  try:
+    if args.udp is not None:
+      host, port = await server.start_udp(*args.udp)
+      print('Receiving datagrams on {}:{}...'.format(host, port))
+    if args.unix is not None:
+      await server.start_unix(args.unix)
+      print('Receiving streams on {}...'.format(args.unix))
+    await stopped.wait()
+    print('Interrupted; applying queued records...')
+  finally:
+    await server.close()
+    if args.unix is not None and os.path.exists(args.unix):
+      os.unlink(args.unix)
+  return server.stats
+
+def main():
+  args = parse_args()
+  ticket_db = None
+  if args.update and os.path.exists(args.dest):
+    print('Loading ticket database to be updated...')
+    with open(args.dest, mode='rb') as destf:
+      ticket_db = ticketfile.TicketFileReader(destf).load()
+  if ticket_db is None:
+    ticket_db = ticket.TicketDatabase(args.fqdn_suffix)
+  stats = asyncio.run(serve(ticket_db, args))
+  print(stats.report())
+  save_ticket_db(ticket_db, args.dest)
+  print('Saved {} tickets into {}.'.format(len(ticket_db), args.dest))
+
+if __name__ == '__main__':
+  main()
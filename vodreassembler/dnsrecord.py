@@ -1,6 +1,13 @@
 """Functions and classes for reading DNS records."""
 
 import collections
+import os
+import time
+
+# Number of bytes read at once by the bulk loaders.
+DEFAULT_BLOCK_SIZE = 1 << 20
+# Seconds between checks for new data by follow_dump().
+DEFAULT_POLL_INTERVAL = 1.0
 
 
 class DnsRecord(collections.namedtuple('DnsRecord',
@@ -8,6 +15,39 @@ class DnsRecord(collections.namedtuple('DnsRecord',
   pass
 
 
+class DnsRecordColumns(collections.namedtuple('DnsRecordColumns',
+                                              ['fqdns', 'classes', 'types',
+                                               'values'])):
+  """Batch of DNS records in columnar form, as parallel lists of fields."""
+
+  def records(self):
+    """Return the list of DnsRecord objects."""
+    return list(map(DnsRecord, self.fqdns, self.classes, self.types,
+                    self.values))
+
+
+class FollowPosition(object):
+  """Position of follow_dump() in the dump it follows.
+
+  follow_dump() updates it in place after all the records of a block have been
+  yielded, so it is exact whenever a heartbeat is yielded.
+
+  Attributes:
+    inode (tuple): (st_dev, st_ino) of the file being read, or None.
+    offset (int): Position in that file right after the lines read so far.
+    num_records (int): Number of records yielded so far, over all files.
+  """
+
+  def __init__(self, inode=None, offset=0, num_records=0):
+    self.inode = inode
+    self.offset = offset
+    self.num_records = num_records
+
+  def __repr__(self):
+    return 'FollowPosition(inode={!r}, offset={!r}, num_records={!r})'.format(
+        self.inode, self.offset, self.num_records)
+
+
 def from_dump(src, filt=None):
   """Read DNS records from DNS record dump."""
   filt = filt or (lambda x: True)
@@ -18,3 +58,238 @@ def from_dump(src, filt=None):
     record = DnsRecord(*l.split())
     if filt(record):
       yield record
+
+
+def from_dump_batches(src, contains=None, block_size=DEFAULT_BLOCK_SIZE,
+                      encoding='utf-8'):
+  """Read DNS records from DNS record dump in batches.
+
+  See from_dump_columns() for arguments.
+
+  Yields:
+    Non-empty lists of DnsRecord objects.
+  """
+  for columns in from_dump_columns(src, contains, block_size, encoding):
+    yield columns.records()
+
+
+def from_dump_columns(src, contains=None, block_size=DEFAULT_BLOCK_SIZE,
+                      encoding='utf-8'):
+  """Read DNS records from DNS record dump in columnar batches.
+
+  The dump is read in large blocks. If contains is provided, lines without it
+  are skipped by a byte-level search before being decoded, so they never
+  become Python objects. Empty lines are skipped.
+
+  Args:
+    src: binary file object of the dump.
+    contains (str, optional): Only read lines containing this string, e.g. the
+      FQDN suffix of interest.
+    block_size (int, optional): Number of bytes to read at once.
+    encoding (str, optional): Encoding of the dump.
+
+  Yields:
+    Non-empty DnsRecordColumns objects, one per block.
+  """
+  for columns, _ in _read_dump_blocks(src, contains, block_size, encoding):
+    if columns:
+      yield columns
+
+
+def from_dump_blocks(src, contains=None, block_size=DEFAULT_BLOCK_SIZE,
+                     encoding='utf-8'):
+  """Read DNS records from DNS record dump, along with positions in the dump.
+
+  See from_dump_columns() for arguments. Reading can be resumed by seeking src
+  to one of the offsets yielded, and calling this function again.
+
+  Yields:
+    (records, offset) tuples, where records is a possibly empty list of
+    DnsRecord objects, and offset is the position in src right after the
+    lines the records were read from.
+  """
+  for columns, offset in _read_dump_blocks(src, contains, block_size,
+                                           encoding):
+    yield (columns.records() if columns else []), offset
+
+
+def follow_dump(path, contains=None, poll_interval=DEFAULT_POLL_INTERVAL,
+                block_size=DEFAULT_BLOCK_SIZE, encoding='utf-8',
+                sleep=time.sleep, clock=time.monotonic, position=None):
+  """Read DNS records from a dump file which keeps growing, like tail -F.
+
+  Records already in the file are read first, and records appended later are
+  read as they appear. A line is only read once its newline is written, so
+  that records being written are never split.
+
+  Rotation of the file is detected by polling path. If path is replaced by a
+  new file, the rest of the old file is read before switching to the new one.
+  If the file is truncated in place, it is read again from the start; only
+  truncation below the position read so far can be detected.
+
+  None is yielded as a heartbeat whenever no new data is available, before
+  waiting, and between blocks at least every poll_interval while data keeps
+  coming, so that consumers can act on time whether or not the dump is idle;
+  see ticket.TicketDatabase.stream_from_records(). The generator never ends
+  by itself.
+
+  Args:
+    path (str): Path of the dump.
+    contains (str, optional): Only read lines containing this string; see
+      from_dump_columns().
+    poll_interval (float, optional): Seconds to wait for new data, and
+      between heartbeats.
+    block_size (int, optional): Maximum number of bytes read at once.
+    encoding (str, optional): Encoding of the dump.
+    sleep (callable, optional): Called with poll_interval to wait.
+    clock (callable, optional): Returns the current time in seconds.
+    position (FollowPosition, optional): Updated as the dump is read. If its
+      inode is the one of path, reading starts at its offset, e.g. to resume
+      where a previous run stopped; otherwise, it starts at the beginning.
+
+  Yields:
+    DnsRecord objects, or None as heartbeats.
+
+  Raises:
+    FileNotFoundError: If path does not exist initially.
+  """
+  needle = contains.encode(encoding) if contains is not None else None
+  if position is None:
+    position = FollowPosition()
+  src = open(path, 'rb')
+  try:
+    inode = _inode(src)
+    if inode == position.inode and position.offset <= os.fstat(
+        src.fileno()).st_size:
+      src.seek(position.offset)
+    else:
+      position.inode, position.offset = inode, 0
+    remainder = b''
+    last_heartbeat = clock()
+    while True:
+      data = src.read(block_size)
+      if data:
+        data = remainder + data
+        cut = data.rfind(b'\n') + 1
+        remainder = data[cut:]
+        yield from _follow_records(_select_lines(data, cut, needle), encoding,
+                                   position)
+        position.offset = src.tell() - len(remainder)
+        if clock() - last_heartbeat >= poll_interval:
+          last_heartbeat = clock()
+          yield None
+        continue
+      rotation = _check_rotation(path, src)
+      if rotation == 'replaced':
+        # Data may have been appended since the last read. The writer has
+        # moved on to the new file, so the last line of the old one will
+        # never be completed.
+        data = remainder + src.read()
+        yield from _follow_records(_select_lines(data, len(data), needle),
+                                   encoding, position)
+        src.close()
+        src = open(path, 'rb')
+        position.inode, position.offset = _inode(src), 0
+        remainder = b''
+        continue
+      elif rotation == 'truncated':
+        src.seek(0)
+        position.offset = 0
+        remainder = b''
+        continue
+      last_heartbeat = clock()
+      yield None
+      sleep(poll_interval)
+  finally:
+    src.close()
+
+
+def _follow_records(lines, encoding, position):
+  records = _records(lines, encoding)
+  yield from records
+  position.num_records += len(records)
+
+
+def _inode(src):
+  src_stat = os.fstat(src.fileno())
+  return (src_stat.st_dev, src_stat.st_ino)
+
+
+def _check_rotation(path, src):
+  # Return 'replaced' if path is a different file than src, 'truncated' if
+  # it is shorter than what has been read, or None.
+  try:
+    path_stat = os.stat(path)
+  except FileNotFoundError:
+    # Moved away, and the new file is not created yet.
+    return None
+  src_stat = os.fstat(src.fileno())
+  if (path_stat.st_ino, path_stat.st_dev) != (src_stat.st_ino,
+                                               src_stat.st_dev):
+    return 'replaced'
+  if path_stat.st_size < src.tell():
+    return 'truncated'
+  return None
+
+
+def _records(lines, encoding):
+  columns = _parse_lines(lines, encoding)
+  return columns.records() if columns else []
+
+
+def _read_dump_blocks(src, contains, block_size, encoding):
+  needle = contains.encode(encoding) if contains is not None else None
+  try:
+    offset = src.tell()
+  except (AttributeError, OSError):
+    # Offsets are relative to the current position for unseekable files.
+    offset = 0
+  remainder = b''
+  while True:
+    data = src.read(block_size)
+    if not data:
+      break
+    data = remainder + data
+    cut = data.rfind(b'\n') + 1
+    remainder = data[cut:]
+    offset += cut
+    yield _parse_lines(_select_lines(data, cut, needle), encoding), offset
+  if remainder:
+    offset += len(remainder)
+    yield _parse_lines(_select_lines(remainder, len(remainder), needle),
+                       encoding), offset
+
+
+def _select_lines(data, end, needle):
+  """Return lines within data[:end] containing needle."""
+  if needle is None:
+    return data[:end].splitlines()
+  lines = []
+  pos = data.find(needle, 0, end)
+  while pos != -1:
+    line_start = data.rfind(b'\n', 0, pos) + 1
+    line_end = data.find(b'\n', pos, end)
+    if line_end == -1:
+      line_end = end
+    lines.append(data[line_start:line_end])
+    pos = data.find(needle, line_end, end)
+  return lines
+
+
+def _parse_lines(lines, encoding):
+  if not lines:
+    return None
+  # Split all lines at once, with a separator token between lines. If every
+  # line has four fields, every fifth token must be the separator.
+  fields = b'\n\0\n'.join(lines).decode(encoding).split()
+  if (len(fields) == 5 * len(lines) - 1
+      and fields[4::5] == ['\0'] * (len(lines) - 1)):
+    return DnsRecordColumns(fields[0::5], fields[1::5], fields[2::5],
+                            fields[3::5])
+  # Some lines are empty or malformed; fall back to splitting every line.
+  records = [DnsRecord(*fields)
+             for fields in (line.decode(encoding).split() for line in lines)
+             if fields]
+  if not records:
+    return None
+  return DnsRecordColumns(*map(list, zip(*records)))
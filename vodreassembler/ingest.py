@@ -0,0 +1,428 @@
+"""Live ingestion of DNS records over UDP or unix sockets.
+
+Resolvers can stream their query logs to IngestServer instead of writing them
+to disk. Records are sent as lines in the format of DNS dumps (see
+dnsrecord.from_dump()):
+
+  UDP: every datagram holds one or more complete lines.
+  unix: every connection carries a stream of lines.
+
+Received data is queued as it is, and parsed and applied to a ticket database
+in batches by a single worker thread, so that receiving goes on while a batch
+is processed. The queue is bounded. Once it is full, reading from connections pauses, which
+blocks their senders, while datagrams are dropped and counted, as UDP has no
+flow control.
+
+replay() sends a dump at a controlled rate, standing in for a resolver in load
+tests.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import io
+import itertools
+import socket
+import time
+from vodreassembler import dnsrecord
+
+DEFAULT_BATCH_SIZE = 4096
+# Seconds a received record may wait for its batch to fill.
+DEFAULT_MAX_DELAY = 0.5
+# Maximum number of datagrams or reads waiting to be applied.
+DEFAULT_QUEUE_SIZE = 256
+# Maximum bytes sent at once by replay(), which fits a datagram into the MTU
+# of common links.
+DEFAULT_SEND_SIZE = 1400
+
+_READ_SIZE = 1 << 16
+
+
+class IngestStats:
+  """Statistics of an IngestServer.
+
+  Latencies are measured from receiving a record to having it applied, and
+  thus include the time spent waiting in the queue and for the batch to fill.
+
+  Attributes:
+    received_lines (int): Number of lines received and queued.
+    received_bytes (int): Number of bytes received, including dropped ones.
+    dropped_datagrams (int): Datagrams dropped, because the queue was full.
+    malformed_lines (int): Lines which are not DNS records.
+    batches (int): Number of batches applied.
+    applied_records (int): Number of records applied.
+    apply_time (float): Seconds spent parsing and applying batches.
+    max_latency (float): Longest latency of a record.
+    failed_batches (int): Batches whose processing raised, including those
+      applied but not saved by on_applied of IngestServer.
+    failed_lines (int): Number of lines in the failed batches.
+    last_error (Exception): Error raised by the last failed batch, or None.
+  """
+  def __init__(self):
+    self.received_lines = 0
+    self.received_bytes = 0
+    self.dropped_datagrams = 0
+    self.malformed_lines = 0
+    self.batches = 0
+    self.applied_records = 0
+    self.apply_time = 0.0
+    self.max_latency = 0.0
+    self.failed_batches = 0
+    self.failed_lines = 0
+    self.last_error = None
+    self._total_latency = 0.0
+
+  def add_batch(self, received_times, num_records, malformed_lines,
+                applied_at, apply_time):
+    self.batches += 1
+    self.apply_time += apply_time
+    self.malformed_lines += malformed_lines
+    for received_at, count in zip(received_times, num_records):
+      latency = applied_at - received_at
+      self.applied_records += count
+      self._total_latency += latency * count
+      self.max_latency = max(self.max_latency, latency)
+
+  def add_failure(self, num_lines, error):
+    self.failed_batches += 1
+    self.failed_lines += num_lines
+    self.last_error = error
+
+  @property
+  def mean_latency(self):
+    """Mean latency of the applied records, or None if none were applied."""
+    if not self.applied_records:
+      return None
+    return self._total_latency / self.applied_records
+
+  @property
+  def throughput(self):
+    """Records applied per second of processing, or None if idle."""
+    if not self.apply_time:
+      return None
+    return self.applied_records / self.apply_time
+
+  def report(self):
+    """Return a human-readable summary."""
+    mean_latency = self.mean_latency
+    throughput = self.throughput
+    lines = [
+        'Received {} lines ({} bytes); dropped {} datagrams, {} malformed '
+        'lines'.format(self.received_lines, self.received_bytes,
+                       self.dropped_datagrams, self.malformed_lines),
+        'Applied {} records in {} batches, {} records/s'.format(
+            self.applied_records, self.batches,
+            '-' if throughput is None else '{:.0f}'.format(throughput)),
+        'Latency mean {} max {:.3f}s'.format(
+            '-' if mean_latency is None else '{:.3f}s'.format(mean_latency),
+            self.max_latency),
+    ]
+    if self.failed_batches:
+      lines.append('Failed {} batches ({} lines); last error: {}'.format(
+          self.failed_batches, self.failed_lines, self.last_error))
+    return '\n'.join(lines)
+
+
+class IngestServer:
+  """Applies DNS records received over sockets to a ticket database.
+
+  The server runs in an asyncio event loop, e.g. ::
+
+    server = ingest.IngestServer(ticket_db)
+    await server.start_udp('127.0.0.1', 5300)
+    await server.start_unix('/run/vod.sock')
+    ...
+    await server.close()
+
+  The database must not be accessed by others until close() returns, except
+  from on_applied.
+  """
+  def __init__(self, ticket_db, batch_size=DEFAULT_BATCH_SIZE,
+               max_delay=DEFAULT_MAX_DELAY, queue_size=DEFAULT_QUEUE_SIZE,
+               contains=None, on_applied=None):
+    """Create a server; nothing is received until started.
+
+    Args:
+      ticket_db (ticket.TicketDatabase): Database the records are applied to.
+      batch_size (int, optional): Number of lines collected before they are
+        parsed and applied at once. Smaller batches are applied once their
+        first line has waited max_delay.
+      max_delay (float, optional): Seconds a record may wait for its batch to
+        fill.
+      queue_size (int, optional): Maximum number of datagrams or reads waiting
+        to be applied.
+      contains (str, optional): Only read lines containing this string; see
+        dnsrecord.from_dump_columns().
+      on_applied (callable, optional): Called with ticket_db after every
+        batch, in the worker thread applying the batches, e.g. to save it.
+        Exceptions raised by it, or by applying a batch, are counted in
+        stats, and the server goes on with the next batch.
+    """
+    self.ticket_db = ticket_db
+    self.stats = IngestStats()
+    self._batch_size = batch_size
+    self._max_delay = max_delay
+    self._queue_size = queue_size
+    self._contains = contains
+    self._on_applied = on_applied
+    self._queue = None
+    self._executor = None
+    self._apply_task = None
+    self._transports = []
+    self._servers = []
+    self._connections = set()
+
+  def _ensure_started(self):
+    if self._queue is None:
+      self._queue = asyncio.Queue(self._queue_size)
+      self._executor = concurrent.futures.ThreadPoolExecutor(1)
+      self._apply_task = asyncio.ensure_future(self._apply_loop())
+
+  async def start_udp(self, host, port):
+    """Receive datagrams on host and port.
+
+    Returns:
+      The bound (host, port), e.g. to find the port if 0 is given.
+    """
+    self._ensure_started()
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: _DatagramProtocol(self), local_addr=(host, port))
+    self._transports.append(transport)
+    return transport.get_extra_info('sockname')[:2]
+
+  async def start_unix(self, path):
+    """Accept stream connections on a unix socket at path."""
+    self._ensure_started()
+    self._servers.append(
+        await asyncio.start_unix_server(self._handle_connection, path))
+
+  async def close(self):
+    """Stop receiving, and wait until all queued records are applied."""
+    if self._queue is None:
+      return
+    for transport in self._transports:
+      transport.close()
+    for server in self._servers:
+      server.close()
+      await server.wait_closed()
+    for task in self._connections:
+      task.cancel()
+    await asyncio.gather(*self._connections, return_exceptions=True)
+    if not self._apply_task.done():
+      await self._queue.put(None)
+    # Raises if the apply loop has died, rather than waiting for it forever.
+    await self._apply_task
+    self._executor.shutdown()
+    self._queue = None
+
+  async def _handle_connection(self, reader, writer):
+    task = asyncio.current_task()
+    self._connections.add(task)
+    remainder = b''
+    try:
+      while True:
+        data = await reader.read(_READ_SIZE)
+        if not data:
+          break
+        self.stats.received_bytes += len(data)
+        data = remainder + data
+        cut = data.rfind(b'\n') + 1
+        remainder = data[cut:]
+        if cut:
+          # Waiting for room in the queue stops reading, and thereby the
+          # sender once the socket buffers are full.
+          await self._put(data[:cut])
+      if remainder:
+        await self._put(remainder)
+    finally:
+      writer.close()
+      self._connections.discard(task)
+
+  async def _put(self, data):
+    await self._queue.put(self._queue_item(data))
+
+  def _put_datagram(self, data):
+    self.stats.received_bytes += len(data)
+    if self._queue.full():
+      self.stats.dropped_datagrams += 1
+      return
+    self._queue.put_nowait(self._queue_item(data))
+
+  def _queue_item(self, data):
+    # Data is parsed in the worker thread; only its lines are counted here,
+    # which is done without leaving C.
+    num_lines = data.count(b'\n')
+    if data and not data.endswith(b'\n'):
+      num_lines += 1
+    self.stats.received_lines += num_lines
+    return (data, time.monotonic(), num_lines)
+
+  async def _apply_loop(self):
+    loop = asyncio.get_running_loop()
+    # (data, time received, number of lines) tuples of the batch being filled.
+    pending = []
+    num_pending = 0
+    closing = False
+    while not closing:
+      timeout = None
+      if pending:
+        timeout = max(0.0,
+                      pending[0][1] + self._max_delay - time.monotonic())
+      try:
+        item = await asyncio.wait_for(self._queue.get(), timeout)
+      except asyncio.TimeoutError:
+        item = ()
+      if item is None:
+        closing = True
+      elif item:
+        pending.append(item)
+        num_pending += item[2]
+      if pending and (closing or num_pending >= self._batch_size
+                      or time.monotonic() - pending[0][1] >= self._max_delay):
+        try:
+          num_records, malformed_lines, applied_at, apply_time = (
+              await loop.run_in_executor(self._executor, self._apply,
+                                         pending))
+        except Exception as e:
+          # Carry on with the next batch, so that the queue keeps draining and
+          # senders are never blocked for good, e.g. while on_applied cannot
+          # save to a full disk.
+          self.stats.add_failure(num_pending, e)
+        else:
+          self.stats.add_batch([received_at for _, received_at, _ in pending],
+                               num_records, malformed_lines, applied_at,
+                               apply_time)
+        pending = []
+        num_pending = 0
+
+  def _apply(self, items):
+    # Runs in the worker thread, and returns the statistics of the batch, so
+    # that they are only updated in the event loop.
+    start = time.perf_counter()
+    parsed = [_parse(data, self._contains) for data, _, _ in items]
+    self.ticket_db.build_from_records(
+        itertools.chain.from_iterable(records for records, _ in parsed))
+    apply_time = time.perf_counter() - start
+    applied_at = time.monotonic()
+    if self._on_applied is not None:
+      self._on_applied(self.ticket_db)
+    return ([len(records) for records, _ in parsed],
+            sum(malformed for _, malformed in parsed), applied_at, apply_time)
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+  def __init__(self, server):
+    self._server = server
+
+  def datagram_received(self, data, addr):
+    self._server._put_datagram(data)
+
+
+def _parse(data, contains):
+  # Returns the records in data, and the number of malformed lines skipped.
+  try:
+    return _read_records(data, contains), 0
+  except (TypeError, UnicodeDecodeError):
+    pass
+  # Skip malformed lines, rather than everything received with them.
+  records = []
+  malformed = 0
+  for line in data.splitlines():
+    try:
+      records += _read_records(line, contains)
+    except (TypeError, UnicodeDecodeError):
+      malformed += 1
+  return records, malformed
+
+
+def _read_records(data, contains):
+  return list(itertools.chain.from_iterable(
+      dnsrecord.from_dump_batches(io.BytesIO(data), contains=contains)))
+
+
+class ReplayStats(collections.namedtuple('ReplayStats', [
+    'records', 'bytes', 'sends', 'elapsed'])):
+  """Result of replay().
+
+  Attributes:
+    records (int): Number of lines sent.
+    bytes (int): Number of bytes sent.
+    sends (int): Number of datagrams, or writes to the unix socket.
+    elapsed (float): Seconds from the first send to the last.
+  """
+
+  @property
+  def rate(self):
+    """Lines sent per second, or None if nothing was sent."""
+    if not self.elapsed:
+      return None
+    return self.records / self.elapsed
+
+
+def replay(lines, address, rate=None, send_size=DEFAULT_SEND_SIZE,
+           clock=time.monotonic, sleep=time.sleep):
+  """Send lines of a DNS dump to an IngestServer at a controlled rate.
+
+  Lines are packed into sends of up to send_size bytes, unless sending them
+  as they are due requires smaller ones.
+
+  Args:
+    lines: iterable of lines of a dump as bytes, e.g. a dump file opened in
+      binary mode. Empty lines are skipped.
+    address: (host, port) tuple to send datagrams to, or the path of a unix
+      socket to connect to.
+    rate (float, optional): Lines sent per second. Lines are sent as fast as
+      possible if not provided.
+    send_size (int, optional): Maximum number of bytes sent at once, unless a
+      single line is longer.
+    clock (callable, optional): Returns the current time in seconds.
+    sleep (callable, optional): Called with the seconds to wait.
+
+  Returns:
+    ReplayStats.
+  """
+  if isinstance(address, str):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    send = sock.sendall
+  else:
+    # The family follows the host, e.g. '::1' for IPv6.
+    family, _, _, _, sockaddr = socket.getaddrinfo(
+        address[0], address[1], type=socket.SOCK_DGRAM)[0]
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    send = lambda data: sock.sendto(data, sockaddr)
+  buffer = []
+  buffer_size = 0
+  num_records = num_bytes = num_sends = 0
+  start = clock()
+
+  def flush():
+    nonlocal buffer, buffer_size, num_bytes, num_sends
+    if buffer:
+      data = b''.join(buffer)
+      send(data)
+      num_bytes += len(data)
+      num_sends += 1
+      buffer = []
+      buffer_size = 0
+
+  with sock:
+    for line in lines:
+      line = line.strip()
+      if not line:
+        continue
+      line += b'\n'
+      if rate:
+        wait = start + num_records / rate - clock()
+        if wait > 0:
+          # Send what is due before waiting.
+          flush()
+          sleep(wait)
+      if buffer_size + len(line) > send_size:
+        flush()
+      buffer.append(line)
+      buffer_size += len(line)
+      num_records += 1
+    flush()
+  return ReplayStats(num_records, num_bytes, num_sends, clock() - start)
@@ -0,0 +1,334 @@
+"""Functions for reading DNS records from packet captures.
+
+Both pcap and pcapng files are supported. DNS responses carried over UDP are
+decoded, and their A record answers are returned as dnsrecord.DnsRecord
+objects, the same as dnsrecord.from_dump() does for text dumps.
+"""
+
+import struct
+from vodreassembler import dnsrecord
+
+DNS_PORT = 53
+
+# Magic numbers of pcap files, mapped to (byte order, timestamp resolution).
+_PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1e-6),
+    b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+    b'\x4d\x3c\xb2\xa1': ('<', 1e-9),
+    b'\xa1\xb2\x3c\x4d': ('>', 1e-9),
+}
+_PCAPNG_MAGIC = b'\x0a\x0d\x0d\x0a'
+
+# pcapng block types.
+_SECTION_HEADER_BLOCK = 0x0a0d0d0a
+_INTERFACE_DESCRIPTION_BLOCK = 0x1
+_OBSOLETE_PACKET_BLOCK = 0x2
+_SIMPLE_PACKET_BLOCK = 0x3
+_ENHANCED_PACKET_BLOCK = 0x6
+_IF_TSRESOL = 9
+
+# Link types.
+_LINKTYPE_NULL = 0
+_LINKTYPE_ETHERNET = 1
+_LINKTYPE_RAW = 101
+_LINKTYPE_LOOP = 108
+_LINKTYPE_LINUX_SLL = 113
+_LINKTYPE_IPV4 = 228
+_LINKTYPE_IPV6 = 229
+_LINKTYPE_LINUX_SLL2 = 276
+
+_ETHERTYPE_IPV4 = 0x0800
+_ETHERTYPE_IPV6 = 0x86dd
+_ETHERTYPE_VLAN = {0x8100, 0x88a8, 0x9100}
+
+_IPPROTO_UDP = 17
+# IPv6 extension headers which may precede the UDP header.
+_IPV6_EXTENSION_HEADERS = {0, 43, 60}
+
+_DNS_TYPE_A = 1
+_DNS_CLASS_IN = 1
+# Maximum number of compression pointers followed for a single name.
+_MAX_POINTERS = 64
+
+
+class Error(Exception):
+  pass
+
+
+class FormatError(Error):
+  pass
+
+
+class _MalformedPacketError(Error):
+  pass
+
+
+def is_capture(header):
+  """Whether the first bytes of a file are those of a pcap or pcapng file."""
+  return header[:4] in _PCAP_MAGIC or header[:4] == _PCAPNG_MAGIC
+
+
+def from_pcap(src, ports=(DNS_PORT,)):
+  """Read A records from answers of DNS responses in a capture.
+
+  Args:
+    src: binary file object of a pcap or pcapng capture.
+    ports (optional): UDP source ports of DNS responses.
+
+  Yields:
+    dnsrecord.DnsRecord objects, in capture order.
+  """
+  for _, record in from_pcap_with_timestamps(src, ports):
+    yield record
+
+
+def from_pcap_with_timestamps(src, ports=(DNS_PORT,)):
+  """Same as from_pcap(), but yields (timestamp, DnsRecord) pairs."""
+  ports = frozenset(ports)
+  for timestamp, linktype, packet in read_packets(src):
+    try:
+      payload = _udp_payload(linktype, packet, ports)
+      records = _dns_a_records(payload) if payload is not None else ()
+    except (_MalformedPacketError, IndexError, struct.error):
+      # Truncated or otherwise malformed packets are ignored.
+      continue
+    for record in records:
+      yield timestamp, record
+
+
+def read_packets(src):
+  """Read packets from a pcap or pcapng capture.
+
+  Yields:
+    (timestamp, linktype, data) tuples, where timestamp is in seconds.
+  """
+  magic = src.read(4)
+  if magic == _PCAPNG_MAGIC:
+    return _read_pcapng(src, magic)
+  elif magic in _PCAP_MAGIC:
+    return _read_pcap(src, magic)
+  raise FormatError('not a pcap or pcapng file')
+
+
+def _read_exactly(src, length):
+  data = src.read(length)
+  if len(data) != length:
+    raise FormatError('unexpected end of file')
+  return data
+
+
+def _read_pcap(src, magic):
+  byte_order, resolution = _PCAP_MAGIC[magic]
+  header = struct.Struct(byte_order + 'HHiIII')
+  _, _, _, _, _, linktype = header.unpack(_read_exactly(src, header.size))
+  record_header = struct.Struct(byte_order + 'IIII')
+  while True:
+    data = src.read(record_header.size)
+    if not data:
+      return
+    if len(data) != record_header.size:
+      raise FormatError('unexpected end of file')
+    seconds, fraction, captured_length, _ = record_header.unpack(data)
+    yield (seconds + fraction * resolution, linktype,
+           _read_exactly(src, captured_length))
+
+
+def _read_pcapng(src, magic):
+  byte_order = None
+  interfaces = []
+  while True:
+    block_type = magic if magic is not None else src.read(4)
+    magic = None
+    if not block_type:
+      return
+    if len(block_type) != 4:
+      raise FormatError('unexpected end of file')
+
+    if block_type == _PCAPNG_MAGIC:
+      # Section header; byte order may change from here.
+      raw_length, byte_order_magic = struct.unpack(
+          '4s4s', _read_exactly(src, 8))
+      if byte_order_magic == b'\x4d\x3c\x2b\x1a':
+        byte_order = '<'
+      elif byte_order_magic == b'\x1a\x2b\x3c\x4d':
+        byte_order = '>'
+      else:
+        raise FormatError('invalid pcapng byte-order magic')
+      total_length, = struct.unpack(byte_order + 'I', raw_length)
+      _read_exactly(src, total_length - 12)
+      interfaces = []
+      continue
+
+    if byte_order is None:
+      raise FormatError('pcapng file must begin with a section header')
+    block_type, = struct.unpack(byte_order + 'I', block_type)
+    total_length, = struct.unpack(byte_order + 'I', _read_exactly(src, 4))
+    if total_length < 12:
+      raise FormatError('invalid pcapng block length')
+    body = _read_exactly(src, total_length - 12)
+    _read_exactly(src, 4)  # trailing total length
+
+    if block_type == _INTERFACE_DESCRIPTION_BLOCK:
+      linktype, _, snaplen = struct.unpack_from(byte_order + 'HHI', body)
+      interfaces.append((linktype, snaplen,
+                         _tsresol(body[8:], byte_order)))
+    elif block_type == _ENHANCED_PACKET_BLOCK:
+      interface_id, ts_high, ts_low, captured_length, _ = struct.unpack_from(
+          byte_order + 'IIIII', body)
+      linktype, _, resolution = _interface(interfaces, interface_id)
+      yield (((ts_high << 32) | ts_low) * resolution, linktype,
+             body[20:20+captured_length])
+    elif block_type == _OBSOLETE_PACKET_BLOCK:
+      interface_id, _, ts_high, ts_low, captured_length, _ = (
+          struct.unpack_from(byte_order + 'HHIIII', body))
+      linktype, _, resolution = _interface(interfaces, interface_id)
+      yield (((ts_high << 32) | ts_low) * resolution, linktype,
+             body[20:20+captured_length])
+    elif block_type == _SIMPLE_PACKET_BLOCK:
+      original_length, = struct.unpack_from(byte_order + 'I', body)
+      linktype, snaplen, _ = _interface(interfaces, 0)
+      captured_length = min(original_length, len(body) - 4)
+      if snaplen:
+        captured_length = min(captured_length, snaplen)
+      # Simple packet blocks carry no timestamp.
+      yield None, linktype, body[4:4+captured_length]
+    # Other blocks are irrelevant.
+
+
+def _interface(interfaces, interface_id):
+  # Packets refer to interfaces described earlier in their section.
+  if interface_id >= len(interfaces):
+    raise FormatError('packet of undescribed pcapng interface {}'.format(
+        interface_id))
+  return interfaces[interface_id]
+
+
+def _tsresol(options, byte_order):
+  offset = 0
+  while offset + 4 <= len(options):
+    code, length = struct.unpack_from(byte_order + 'HH', options, offset)
+    if code == 0:
+      break
+    if code == _IF_TSRESOL and length >= 1:
+      value = options[offset + 4]
+      if value & 0x80:
+        return 2.0 ** -(value & 0x7f)
+      return 10.0 ** -value
+    offset += 4 + (length + 3) // 4 * 4
+  return 1e-6
+
+
+def _udp_payload(linktype, packet, ports):
+  """Return the payload of UDP datagram from one of ports, or None."""
+  if linktype == _LINKTYPE_ETHERNET:
+    ethertype, = struct.unpack_from('!H', packet, 12)
+    offset = 14
+    while ethertype in _ETHERTYPE_VLAN:
+      ethertype, = struct.unpack_from('!H', packet, offset + 2)
+      offset += 4
+    return _ip_udp_payload(ethertype, packet[offset:], ports)
+  elif linktype in (_LINKTYPE_NULL, _LINKTYPE_LOOP):
+    # Address family in host byte order for NULL, network byte order for LOOP.
+    return _ip_udp_payload(None, packet[4:], ports)
+  elif linktype in (_LINKTYPE_RAW, _LINKTYPE_IPV4, _LINKTYPE_IPV6):
+    return _ip_udp_payload(None, packet, ports)
+  elif linktype == _LINKTYPE_LINUX_SLL:
+    ethertype, = struct.unpack_from('!H', packet, 14)
+    return _ip_udp_payload(ethertype, packet[16:], ports)
+  elif linktype == _LINKTYPE_LINUX_SLL2:
+    ethertype, = struct.unpack_from('!H', packet, 0)
+    return _ip_udp_payload(ethertype, packet[20:], ports)
+  return None
+
+
+def _ip_udp_payload(ethertype, packet, ports):
+  if not packet:
+    return None
+  version = packet[0] >> 4
+  if ethertype is not None and ethertype not in (_ETHERTYPE_IPV4,
+                                                 _ETHERTYPE_IPV6):
+    return None
+  if version == 4:
+    header_length = (packet[0] & 0xf) * 4
+    total_length, flags_fragment = struct.unpack_from('!HxxH', packet, 2)
+    if flags_fragment & 0x3fff:
+      # Fragmented datagrams are not reassembled.
+      return None
+    if packet[9] != _IPPROTO_UDP:
+      return None
+    udp = packet[header_length:total_length]
+  elif version == 6:
+    payload_length, = struct.unpack_from('!H', packet, 4)
+    next_header = packet[6]
+    offset = 40
+    while next_header in _IPV6_EXTENSION_HEADERS:
+      next_header = packet[offset]
+      offset += (packet[offset + 1] + 1) * 8
+    if next_header != _IPPROTO_UDP:
+      return None
+    udp = packet[offset:40+payload_length]
+  else:
+    return None
+
+  source_port, _, udp_length = struct.unpack_from('!HHH', udp)
+  if source_port not in ports:
+    return None
+  if udp_length < 8 or udp_length > len(udp):
+    raise _MalformedPacketError('truncated UDP datagram')
+  return udp[8:udp_length]
+
+
+def _dns_a_records(message):
+  """Return A records in the answer section of a DNS response."""
+  _, flags, question_count, answer_count = struct.unpack_from('!HHHH',
+                                                              message)
+  if not flags & 0x8000:
+    # Not a response.
+    return []
+  offset = 12
+  for _ in range(question_count):
+    _, offset = _read_name(message, offset)
+    offset += 4  # type and class
+  records = []
+  for _ in range(answer_count):
+    name, offset = _read_name(message, offset)
+    record_type, record_class, _, data_length = struct.unpack_from(
+        '!HHIH', message, offset)
+    offset += 10
+    data = message[offset:offset+data_length]
+    if len(data) != data_length:
+      raise _MalformedPacketError('truncated resource record')
+    offset += data_length
+    if (record_type == _DNS_TYPE_A and record_class == _DNS_CLASS_IN
+        and data_length == 4):
+      records.append(dnsrecord.DnsRecord(name, 'IN', 'A',
+                                         '{}.{}.{}.{}'.format(*data)))
+  return records
+
+
+def _read_name(message, offset):
+  """Read a possibly compressed name; return (name, offset past the name)."""
+  labels = []
+  end = None
+  pointers = 0
+  while True:
+    length = message[offset]
+    if length & 0xc0 == 0xc0:
+      if end is None:
+        end = offset + 2
+      pointers += 1
+      if pointers > _MAX_POINTERS:
+        raise _MalformedPacketError('too many compression pointers')
+      offset = ((length & 0x3f) << 8) | message[offset + 1]
+    elif length & 0xc0:
+      raise _MalformedPacketError('unsupported label type')
+    elif length == 0:
+      offset += 1
+      break
+    else:
+      label = message[offset+1:offset+1+length]
+      if len(label) != length:
+        raise _MalformedPacketError('truncated label')
+      labels.append(label.decode('ascii', 'backslashreplace'))
+      offset += 1 + length
+  return '.'.join(labels) + '.', end if end is not None else offset
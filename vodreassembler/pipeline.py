@@ -0,0 +1,213 @@
+"""Asynchronous pipeline for building ticket databases.
+
+Building a ticket database involves reading records, parsing them and applying
+them to tickets. The pipeline runs these as three concurrent stages joined by
+bounded queues, so that waiting for I/O overlaps with parsing:
+
+  read: pulls batches of records from the source in a thread.
+  parse: parses batches in a pool of worker processes.
+  assemble: applies the parsed queries to the tickets in the original order.
+
+The queues bound the number of batches in flight, and thereby memory usage.
+"""
+
+import asyncio
+import concurrent.futures
+import itertools
+import time
+from vodreassembler import ticket
+
+DEFAULT_BATCH_SIZE = 4096
+DEFAULT_QUEUE_SIZE = 8
+
+
+class StageStats:
+  """Statistics of a pipeline stage.
+
+  Attributes:
+    name (str): Name of the stage.
+    batches (int): Number of batches processed.
+    records (int): Number of records in the batches.
+    busy_time (float): Seconds spent processing batches, excluding waits for
+      other stages. Summed over the workers for the parse stage.
+  """
+  def __init__(self, name):
+    self.name = name
+    self.batches = 0
+    self.records = 0
+    self.busy_time = 0.0
+
+  def add(self, num_records, busy_time):
+    self.batches += 1
+    self.records += num_records
+    self.busy_time += busy_time
+
+  @property
+  def throughput(self):
+    """Records processed per second of busy time, or None if idle."""
+    if not self.busy_time:
+      return None
+    return self.records / self.busy_time
+
+
+class QueueStats:
+  """Occupancy of a queue between stages, sampled whenever an item is taken.
+
+  Attributes:
+    name (str): Name of the queue.
+    maxsize (int): Capacity of the queue.
+    max_occupancy (int): Largest number of items seen in the queue.
+  """
+  def __init__(self, name, maxsize):
+    self.name = name
+    self.maxsize = maxsize
+    self.max_occupancy = 0
+    self._samples = 0
+    self._total = 0
+
+  def sample(self, occupancy):
+    self._samples += 1
+    self._total += occupancy
+    self.max_occupancy = max(self.max_occupancy, occupancy)
+
+  @property
+  def mean_occupancy(self):
+    if not self._samples:
+      return 0.0
+    return self._total / self._samples
+
+
+class PipelineStats:
+  """Statistics of a pipeline run.
+
+  Attributes:
+    stages (list): StageStats of read, parse and assemble stages.
+    queues (list): QueueStats of the queues between the stages.
+    elapsed (float): Wall clock seconds of the whole run.
+  """
+  def __init__(self, queue_size):
+    self.stages = [StageStats(name)
+                   for name in ('read', 'parse', 'assemble')]
+    self.queues = [QueueStats(name, queue_size)
+                   for name in ('read->parse', 'parse->assemble')]
+    self.elapsed = 0.0
+
+  def report(self):
+    """Return a human-readable summary."""
+    lines = ['Pipeline finished in {:.2f}s'.format(self.elapsed)]
+    for stage in self.stages:
+      throughput = stage.throughput
+      lines.append('  {:<8} {:>10} records {:>8} batches {:>8.2f}s busy '
+                   '{:>12} records/s'.format(
+                       stage.name, stage.records, stage.batches,
+                       stage.busy_time,
+                       '-' if throughput is None else
+                       '{:.0f}'.format(throughput)))
+    for queue in self.queues:
+      lines.append('  queue {:<16} mean {:.1f} max {} of {}'.format(
+          queue.name, queue.mean_occupancy, queue.max_occupancy,
+          queue.maxsize))
+    return '\n'.join(lines)
+
+
+def build_ticket_db(records, ticket_db=None, processes=1,
+                    batch_size=DEFAULT_BATCH_SIZE,
+                    queue_size=DEFAULT_QUEUE_SIZE):
+  """Build a ticket database from records with the pipeline.
+
+  The result is identical to TicketDatabase.build_from_records().
+
+  Args:
+    records: iterable of dnsrecord.DnsRecord objects. Iterating may block,
+      e.g. on reading a file; it is done in a separate thread.
+    ticket_db (ticket.TicketDatabase, optional): Database to be updated. A new
+      database is created if not provided.
+    processes (int, optional): Number of worker processes for parsing.
+    batch_size (int, optional): Number of records in a batch.
+    queue_size (int, optional): Maximum number of batches waiting in each
+      queue between stages.
+
+  Returns:
+    Tuple of the ticket database and PipelineStats.
+  """
+  if ticket_db is None:
+    ticket_db = ticket.TicketDatabase()
+  stats = PipelineStats(queue_size)
+  start = time.perf_counter()
+  with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+    asyncio.run(_run(records, ticket_db, executor, batch_size, queue_size,
+                     stats))
+  stats.elapsed = time.perf_counter() - start
+  return ticket_db, stats
+
+
+async def _run(records, ticket_db, executor, batch_size, queue_size, stats):
+  read_queue = asyncio.Queue(queue_size)
+  parse_queue = asyncio.Queue(queue_size)
+  read_stats, parse_stats, assemble_stats = stats.stages
+  read_queue_stats, parse_queue_stats = stats.queues
+  tasks = [
+      asyncio.ensure_future(_read(records, batch_size, read_queue,
+                                  read_stats)),
+      asyncio.ensure_future(_parse(read_queue, parse_queue, executor,
+                                   ticket_db.fqdn_suffix, read_queue_stats)),
+      asyncio.ensure_future(_assemble(parse_queue, ticket_db, parse_stats,
+                                      assemble_stats, parse_queue_stats)),
+  ]
+  try:
+    await asyncio.gather(*tasks)
+  finally:
+    for task in tasks:
+      task.cancel()
+
+
+async def _read(records, batch_size, queue, stats):
+  loop = asyncio.get_running_loop()
+  iterator = iter(records)
+  while True:
+    start = time.perf_counter()
+    batch = await loop.run_in_executor(
+        None, lambda: list(itertools.islice(iterator, batch_size)))
+    if not batch:
+      break
+    stats.add(len(batch), time.perf_counter() - start)
+    await queue.put(batch)
+  await queue.put(None)
+
+
+async def _parse(in_queue, out_queue, executor, fqdn_suffix, queue_stats):
+  loop = asyncio.get_running_loop()
+  while True:
+    queue_stats.sample(in_queue.qsize())
+    batch = await in_queue.get()
+    if batch is None:
+      break
+    # Futures are queued in order, so that they are applied in order; the size
+    # of the queue limits the number of batches being parsed.
+    future = loop.run_in_executor(executor, _parse_record_batch, batch,
+                                  fqdn_suffix)
+    await out_queue.put((len(batch), future))
+  await out_queue.put(None)
+
+
+async def _assemble(queue, ticket_db, parse_stats, stats, queue_stats):
+  while True:
+    queue_stats.sample(queue.qsize())
+    item = await queue.get()
+    if item is None:
+      break
+    num_records, future = item
+    pairs, rejections, parse_time = await future
+    parse_stats.add(num_records, parse_time)
+    start = time.perf_counter()
+    ticket_db.rejections.update(rejections)
+    for ticket_id, query in pairs:
+      ticket_db.update(ticket_id, query)
+    stats.add(num_records, time.perf_counter() - start)
+
+
+def _parse_record_batch(records, fqdn_suffix):
+  # Runs in worker processes.
+  start = time.perf_counter()
+  pairs, rejections = ticket.parse_record_batch(records, fqdn_suffix)
+  return pairs, rejections, time.perf_counter() - start
@@ -5,12 +5,26 @@ import collections
 import enum
 import itertools
 import regex
+import string
 import struct
 from vodreassembler import util
 from vodreassembler import dnsrecord
 
+try:
+  import numpy
+except ImportError:
+  # Batch decoding is unavailable; see ipv4_to_chunks().
+  numpy = None
+
 DEFAULT_FQDN_SUFFIX = 'tun.vpnoverdns.com.'
 
+# Variables normalized by Query.normalize_data().
+_INT_VARIABLES = frozenset({'id', 'sz', 'rn', 'wr', 'ck', 'ln', 'rd', 'retry'})
+_HEX_VARIABLES = frozenset({'bf'})
+
+# Characters accepted in labels by the fast path of QueryParser; a subset of \w.
+_ASCII_WORD_CHARS = string.ascii_letters + string.digits + '_'
+
 
 class Error(Exception):
   pass
@@ -24,20 +38,148 @@ def ipv4_to_bytes(addr):
   return ipv4_to_chunk(addr)[0]
 
 def ipv4_to_chunk(addr):
+  data = _ipv4_to_packed(addr)
+  length = (data[0] >> 6) & 0x3
+  offset = (data[0] & 0x3f) * 3
+  return util.DataChunk(data[1:length+1], offset)
+
+def _ipv4_to_packed(addr):
   octets = addr.split('.')
   if len(octets) != 4:
     raise ValueError('IPv4 addresses must have 4 octets')
   octets = map(int, octets)
   try:
-    data = ipv4_to_chunk.packer.pack(*octets)
+    return _ipv4_to_packed.packer.pack(*octets)
   except struct.error as e:
     raise ValueError('every octet must be within [0,255]') from e
 
-  length = (data[0] >> 6) & 0x3
-  offset = (data[0] & 0x3f) * 3
-  return util.DataChunk(data[1:length+1], offset)
+_ipv4_to_packed.packer = struct.Struct('!BBBB')
+
+
+class ChunkArrays(collections.namedtuple('ChunkArrays',
+                                         ['lengths', 'offsets', 'data'])):
+  """Payloads of multiple A records, decoded into parallel NumPy arrays.
+
+  Attributes:
+    lengths: uint8 array of chunk lengths.
+    offsets: int64 array of chunk offsets.
+    data: (n, 3) uint8 array of chunk data. Bytes past the length of each chunk
+      are meaningless.
+  """
+
+  def to_chunks(self):
+    """Return the list of DataChunk objects."""
+    data = self.data.tobytes()
+    return [util.DataChunk(data[i:i+length], offset)
+            for i, length, offset in zip(range(0, len(data), 3),
+                                         self.lengths.tolist(),
+                                         self.offsets.tolist())]
+
+
+def ipv4_to_chunks(addrs):
+  """Decode payloads of multiple IPv4 addresses at once.
+
+  Equivalent to calling ipv4_to_chunk() for every address, but decoding is
+  done with NumPy. Requires NumPy.
+
+  Args:
+    addrs: sequence of IPv4 addresses in dotted-quad notation, or sequence or
+      array of IPv4 addresses as 32-bit integers.
+
+  Returns:
+    ChunkArrays holding the decoded chunks.
+
+  Raises:
+    ValueError: if any of the addresses is invalid.
+  """
+  octets, valid = ipv4_to_octet_array(addrs)
+  if not valid.all():
+    index = int(numpy.flatnonzero(~valid)[0])
+    raise ValueError('invalid IPv4 address {!r} at index {}'.format(
+        addrs[index], index))
+  return _octets_to_chunks(octets)
+
+
+def ipv4_to_octet_array(addrs):
+  """Convert IPv4 addresses into an (n, 4) uint8 array of octets.
+
+  Returns:
+    Tuple of the octet array and a boolean array indicating which of the
+    addresses are valid. Octets of invalid addresses are zero.
+  """
+  if numpy is None:
+    raise ImportError('NumPy is required for batch decoding')
+  if isinstance(addrs, numpy.ndarray) and addrs.dtype.kind in 'iu':
+    return _ints_to_octets(addrs)
+  if len(addrs) and not isinstance(addrs[0], str):
+    return _ints_to_octets(numpy.asarray(addrs, dtype=numpy.int64))
+  return _strings_to_octets(addrs)
+
+
+def _ints_to_octets(addrs):
+  addrs = addrs.astype(numpy.int64)
+  valid = (addrs >= 0) & (addrs <= 0xffffffff)
+  addrs = numpy.where(valid, addrs, 0)
+  octets = addrs.astype('>u4').view(numpy.uint8).reshape(-1, 4)
+  return octets, valid
+
+
+def _strings_to_octets(addrs):
+  num_addrs = len(addrs)
+  octets = numpy.zeros((num_addrs, 4), dtype=numpy.uint8)
+  if not num_addrs:
+    return octets, numpy.ones(0, dtype=bool)
+  # Parse all addresses joined by newlines in one pass. Every address with
+  # unusual syntax is marked invalid here, and retried with ipv4_to_chunk()
+  # later, so the results match regardless of what int() accepts.
+  text = ('\n'.join(addrs) + '\n').encode('ascii', 'replace')
+  buf = numpy.frombuffer(text, dtype=numpy.uint8)
+  is_newline = buf == ord('\n')
+  is_separator = is_newline | (buf == ord('.'))
+  digits = buf.astype(numpy.int64) - ord('0')
+  is_digit = (digits >= 0) & (digits <= 9)
+  if numpy.count_nonzero(is_newline) != num_addrs:
+    # Some of the addresses contain newlines.
+    return _retry_invalid(addrs, octets, numpy.zeros(num_addrs, dtype=bool))
+  char_line = numpy.cumsum(is_newline) - is_newline
+
+  invalid = numpy.zeros(num_addrs, dtype=bool)
+  invalid[char_line[~(is_digit | is_separator)]] = True
+  separators = numpy.flatnonzero(is_separator)
+  field_lengths = numpy.diff(separators, prepend=-1) - 1
+  field_line = char_line[separators]
+  invalid[field_line[(field_lengths == 0) | (field_lengths > 3)]] = True
+  invalid |= numpy.bincount(field_line, minlength=num_addrs) != 4
+
+  char_field = numpy.cumsum(is_separator) - is_separator
+  # Separators get zero weight, and digits of fields too long are invalid.
+  exponents = numpy.clip(separators[char_field] - numpy.arange(len(buf)) - 1,
+                         0, 3)
+  weights = numpy.where(is_digit, digits * 10 ** exponents, 0)
+  values = numpy.bincount(char_field, weights=weights,
+                          minlength=len(separators))
+  invalid[field_line[values > 255]] = True
+
+  valid = ~invalid
+  octets[valid] = values[valid[field_line]].astype(numpy.uint8).reshape(-1, 4)
+  return _retry_invalid(addrs, octets, valid)
 
-ipv4_to_chunk.packer = struct.Struct('!BBBB')
+
+def _retry_invalid(addrs, octets, valid):
+  for i in numpy.flatnonzero(~valid).tolist():
+    try:
+      packed = _ipv4_to_packed(addrs[i])
+    except (AttributeError, ValueError):
+      continue
+    octets[i] = numpy.frombuffer(packed, dtype=numpy.uint8)
+    valid[i] = True
+  return octets, valid
+
+
+def _octets_to_chunks(octets):
+  first = octets[:, 0]
+  return ChunkArrays(first >> 6, (first & 0x3f).astype(numpy.int64) * 3,
+                     octets[:, 1:])
 
 def chunk_to_ipv4(chunk):
   if not isinstance(chunk, util.DataChunk):
@@ -65,6 +207,40 @@ def normalize_fqdn_suffix(fqdn_suffix):
     fqdn_suffix = fqdn_suffix[1:]
   return fqdn_suffix
 
+def is_suffix_set(fqdn_suffix):
+  """Whether fqdn_suffix is a collection of suffixes, not a single one."""
+  return fqdn_suffix is not None and not isinstance(fqdn_suffix, str)
+
+def normalize_fqdn_suffixes(fqdn_suffixes):
+  """Normalize a collection of suffixes into a sorted tuple."""
+  suffixes = tuple(sorted({normalize_fqdn_suffix(s) for s in fqdn_suffixes}))
+  if not suffixes:
+    raise ValueError('at least one suffix is required')
+  return suffixes
+
+
+class _SuffixTable:
+  """Finds the suffix, out of a set of suffixes, which an FQDN ends with.
+
+  Suffixes are looked up in a hash set, once for each distinct number of
+  labels among the suffixes, longest first.
+  """
+  def __init__(self, suffixes):
+    self._suffixes = frozenset(suffixes)
+    self._label_counts = sorted({s.count('.') for s in self._suffixes},
+                                reverse=True)
+
+  def match(self, fqdn):
+    """Return the longest suffix preceded by a label in fqdn, or None."""
+    for count in self._label_counts:
+      # Labels of the suffix, and the empty string after the trailing dot.
+      parts = fqdn.rsplit('.', count + 1)
+      if len(parts) == count + 2 and parts[0]:
+        suffix = fqdn[len(parts[0]) + 1:]
+        if suffix in self._suffixes:
+          return suffix
+    return None
+
 
 @enum.unique
 class QueryType(enum.Enum):
@@ -79,38 +255,47 @@ class QueryType(enum.Enum):
   def deduce(version, variables, data):
     if version != '0':
       raise UnknownVersionError(version)
-    keys = set(variables.keys())
+    return QueryType._from_keys(variables.keys())
+
+  @staticmethod
+  def _from_keys(keys):
+    keys = frozenset(keys)
     if 'retry' in keys:
       # ignore clearly optional variables
-      keys.remove('retry')
-    if keys == {'sz', 'rn', 'id'}:
-      return QueryType.open_ticket
-    elif keys == {'bf', 'wr', 'id'}:
-      return QueryType.request_data
-    elif keys == {'ck', 'id'}:
-      return QueryType.check_request
-    elif keys == {'ln', 'rd', 'id'}:
-      return QueryType.fetch_response
-    elif keys == {'ac', 'id'}:
-      return QueryType.close_ticket
-    return QueryType.unknown
+      keys = keys.difference(('retry',))
+    return _QUERY_TYPES_BY_KEYS.get(keys, QueryType.unknown)
+
+
+_QUERY_TYPES_BY_KEYS = {
+    frozenset({'sz', 'rn', 'id'}): QueryType.open_ticket,
+    frozenset({'bf', 'wr', 'id'}): QueryType.request_data,
+    frozenset({'ck', 'id'}): QueryType.check_request,
+    frozenset({'ln', 'rd', 'id'}): QueryType.fetch_response,
+    frozenset({'ac', 'id'}): QueryType.close_ticket,
+}
 
 
 class Query(collections.namedtuple('Query', ['version', 'type',
-                                                 'variables', 'payload'])):
+                                                 'variables', 'payload',
+                                                 'fqdn_suffix'])):
+  """Query of VPN over DNS.
+
+  fqdn_suffix is the suffix the query was sent to, if parsed by a QueryParser
+  for multiple suffixes, and None otherwise.
+  """
   @classmethod
-  def create(cls, version, variables, payload):
+  def create(cls, version, variables, payload, fqdn_suffix=None):
     querytype = QueryType.deduce(version, variables, payload)
     variables, payload = cls.normalize_data(querytype, variables, payload)
-    return cls(version, querytype, variables, payload)
+    return cls(version, querytype, variables, payload, fqdn_suffix)
 
   @staticmethod
   def normalize_data(querytype, variables, payload):
     newvars = {}
     for key in variables:
-      if key in {'id', 'sz', 'rn', 'wr', 'ck', 'ln', 'rd', 'retry'}:
+      if key in _INT_VARIABLES:
         newvars[key] = int(variables[key])
-      elif key in {'bf'}:
+      elif key in _HEX_VARIABLES:
         newvars[key] = binascii.unhexlify(variables[key])
       else:
         newvars[key] = variables[key]
@@ -126,7 +311,8 @@ class Query(collections.namedtuple('Query', ['version', 'type',
     return None
 
   def encode(self, fqdn_suffix=None):
-    fqdn_suffix = normalize_fqdn_suffix(fqdn_suffix or DEFAULT_FQDN_SUFFIX)
+    fqdn_suffix = normalize_fqdn_suffix(
+        fqdn_suffix or self.fqdn_suffix or DEFAULT_FQDN_SUFFIX)
     field_encoders = [
         ('retry', str),
         ('sz', '{:08d}'.format),
@@ -153,24 +339,413 @@ class Query(collections.namedtuple('Query', ['version', 'type',
         'IN', 'A', chunk_to_ipv4(self.payload))
 
 
+Query.__new__.__defaults__ = (None,)
+
+
+class CompactQuery:
+  """Memory-efficient counterpart of Query for bulk processing.
+
+  Query holds its variables in a dict and its payload in a DataChunk, which
+  takes several hundred bytes per query. CompactQuery stores the variables used
+  for reassembly in fixed slots instead, and the query type as its small
+  integer value. Absent variables are None. Flags and other variables, such as
+  retry, are dropped. QueryParser(compact=True) parses records into
+  CompactQuery objects directly.
+
+  Attributes:
+    type_code (int): value of the QueryType.
+    id, sz, rn, wr, ck, ln, rd (int): variables of the query, or None.
+    bf (bytes): request data, or None.
+    data (bytes): data of the payload.
+    offset (int): offset of the payload.
+    fqdn_suffix (str): same as Query.fqdn_suffix.
+  """
+  __slots__ = ('type_code', 'id', 'sz', 'rn', 'wr', 'ck', 'ln', 'rd', 'bf',
+               'data', 'offset', 'fqdn_suffix')
+  _VARIABLES = ('id', 'sz', 'rn', 'wr', 'ck', 'ln', 'rd', 'bf')
+
+  def __init__(self, type_code, id=None, sz=None, rn=None, wr=None, ck=None,
+               ln=None, rd=None, bf=None, data=b'', offset=0,
+               fqdn_suffix=None):
+    self.type_code = type_code
+    self.id = id
+    self.sz = sz
+    self.rn = rn
+    self.wr = wr
+    self.ck = ck
+    self.ln = ln
+    self.rd = rd
+    self.bf = bf
+    self.data = data
+    self.offset = offset
+    self.fqdn_suffix = fqdn_suffix
+
+  @classmethod
+  def from_query(cls, query):
+    return cls.from_variables(query.type, query.variables, query.payload,
+                              query.fqdn_suffix)
+
+  @classmethod
+  def from_variables(cls, querytype, variables, payload, fqdn_suffix=None):
+    """Create from normalized variables, as held by Query."""
+    get = variables.get
+    return cls(querytype.value, get('id'), get('sz'), get('rn'), get('wr'),
+               get('ck'), get('ln'), get('rd'), get('bf'), payload.data,
+               payload.offset, fqdn_suffix)
+
+  def to_query(self):
+    """Return the equivalent Query, without the dropped variables."""
+    variables = {key: getattr(self, key) for key in self._VARIABLES
+                 if getattr(self, key) is not None}
+    if self.type_code == QueryType.close_ticket.value:
+      variables['ac'] = True
+    return Query('0', self.type, variables, self.payload, self.fqdn_suffix)
+
+  @property
+  def type(self):
+    return _QUERY_TYPES_BY_CODE[self.type_code]
+
+  @property
+  def payload(self):
+    return util.DataChunk(self.data, self.offset)
+
+  @property
+  def error(self):
+    # Same as Query.error.
+    if len(self.data) == 2 and self.data.startswith(b'E'):
+      return self.data[1] or None
+    return None
+
+  def _fields(self):
+    return tuple(getattr(self, key) for key in self.__slots__)
+
+  def __reduce__(self):
+    # Pickle positionally; the default for slotted classes stores every name.
+    return CompactQuery, self._fields()
+
+  def __eq__(self, other):
+    if not isinstance(other, CompactQuery):
+      return NotImplemented
+    return self._fields() == other._fields()
+
+  __hash__ = None
+
+  def __repr__(self):
+    return 'CompactQuery({})'.format(', '.join(
+        '{}={!r}'.format(key, getattr(self, key)) for key in self.__slots__
+        if getattr(self, key) is not None))
+
+
+_QUERY_TYPES_BY_CODE = {query_type.value: query_type
+                        for query_type in QueryType}
+
+
 class QueryParser:
-  def __init__(self, fqdn_suffix=None):
-    self._suffix = normalize_fqdn_suffix(fqdn_suffix or DEFAULT_FQDN_SUFFIX)
+  """Parser for DNS records carrying VPN over DNS queries.
+
+  Well-formed names are parsed by a fast path which splits the labels once,
+  and names without the suffix are rejected by it. Anything else the fast path
+  is not sure about is handed to a regular expression, which also produces
+  the error for malformed names.
+
+  try_parse() and parse_batch() do not raise for records which are not
+  queries. Instead, they count rejected records by reason in rejections:
+
+    type: the record is not an A record.
+    suffix: the FQDN does not end with the suffix.
+    format: the FQDN or the value is malformed.
+    version: the query has an unknown version.
+
+  The parser accepts either a single suffix, or a collection of suffixes. In
+  the latter case, records of all the suffixes are parsed in a single pass,
+  and every query is tagged with the suffix it was sent to; see
+  Query.fqdn_suffix.
+
+  With compact=True, records are parsed into CompactQuery objects instead of
+  Query objects, e.g. for queries held in bulk.
+  """
+  def __init__(self, fqdn_suffix=None, compact=False):
+    self._compact = compact
+    if is_suffix_set(fqdn_suffix):
+      suffixes = normalize_fqdn_suffixes(fqdn_suffix)
+      self._suffix_table = _SuffixTable(suffixes)
+    else:
+      suffixes = (normalize_fqdn_suffix(fqdn_suffix or DEFAULT_FQDN_SUFFIX),)
+      self._suffix_table = None
+    self._suffix = suffixes[0]
+    self._dotted_suffix = '.' + self._suffix
+    self.rejections = collections.Counter()
+    # Longest first, so that the longest of overlapping suffixes is chosen.
     self._re = regex.compile(
         r'''^\s*
               ((?P<flag>\w+)\.)*                # flags
               ((?P<var>\w+)-(?P<value>\w+)\.)+  # variables
               v(?P<version>\w+)\.               # version
-              {!s}                              # suffix
-            \s*$'''.format(regex.escape(self._suffix)),
+              (?P<suffix>{!s})                  # suffix
+            \s*$'''.format('|'.join(
+                regex.escape(s)
+                for s in sorted(suffixes, key=len, reverse=True))),
         regex.VERSION1 | regex.VERBOSE)
 
+  def _match_suffix(self, fqdn):
+    # Return the suffix fqdn ends with, or None.
+    if self._suffix_table is not None:
+      return self._suffix_table.match(fqdn)
+    if fqdn.endswith(self._dotted_suffix):
+      return self._suffix
+    return None
+
   def parse(self, dns_record):
+    query = self._parse_fast(dns_record)
+    if query is None:
+      query = self.parse_regex(dns_record)
+    return query
+
+  def accepts(self, dns_record):
+    """Check cheaply whether the record may be a query.
+
+    Records failing the check are counted in rejections. Records passing the
+    check may still be rejected by try_parse().
+    """
+    if dns_record.type != 'A':
+      self.rejections['type'] += 1
+      return False
+    if self._match_suffix(dns_record.fqdn.rstrip()) is None:
+      self.rejections['suffix'] += 1
+      return False
+    return True
+
+  def may_be_query(self, dns_record):
+    """Same check as accepts(), without counting rejections."""
+    return (dns_record.type == 'A'
+            and self._match_suffix(dns_record.fqdn.rstrip()) is not None)
+
+  def try_parse(self, dns_record):
+    """Parse the record, or return None if it is not a valid query."""
+    if not self.accepts(dns_record):
+      return None
+    return self._try_parse_accepted(dns_record, None)
+
+  def _try_parse_accepted(self, dns_record, payload):
+    try:
+      query = self._parse_fast(dns_record, payload)
+      if query is None:
+        query = self.parse_regex(dns_record, payload)
+      return query
+    except ValueError:
+      self.rejections['format'] += 1
+    except UnknownVersionError:
+      self.rejections['version'] += 1
+    return None
+
+  def parse_batch(self, dns_records):
+    """Parse multiple records, decoding their payloads at once.
+
+    Records are checked by accepts() first. Payloads of the remaining records
+    are decoded by ipv4_to_octet_array() if NumPy is available.
+
+    Returns:
+      List holding a Query or CompactQuery for every record, or None if the
+      record cannot be parsed.
+    """
+    if numpy is None:
+      return [self.try_parse(r) for r in dns_records]
+    results = [None] * len(dns_records)
+    indices = [i for i, r in enumerate(dns_records) if self.accepts(r)]
+    octets, valid = ipv4_to_octet_array(
+        [dns_records[i].value for i in indices])
+    chunks = _octets_to_chunks(octets).to_chunks()
+    for i, chunk, ok in zip(indices, chunks, valid.tolist()):
+      results[i] = self._try_parse_accepted(dns_records[i],
+                                            chunk if ok else None)
+    return results
+
+  def parse_regex(self, dns_record, payload=None):
+    """Parse the record with the regular expression only.
+
+    Args:
+      dns_record (dnsrecord.DnsRecord): Record to be parsed.
+      payload (util.DataChunk, optional): Payload already decoded from the
+        value of the record.
+    """
     m = self._re.fullmatch(dns_record.fqdn)
     if not m:
-      raise ValueError(
-          "fqdn '{}' is not in the expected format".format(dns_record.fqdn))
+      raise _format_error(dns_record.fqdn)
     variables = dict.fromkeys(m.captures('flag'), True)
     variables.update(zip(m.captures('var'), m.captures('value')))
-    return Query.create(m.group('version'), variables,
-                          ipv4_to_chunk(dns_record.value))
+    if payload is None:
+      payload = ipv4_to_chunk(dns_record.value)
+    tag = self._tag(m.group('suffix'))
+    if not self._compact:
+      return Query.create(m.group('version'), variables, payload, tag)
+    querytype = QueryType.deduce(m.group('version'), variables, payload)
+    variables, payload = Query.normalize_data(querytype, variables, payload)
+    return CompactQuery.from_variables(querytype, variables, payload, tag)
+
+  def _tag(self, suffix):
+    # Queries are only tagged by parsers for multiple suffixes.
+    return suffix if self._suffix_table is not None else None
+
+  def _parse_fast(self, dns_record, payload=None):
+    """Parse the record without regex, or return None if unsure.
+
+    The result must be identical to parse_regex() whenever this returns a
+    Query or raises. Returning None defers the decision to parse_regex().
+    Names without the suffix, which are most records of a dump, can never
+    match the regular expression, and are rejected here. Names ending with
+    the suffix before trailing whitespace are deferred.
+    """
+    fqdn = dns_record.fqdn
+    if self._suffix_table is None:
+      # Inlined _match_suffix() for the common case of a single suffix.
+      if not fqdn.endswith(self._dotted_suffix):
+        if fqdn.rstrip().endswith(self._dotted_suffix):
+          return None
+        raise _format_error(fqdn)
+      suffix = self._suffix
+      tag = None
+    else:
+      suffix = tag = self._suffix_table.match(fqdn)
+      if suffix is None:
+        if self._suffix_table.match(fqdn.rstrip()) is not None:
+          return None
+        raise _format_error(fqdn)
+    labels = fqdn[:-len(suffix) - 1].split('.')
+    version = labels.pop()
+    if not version.startswith('v') or not _is_ascii_word(version[1:]):
+      return None
+    version = version[1:]
+
+    variables = {}
+    has_vars = False
+    for label in labels:
+      key, sep, value = label.partition('-')
+      if sep:
+        if not _is_ascii_word(key) or not _is_ascii_word(value):
+          return None
+        has_vars = True
+        variables[key] = value
+      elif has_vars or not _is_ascii_word(key):
+        # Flags must precede all variables.
+        return None
+      elif key in _INT_VARIABLES or key in _HEX_VARIABLES:
+        # Leave flags that would be normalized to the slow path.
+        return None
+      else:
+        variables[key] = True
+    if not has_vars:
+      return None
+
+    if payload is None:
+      payload = ipv4_to_chunk(dns_record.value)
+    if version != '0':
+      raise UnknownVersionError(version)
+    querytype = QueryType._from_keys(variables.keys())
+    for key, value in variables.items():
+      if key in _INT_VARIABLES:
+        variables[key] = int(value)
+      elif key in _HEX_VARIABLES:
+        variables[key] = binascii.unhexlify(value)
+    if self._compact:
+      return CompactQuery.from_variables(querytype, variables, payload, tag)
+    return Query(version, querytype, variables, payload, tag)
+
+
+class DuplicateFilter:
+  """Bounded cache suppressing repeated records ahead of QueryParser.
+
+  Resolvers log the same query several times, because of retries by clients
+  and multiple vantage points. Applying a query again does not change the
+  ticket, so repeated records can be dropped before they are parsed.
+
+  Records are keyed by their FQDN and value, with the retry variable removed
+  from the FQDN, since it is the only difference between a query and its
+  retries. The most recently seen keys are kept, up to max_size.
+
+  In resolver logs, most records are usually not queries. Given a check such
+  as QueryParser.may_be_query(), the filter only keeps keys of records passing
+  it, so that noise cannot evict the keys of queries.
+
+  Attributes:
+    max_size (int): Maximum number of keys kept.
+    hits (int): Number of records suppressed.
+    misses (int): Number of checked records passed through.
+  """
+  def __init__(self, max_size):
+    if max_size < 1:
+      raise ValueError('max_size must be positive')
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self._keys = collections.OrderedDict()
+
+  def __len__(self):
+    return len(self._keys)
+
+  @property
+  def hit_rate(self):
+    """Fraction of records suppressed, or None if none were seen."""
+    total = self.hits + self.misses
+    if not total:
+      return None
+    return self.hits / total
+
+  def recent_keys(self):
+    """Return the keys kept, from the least recently seen, e.g. to be saved."""
+    return list(self._keys)
+
+  def remember(self, keys):
+    """Keep keys returned by recent_keys(), as the most recently seen ones.
+
+    Only the last max_size keys are kept.
+    """
+    for key in keys:
+      key = tuple(key)
+      self._keys[key] = None
+      self._keys.move_to_end(key)
+    while len(self._keys) > self.max_size:
+      self._keys.popitem(last=False)
+
+  def filter(self, dns_records, accepts=None):
+    """Yield the records which have not been seen recently.
+
+    None heartbeats of dnsrecord.follow_dump() are passed through.
+
+    Args:
+      dns_records: iterable of dnsrecord.DnsRecord objects, or None.
+      accepts (callable, optional): Called with every record. Records for
+        which it returns False are passed through without being remembered,
+        e.g. to be rejected by the parser.
+    """
+    keys = self._keys
+    max_size = self.max_size
+    for record in dns_records:
+      if record is None or (accepts is not None and not accepts(record)):
+        yield record
+        continue
+      fqdn = record.fqdn
+      if 'retry-' in fqdn:
+        fqdn = _strip_retry(fqdn)
+      key = (fqdn, record.value)
+      if key in keys:
+        keys.move_to_end(key)
+        self.hits += 1
+        continue
+      keys[key] = None
+      if len(keys) > max_size:
+        keys.popitem(last=False)
+      self.misses += 1
+      yield record
+
+
+def _format_error(fqdn):
+  return ValueError("fqdn '{}' is not in the expected format".format(fqdn))
+
+
+def _strip_retry(fqdn):
+  return '.'.join(label for label in fqdn.split('.')
+                  if not label.startswith('retry-'))
+
+
+def _is_ascii_word(label):
+  return bool(label) and not label.strip(_ASCII_WORD_CHARS)
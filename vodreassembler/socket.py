@@ -1,5 +1,10 @@
 """Utilities for analyzing with VPN over DNS socket sessions."""
 
+import collections
+import multiprocessing
+import os
+import zlib
+from vodreassembler import ticket as ticket_module
 from vodreassembler import util
 
 
@@ -16,14 +21,37 @@ class SocketSession:
   def session_id(self):
     return self._data['id']
 
+  @property
+  def fqdn_suffix(self):
+    """Suffix of the tickets in databases of multiple suffixes, or None."""
+    return self._data['fqdn_suffix']
+
   @property
   def all_tickets(self):
     return self._data['tickets']
 
+  @property
+  def ordered_tickets(self):
+    """Tickets in the order their data is assumed to appear in the stream.
+
+    Socket messages carry no sequence number, and ticket ids are random, so
+    tickets are ordered by their first records (see Ticket.first_seen). This
+    is the order of the stream as long as the client waits for the response
+    of a ticket before opening the next one. See the caveats in README.
+    """
+    return sorted(self.all_tickets, key=lambda t: t.first_seen)
+
   @classmethod
   def find_all(cls, ticket_db):
-    """Find all socket sessions from given ticket_db."""
+    """Find all socket sessions from given ticket_db.
+
+    Sessions of different suffixes are kept apart, as they belong to different
+    tunnels.
+    """
     socket_db = {}
+    if hasattr(ticket_db, 'find'):
+      # Only SocketData tickets need to be examined.
+      ticket_db = ticket_db.find(message_type='SocketData')
     for ticket in ticket_db:
       try:
         uuid, msgtype, *other_params = ticket.request_message.split('\xa7')
@@ -31,9 +59,11 @@ class SocketSession:
         # TODO(toukoaozaki): support other message types
         if msgtype == 'SocketData':
           socket_id = int(other_params[0])
-          key = (uuid, socket_id)
+          key = (ticket.fqdn_suffix, uuid, socket_id)
           if key not in socket_db:
-            socket_db[key] = {'uuid': uuid, 'id': socket_id, 'tickets': []}
+            socket_db[key] = {'uuid': uuid, 'id': socket_id,
+                              'fqdn_suffix': ticket.fqdn_suffix,
+                              'tickets': []}
           socket_db[key]['tickets'].append(ticket)
       except (util.IncompleteDataError, ValueError):
         pass
@@ -45,3 +75,126 @@ class SocketSession:
             'num_tickets={!r})').format(self.uuid,
                                         self.session_id,
                                         len(self.all_tickets))
+
+
+class SessionStreams(collections.namedtuple('SessionStreams', [
+    'uuid', 'session_id', 'num_tickets', 'incomplete_tickets',
+    'request_path', 'request_length', 'response_path', 'response_length',
+    'fqdn_suffix'])):
+  """Result of reconstructing the byte streams of a socket session.
+
+  Attributes:
+    uuid (int): UUID of the session.
+    session_id (int): Socket id of the session.
+    num_tickets (int): Number of tickets in the session.
+    incomplete_tickets (int): Number of tickets whose response could not be
+      decoded, and is missing from the response stream.
+    request_path (str): File holding the concatenated request payloads.
+    request_length (int): Length of the request stream.
+    response_path (str): File holding the concatenated response payloads.
+    response_length (int): Length of the response stream.
+    fqdn_suffix (str): Suffix of the session in databases of multiple
+      suffixes, or None.
+  """
+  pass
+
+SessionStreams.__new__.__defaults__ = (None,)
+
+
+def reconstruct_sessions(ticket_db, output_dir, processes=None):
+  """Write the byte streams of every socket session into files.
+
+  For each session, the payloads of requests and responses of its tickets are
+  concatenated in the order of SocketSession.ordered_tickets, and written to
+  files named <uuid>-<socket id>.request and <uuid>-<socket id>.response in
+  output_dir. In databases of multiple suffixes, the names are prefixed with
+  the suffix of the session, e.g. tun.example.com-<uuid>-<socket id>.request.
+  Decompressing and writing the responses is done by a pool of worker
+  processes, one session at a time.
+
+  Workers are only sent the keys of the tickets of a session, and look the
+  tickets up in their own reference to ticket_db. It is inherited where
+  processes are forked, and pickled once per worker otherwise; a
+  ticketfile.MappedTicketDatabase is then mapped again by every worker.
+
+  Args:
+    ticket_db: ticket.TicketDatabase, ticketfile.MappedTicketDatabase or any
+      iterable of ticket.Ticket objects.
+    output_dir (str): Existing directory for the output files.
+    processes (int, optional): Number of worker processes. If not greater than
+      1, sessions are written in the current process.
+
+  Returns:
+    List of SessionStreams, sorted by suffix, uuid and socket id.
+  """
+  if hasattr(ticket_db, 'fqdn_suffix'):
+    # Ticket databases, unlike iterables of tickets, are looked up by key.
+    tickets = ticket_db
+    sessions = SocketSession.find_all(ticket_db)
+  else:
+    tickets = {ticket.key: ticket for ticket in ticket_db}
+    sessions = SocketSession.find_all(tickets.values())
+  jobs = (_session_job(session, output_dir) for session in sessions)
+  if processes is not None and processes > 1:
+    with multiprocessing.Pool(processes, _init_worker, (tickets,)) as pool:
+      results = list(pool.imap_unordered(_write_session_in_worker, jobs))
+  else:
+    results = [_write_session(tickets, job) for job in jobs]
+  results.sort(key=lambda r: (r.fqdn_suffix or '', r.uuid, r.session_id))
+  return results
+
+
+def _session_job(session, output_dir):
+  return (session.fqdn_suffix, session.uuid, session.session_id,
+          [ticket.key for ticket in session.ordered_tickets], output_dir)
+
+
+# Tickets looked up by the jobs of a worker process; see _init_worker().
+_worker_tickets = None
+
+
+def _init_worker(tickets):
+  global _worker_tickets
+  _worker_tickets = tickets
+
+
+def _write_session_in_worker(job):
+  return _write_session(_worker_tickets, job)
+
+
+def _write_session(tickets, job):
+  fqdn_suffix, uuid, session_id, keys, output_dir = job
+  name = '{}-{}'.format(uuid, session_id)
+  if fqdn_suffix is not None:
+    name = '{}-{}'.format(fqdn_suffix.rstrip('.'), name)
+  prefix = os.path.join(output_dir, name)
+  request_path = prefix + '.request'
+  response_path = prefix + '.response'
+  incomplete_tickets = 0
+  request_length = response_length = 0
+  with open(request_path, 'wb') as request_file, \
+       open(response_path, 'wb') as response_file:
+    for key in keys:
+      ticket = tickets[key]
+      request_payload = ticket.request_data
+      if request_payload:
+        request_length += request_file.write(request_payload)
+      try:
+        raw_response = ticket.raw_response_data
+      except util.IncompleteDataError:
+        raw_response = None
+      decoded = None
+      if raw_response is not None:
+        try:
+          decoded = ticket_module.decode_response(
+              zlib.decompress(raw_response), ticket.is_binary)
+        except (zlib.error, IndexError, UnicodeDecodeError):
+          pass
+      if decoded is None:
+        incomplete_tickets += 1
+        continue
+      if decoded[1]:
+        response_length += response_file.write(decoded[1])
+  return SessionStreams(uuid, session_id, len(keys), incomplete_tickets,
+                        request_path, request_length, response_path,
+                        response_length, fqdn_suffix)
@@ -1,24 +1,106 @@
 """Module for ticket-related utilities."""
 
+import collections
+import functools
+import itertools
+import multiprocessing
+import queue
+import time
 from vodreassembler import util
 from vodreassembler import protocol
 import zlib
 
+# Number of records parsed at once by bulk builds.
+_PARSE_BATCH_SIZE = 4096
+# Bounds of the batches in flight in parallel builds: batches being parsed per
+# process, and parsed batches waiting for each shard.
+_PENDING_BATCHES_PER_PROCESS = 2
+_SHARD_QUEUE_SIZE = 4
+# Seconds between checks that shard processes are alive, while parallel builds
+# wait for them.
+_SHARD_POLL_INTERVAL = 0.1
+# Number of keys of evicted tickets remembered by streaming builds.
+_MAX_EVICTED_KEYS = 1 << 16
+
+# Type codes of protocol.CompactQuery.
+_OPEN_TICKET = protocol.QueryType.open_ticket.value
+_REQUEST_DATA = protocol.QueryType.request_data.value
+_CHECK_REQUEST = protocol.QueryType.check_request.value
+_FETCH_RESPONSE = protocol.QueryType.fetch_response.value
+_CLOSE_TICKET = protocol.QueryType.close_ticket.value
+
+
+class Error(Exception):
+  pass
+
+
+class ShardError(Error):
+  pass
+
 
 class Ticket:
+  """View of the data assembled for a ticket.
+
+  Decoded values are computed on first access and cached until the underlying
+  ticket data is updated.
+  """
   def __init__(self, ticket_data):
     self._ticket_data = ticket_data
-    self._request = None
-    self._response = None
+    self._cache = {}
+    self._cache_version = None
+
+  def __getstate__(self):
+    # Cached values are copies of, or decoded from, the ticket data, and are
+    # not pickled with it.
+    return {'_ticket_data': self._ticket_data}
+
+  def __setstate__(self, state):
+    self.__init__(state['_ticket_data'])
+
+  def _cached(self, key, compute):
+    version = self._ticket_data.version
+    if self._cache_version != version:
+      self._cache = {}
+      self._cache_version = version
+    try:
+      return self._cache[key]
+    except KeyError:
+      value = self._cache[key] = compute()
+      return value
 
   @property
   def ticket_id(self):
     return self._ticket_data.id
 
+  @property
+  def fqdn_suffix(self):
+    """Suffix of the ticket in databases of multiple suffixes, or None."""
+    return self._ticket_data.fqdn_suffix
+
+  @property
+  def key(self):
+    """Key of the ticket in TicketDatabase; see TicketDatabase.update()."""
+    if self.fqdn_suffix is None:
+      return self.ticket_id
+    return (self.fqdn_suffix, self.ticket_id)
+
+  @property
+  def first_seen(self):
+    """Rank of the ticket by its first record among those of its database.
+
+    Tickets first seen earlier in the records have lower ranks. Ranks are only
+    comparable between tickets of the same database.
+    """
+    return self._ticket_data.first_seen
+
   @property
   def collision(self):
     return self._ticket_data.collision
 
+  @property
+  def closed(self):
+    return self._ticket_data.closed
+
   @property
   def random_number(self):
     return self._ticket_data.rn
@@ -34,31 +116,22 @@ class Ticket:
   def raw_request_data(self):
     if self._ticket_data.request_data is None:
       return None
-    return self._ticket_data.request_data.getbytes()
+    return self._cached('raw_request',
+                        self._ticket_data.request_data.getbytes)
 
   @property
   def request_data(self):
-    if not self._request:
-      self._request = self._parse_request_data()
-    return self._request[1]
+    return self._cached('request', self._parse_request_data)[1]
 
   @property
   def request_message(self):
-    if not self._request:
-      self._request = self._parse_request_data()
-    return self._request[0]
+    return self._cached('request', self._parse_request_data)[0]
 
   def _parse_request_data(self):
     data = self.raw_request_data
     if data is None:
       raise util.IncompleteDataError()
-    string_length = data[0]
-    if self.is_binary:
-      assert string_length != 0
-      return (data[1:string_length+1].decode('utf-8'), data[string_length+1:])
-    else:
-      assert string_length == 0
-      return (data[1:].decode('utf-8'), None)
+    return decode_request(data)
 
   @property
   def raw_response_length(self):
@@ -71,48 +144,77 @@ class Ticket:
   def raw_response_data(self):
     if self._ticket_data.response_data is None:
       return None
-    return self._ticket_data.response_data.getbytes()
+    return self._cached('raw_response',
+                        self._ticket_data.response_data.getbytes)
 
   @property
   def response_data(self):
-    if not self._response:
-      self._response = self._parse_response_data()
-    return self._response[1]
+    return self._cached('response', self._parse_response_data)[1]
 
   @property
   def response_message(self):
-    if not self._response:
-      self._response = self._parse_response_data()
-    return self._response[0]
+    return self._cached('response', self._parse_response_data)[0]
+
+  @property
+  def partial_response(self):
+    """Decompressed response data received so far.
+
+    Unlike response_data, this is available while the response is being
+    assembled. Only the contiguous data from the beginning of the raw response
+    can be decompressed. It is decompressed on every access and not cached; use
+    stream_response() to follow a response as it arrives. None if no response
+    data has been received.
+
+    Raises:
+      zlib.error: If the raw response data is corrupted.
+    """
+    response_data = self._ticket_data.response_data
+    if response_data is None:
+      return None
+    chunks = []
+    util.PrefixDecompressor(chunks.append).update(response_data)
+    return b''.join(chunks)
+
+  def stream_response(self, consumer):
+    """Pass the response to consumer, decompressed as it arrives.
+
+    consumer is called with the data decompressible from the response received
+    so far, and then with more data whenever records extending the beginning
+    of the raw response are applied to the ticket. The decompressed data is not
+    kept, so that large responses can be followed in constant memory. Streams
+    are not pickled with the ticket data.
+
+    Returns:
+      util.PrefixDecompressor feeding consumer, e.g. to check its eof and
+      error. A corrupted response stops the stream with its error set.
+
+    Raises:
+      zlib.error: If the raw response data received so far is corrupted.
+    """
+    return self._ticket_data.stream_response(consumer)
 
   def _parse_response_data(self):
-    data = self.raw_response_data
-    if data is None:
+    response_data = self._ticket_data.response_data
+    if response_data is None:
       raise util.IncompleteDataError()
-    data = zlib.decompress(data)
-    # Binary flag in the response may be unknown. Here, we ar simply choosing to
-    # treate everything as text, then fall back if it doesn't work.
-    if not self.is_binary:
-      try:
-        result = (data.decode('utf-8'), None)
-        # If padded with null characters, message is probably binary...
-        if '\x00' not in result[0]:
-          return result
-      except UnicodeDecodeError:
-        pass
-    string_length = data[0]
-    if string_length + 1 <= len(data):
-      message = data[1:string_length+1].decode('utf-8')
-      payload = data[string_length+1:]
-      return (message, payload)
+    if not response_data.complete:
+      raise util.IncompleteDataError('cannot return incomplete data')
+    # zlib.decompress() raises zlib.error on truncated streams as well.
+    return decode_response(zlib.decompress(response_data.getbuffer()),
+                           self.is_binary)
 
   @property
   def is_binary(self):
+    return self._cached('is_binary', self._parse_is_binary)
+
+  def _parse_is_binary(self):
+    request_data = self._ticket_data.request_data
     try:
       # If the first byte of the request is zero, the messages exchanged are
-      # both in utf-8 text. Otherwise, they must be binary.
-      if self.raw_request_data is not None:
-        return self.raw_request_data[0] != 0
+      # both in utf-8 text. Otherwise, they must be binary. Only the first byte
+      # is needed, so avoid copying the data.
+      if request_data is not None:
+        return request_data.getbuffer()[0] != 0
     except util.IncompleteDataError:
       pass
     return None
@@ -128,45 +230,150 @@ class Ticket:
                                       self.is_binary)
 
 
+def decode_request(data):
+  """Split raw request data into the message and the binary payload.
+
+  Returns:
+    Tuple of the message and the payload. The payload is None if the message
+    is text.
+  """
+  string_length = data[0]
+  if string_length != 0:
+    # Binary; the message is prefixed by its length.
+    return (str(data[1:string_length+1], 'utf-8'), data[string_length+1:])
+  return (str(data[1:], 'utf-8'), None)
+
+
+def decode_response(data, is_binary):
+  """Split decompressed response data into the message and the payload.
+
+  Args:
+    data (bytes): Decompressed response data.
+    is_binary (bool): Binary flag of the ticket, or None if unknown.
+
+  Returns:
+    Tuple of the message and the payload, or None if the data is malformed.
+  """
+  # Binary flag in the response may be unknown. Here, we ar simply choosing to
+  # treate everything as text, then fall back if it doesn't work.
+  if not is_binary:
+    try:
+      result = (data.decode('utf-8'), None)
+      # If padded with null characters, message is probably binary...
+      if '\x00' not in result[0]:
+        return result
+    except UnicodeDecodeError:
+      pass
+  string_length = data[0]
+  if string_length + 1 <= len(data):
+    message = data[1:string_length+1].decode('utf-8')
+    payload = data[string_length+1:]
+    return (message, payload)
+
+
 class _TicketData:
-  def __init__(self, ticket_id):
-    self.id = ticket_id
+  # Incremented on every update, so that Ticket can invalidate its cache.
+  version = 0
+  # Only set in databases of multiple suffixes.
+  fqdn_suffix = None
+  # util.PrefixDecompressor of stream_response(), if any.
+  response_stream = None
+  # Set by TicketDatabase when the ticket is added; see Ticket.first_seen.
+  first_seen = None
+
+  def __init__(self, key):
+    if isinstance(key, tuple):
+      self.fqdn_suffix, self.id = key
+    else:
+      self.id = key
     self.collision = False
     self.rn = None
     self.request_length = None
     self.request_data = None
     self.response_length = None
     self.response_data = None
+    self.closed = False
+
+  def __getstate__(self):
+    # Consumers of streams are not picklable in general.
+    state = self.__dict__.copy()
+    state.pop('response_stream', None)
+    return state
+
+  def stream_response(self, consumer):
+    stream = util.PrefixDecompressor(consumer)
+    if self.response_data is not None:
+      stream.update(self.response_data)
+    if not stream.eof:
+      self.response_stream = stream
+    return stream
+
+  def update_response_stream(self):
+    """Feed response data received since the last call to the stream."""
+    if self.response_stream is None or self.response_data is None:
+      return
+    try:
+      self.response_stream.update(self.response_data)
+    except zlib.error:
+      # Kept in the error of the stream, as returned to its owner.
+      self.response_stream = None
+    else:
+      if self.response_stream.eof:
+        self.response_stream = None
+
+  @property
+  def finished(self):
+    """Whether no more records are expected for the ticket."""
+    return self.closed or (_assembled(self.request_data)
+                           and _assembled(self.response_data))
 
   def update(self, query):
+    """Apply a protocol.Query or protocol.CompactQuery to the ticket.
+
+    Returns:
+      None if the query was applied, or the reason it was dropped: 'conflict'
+      if it disagrees with the random number or lengths seen earlier, or
+      'unexpected_chunk' if its data disagrees with the data seen earlier.
+      Either marks the ticket as a collision.
+    """
     assert query.error is None
-    if query.type is protocol.QueryType.open_ticket:
-      self._update_rn(query.variables['rn'])
-      self._update_request_length(query.variables['sz'])
-    elif query.type is protocol.QueryType.request_data:
-      self._update_request_data(query.variables['bf'], query.variables['wr'])
-    elif query.type is protocol.QueryType.check_request:
-      if len(query.payload) == 4 and query.payload.startswith(b'L'):
-        self._update_response_length(int.from_bytes(query.payload[1:],
-                                                    byte_order='big'))
-    elif query.type is protocol.QueryType.fetch_response:
-      self._update_response_data(query.variables['ln'], query.variables['rd'],
-                                 query.payload)
-    elif query.type is protocol.QueryType.close_ticket:
-      # We don't really care about close_ticket at this point.
-      pass
+    self.version += 1
+    if isinstance(query, protocol.CompactQuery):
+      type_code = query.type_code
+      get = functools.partial(getattr, query)
+      data, offset = query.data, query.offset
+    else:
+      type_code = query.type.value
+      get = query.variables.get
+      data, offset = query.payload
+    if type_code == _OPEN_TICKET:
+      rn_reason = self._update_rn(get('rn'))
+      return self._update_request_length(get('sz')) or rn_reason
+    elif type_code == _REQUEST_DATA:
+      return self._update_request_data(get('bf'), get('wr'))
+    elif type_code == _CHECK_REQUEST:
+      response_length = _checked_response_length(data)
+      if response_length is not None:
+        return self._update_response_length(response_length)
+    elif type_code == _FETCH_RESPONSE:
+      return self._update_response_data(get('ln'), get('rd'), data, offset)
+    elif type_code == _CLOSE_TICKET:
+      self.closed = True
+    return None
 
   def _update_rn(self, rn):
     if self.rn is not None and self.rn != rn:
       self.collision = True
-      return
+      return 'conflict'
     self.rn = rn
+    return None
 
   def _update_request_length(self, length):
     if self.request_length is not None and self.request_length != length:
       self.collision = True
-      return
+      return 'conflict'
     self.request_length = length
+    return None
 
   def _update_request_data(self, data, offset):
     if self.request_data is None:
@@ -175,45 +382,255 @@ class _TicketData:
       self.request_data.add(data, offset)
     except util.UnexpectedChunkError:
       self.collision = True
-      return
+      return 'unexpected_chunk'
     if self.request_data.length is not None:
-      self._update_request_length(self.request_data.length)
+      return self._update_request_length(self.request_data.length)
+    return None
 
   def _update_response_length(self, length):
     if self.response_length is not None and self.response_length != length:
       self.collision = True
-      return
+      return 'conflict'
     self.response_length = length
+    return None
 
-  def _update_response_data(self, segment_length, segment_offset, chunk):
+  def _update_response_data(self, segment_length, segment_offset, data,
+                            offset):
     if self.response_data is None:
       self.response_data = util.DataAssembler(3, length=self.response_length)
-    # Response data is queried by split segments. chunk is a piece of data
-    # within one of the segments. In order to reassemble the entire data, we
+    # Response data is queried by split segments. data is a piece of a segment,
+    # at offset within it. In order to reassemble the entire data, we
     # must first construct each segment from chunks, then assemble segments into
     # final data. Fortunately, the known implementation uses segment_length=48,
     # which is a multiple of 3; therefore a single DataAssembler can be used.
-    absolute_offset = segment_offset + chunk.offset
     try:
-      self.response_data.add(chunk.data, absolute_offset)
+      self.response_data.add(data, segment_offset + offset)
     except util.UnexpectedChunkError:
       self.collision = True
-      return
+      return 'unexpected_chunk'
+    self.update_response_stream()
 
     if segment_length < 48:
       try:
         self.response_data.length = segment_offset + segment_length
       except ValueError:
         self.collision = True
+        return 'conflict'
     if self.response_data.length is not None:
-      self._update_response_length(self.response_data.length)
+      return self._update_response_length(self.response_data.length)
+    return None
+
+
+def _num_filled_chunks(ticket_data, type_code):
+  if type_code == _REQUEST_DATA:
+    assembler = ticket_data.request_data
+  elif type_code == _FETCH_RESPONSE:
+    assembler = ticket_data.response_data
+  else:
+    return 0
+  return assembler.num_filled_chunks if assembler is not None else 0
+
+
+def _checked_response_length(data):
+  # The reply to check_request is b'L' followed by the response length in 2
+  # bytes, once the response is ready, or None.
+  if len(data) == 3 and data.startswith(b'L'):
+    return int.from_bytes(data[1:], byteorder='big')
+  return None
+
+
+def _assembled(assembler):
+  return (assembler is not None and assembler.length is not None
+          and assembler.complete)
+
+
+class _TicketIndex:
+  """Secondary index mapping (field, value) keys to sets of ticket ids."""
+  def __init__(self):
+    # Sets are dicts, which keep the order of insertion.
+    self._ids_by_key = collections.defaultdict(dict)
+    self._keys_by_id = {}
+    # Keys from the request message, which never changes once decoded.
+    self._message_keys = {}
+
+  def lookup(self, key):
+    return self._ids_by_key.get(key, {})
+
+  def values(self, field):
+    return [value for key_field, value in self._ids_by_key
+            if key_field == field]
+
+  def message_keys(self, ticket_id):
+    return self._message_keys.get(ticket_id)
+
+  def set_message_keys(self, ticket_id, keys):
+    self._message_keys[ticket_id] = keys
+
+  def update(self, ticket_id, keys):
+    old_keys = self._keys_by_id.get(ticket_id, ())
+    if old_keys == keys:
+      return
+    for key in old_keys:
+      if key not in keys:
+        ids = self._ids_by_key[key]
+        del ids[ticket_id]
+        if not ids:
+          del self._ids_by_key[key]
+    for key in keys:
+      if key not in old_keys:
+        self._ids_by_key[key][ticket_id] = None
+    self._keys_by_id[ticket_id] = keys
+
+  def remove(self, ticket_id):
+    self.update(ticket_id, ())
+    self._keys_by_id.pop(ticket_id, None)
+    self._message_keys.pop(ticket_id, None)
+
+
+def _message_keys(message):
+  # Messages are fields separated by \xa7, starting with uuid and type.
+  # SocketData messages continue with the socket id.
+  fields = message.split('\xa7')
+  keys = []
+  if len(fields) >= 2:
+    keys.append(('message_type', fields[1]))
+  try:
+    keys.append(('uuid', int(fields[0])))
+    if len(fields) >= 3 and fields[1] == 'SocketData':
+      keys.append(('socket_id', int(fields[2])))
+  except ValueError:
+    pass
+  return tuple(keys)
+
+
+class BuildStats:
+  """Counters and timers collected while building tickets.
+
+  Collecting statistics is optional; see TicketDatabase.build_from_records().
+  The same object may be passed to several builds to accumulate them.
+
+  Attributes:
+    records (int): Number of records read.
+    queries (collections.Counter): Queries applied to tickets, keyed by the
+      name of their protocol.QueryType. Queries dropped for any reason are
+      only counted in drops.
+    drops (collections.Counter): Dropped records and queries, keyed by reason.
+      Besides the reasons of protocol.QueryParser, error replies are counted
+      as error, queries without ticket ids as no_ticket, and queries
+      conflicting with earlier ones as conflict or unexpected_chunk; see
+      _TicketData.update().
+    collisions (int): Number of tickets which became collisions.
+    request_bytes (int): Bytes of requests newly assembled.
+    response_bytes (int): Bytes of responses newly assembled.
+    timers (dict): Cumulative seconds spent in each stage: parse (parsing
+      records into queries, including deduction of their types and
+      normalization of their variables), map (mapping queries to tickets),
+      assemble (applying queries to tickets) and index (updating the
+      indexes for the tickets updated, at the end of the build).
+  """
+  STAGES = ('parse', 'map', 'assemble', 'index')
+
+  def __init__(self):
+    self.records = 0
+    self.queries = collections.Counter()
+    self.drops = collections.Counter()
+    self.collisions = 0
+    self.request_bytes = 0
+    self.response_bytes = 0
+    self.timers = dict.fromkeys(self.STAGES, 0.0)
+
+  def as_dict(self):
+    """Return the statistics as a JSON serializable dict."""
+    return {
+        'records': self.records,
+        'queries': dict(self.queries),
+        'drops': dict(self.drops),
+        'collisions': self.collisions,
+        'request_bytes': self.request_bytes,
+        'response_bytes': self.response_bytes,
+        'timers': dict(self.timers),
+    }
+
+
+class TicketState(collections.namedtuple('TicketState', [
+    'key', 'collision', 'closed', 'random_number', 'request_length',
+    'response_length', 'request_data', 'response_data'])):
+  """Assembly state of a ticket, e.g. to be saved and restored by ticketfile.
+
+  Attributes:
+    key: Key of the ticket in TicketDatabase; see TicketDatabase.update().
+    collision (bool): Whether the ticket has collisions.
+    closed (bool): Whether the ticket has been closed.
+    random_number (int): Random number of the ticket, or None.
+    request_length (int): Request length from open_ticket, or None.
+    response_length (int): Response length from check_request, or None.
+    request_data (util.DataAssembler): Request assembled so far, or None.
+    response_data (util.DataAssembler): Response assembled so far, or None.
+  """
+  pass
 
 
 class TicketDatabase:
+  """Database of tickets, indexed by ticket id.
+
+  Tickets are also indexed by message type, uuid and socket id of their
+  request messages, and by their completeness and collision states; see
+  find(). Tickets updated by queries are reindexed lazily, on the next lookup,
+  so that building pays nothing for the indexes. The indexes are not pickled,
+  but rebuilt on the first lookup after unpickling.
+
+  A database built for a collection of suffixes reads the records of all of
+  them in a single pass. Since ticket ids are only unique within a suffix,
+  its tickets are keyed by (suffix, ticket id) tuples instead of ticket ids.
+  """
   def __init__(self, fqdn_suffix=None):
     self._tickets = {}
     self._ticket_data = {}
+    if protocol.is_suffix_set(fqdn_suffix):
+      fqdn_suffix = protocol.normalize_fqdn_suffixes(fqdn_suffix)
     self._fqdn_suffix = fqdn_suffix
+    self._rejections = collections.Counter()
+    self._index = _TicketIndex()
+    # Ids of the tickets to be reindexed before the next lookup, as a dict
+    # keeping their order.
+    self._stale = {}
+    # Next Ticket.first_seen rank.
+    self._num_first_seen = 0
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state['_index']
+    del state['_stale']
+    return state
+
+  def __setstate__(self, state):
+    # Pickles of older versions may carry an index, which is rebuilt as well.
+    state.pop('_index', None)
+    self.__dict__.update(state)
+    if '_num_first_seen' not in state:
+      # Tickets of older versions are ranked by their order, which is that of
+      # their first records.
+      for first_seen, data in enumerate(self._ticket_data.values()):
+        data.first_seen = first_seen
+      self._num_first_seen = len(self._ticket_data)
+    self._index = _TicketIndex()
+    self._stale = dict.fromkeys(self._ticket_data)
+
+  @property
+  def fqdn_suffix(self):
+    """Suffix of the queries, or None for the default suffix.
+
+    Sorted tuple of suffixes for databases of multiple suffixes.
+    """
+    return self._fqdn_suffix
+
+  @property
+  def rejections(self):
+    """Counter of records rejected by the parser, keyed by reason.
+
+    See protocol.QueryParser for the reasons.
+    """
+    return self._rejections
 
   def __getitem__(self, ticket_id):
     return self._tickets[ticket_id]
@@ -231,33 +648,617 @@ class TicketDatabase:
     # Use values, as keys are redundant.
     return iter(self._tickets.values())
 
-  def build_from_records(self, records):
+  def ticket_states(self):
+    """Iterate over the TicketState of every ticket.
+
+    Tickets are in the order of first_seen. The assemblers of the states are
+    those of the tickets, not copies, so they must not be modified.
+    """
+    for data in sorted(self._ticket_data.values(),
+                       key=lambda data: data.first_seen):
+      key = data.id if data.fqdn_suffix is None else (data.fqdn_suffix,
+                                                      data.id)
+      yield TicketState(key, data.collision, data.closed, data.rn,
+                        data.request_length, data.response_length,
+                        data.request_data, data.response_data)
+
+  def restore(self, state):
+    """Add a ticket in a TicketState, e.g. read from a ticket file.
+
+    Restored tickets are ranked by first_seen in the order they are added.
+
+    Raises:
+      ValueError: If a ticket with the same key is already in the database.
+    """
+    if state.key in self._tickets:
+      raise ValueError('ticket {!r} already exists'.format(state.key))
+    data = _TicketData(state.key)
+    data.collision = state.collision
+    data.closed = state.closed
+    data.rn = state.random_number
+    data.request_length = state.request_length
+    data.response_length = state.response_length
+    data.request_data = state.request_data
+    data.response_data = state.response_data
+    self._add_ticket_data(state.key, data)
+    self._reindex(state.key)
+
+  def build_from_records(self, records, processes=None, batch_size=10000,
+                         stats=None, dedup=None):
+    """Parse records and apply them to the tickets in the database.
+
+    Args:
+      records: iterable of dnsrecord.DnsRecord objects.
+      processes (int, optional): Number of worker processes parsing records,
+        and of shard processes assembling them. If greater than 1, records
+        are parsed and assembled in parallel; see
+        _build_from_records_parallel(). The result is identical to the serial
+        build.
+      batch_size (int, optional): Number of records sent to a worker process
+        at once. Only used in parallel builds.
+      stats (BuildStats, optional): Statistics to be updated. Only collected
+        by serial builds. Records suppressed by dedup are counted as dropped
+        for the duplicate reason.
+      dedup (protocol.DuplicateFilter, optional): Filter suppressing repeated
+        records before they are parsed. The result is identical to the build
+        without the filter.
+
+    Raises:
+      ValueError: If stats are requested for a parallel build.
+      ShardError: If a process of a parallel build dies, e.g. killed when out
+        of memory. The other processes are terminated.
+    """
+    parallel = processes is not None and processes > 1
+    if parallel and stats is not None:
+      raise ValueError('stats are only collected by serial builds')
+    if dedup is not None:
+      hits = dedup.hits
+      records = dedup.filter(
+          records, protocol.QueryParser(self._fqdn_suffix).may_be_query)
+    if parallel:
+      self._build_from_records_parallel(records, processes, batch_size)
+    else:
+      self._build_from_records_serial(records, stats)
+    if dedup is not None and stats is not None:
+      stats.records += dedup.hits - hits
+      stats.drops['duplicate'] += dedup.hits - hits
+
+  def _build_from_records_serial(self, records, stats):
+    # Records are parsed and applied in batches. Stages are timed per batch,
+    # which costs a few clock readings per batch, and the outcome of every
+    # query is only examined if stats are collected.
+    parser = self._create_parser()
+    clock = time.perf_counter
+    if stats is None:
+      drops = None
+      apply = self.update
+    else:
+      drops = stats.drops
+      apply = functools.partial(self._update_counted, stats)
+      rejections = parser.rejections.copy()
+    for batch in _batched(records, _PARSE_BATCH_SIZE):
+      start = clock()
+      queries = parser.parse_batch(batch)
+      parsed = clock()
+      pairs = list(_query_pairs(queries, drops))
+      mapped = clock()
+      for ticket_id, query in pairs:
+        apply(ticket_id, query)
+      if stats is not None:
+        stats.records += len(batch)
+        stats.timers['parse'] += parsed - start
+        stats.timers['map'] += mapped - parsed
+        stats.timers['assemble'] += clock() - mapped
+    if stats is not None:
+      # Indexes are otherwise updated lazily, by the next lookup.
+      start = clock()
+      self._flush_index()
+      stats.timers['index'] += clock() - start
+      stats.drops.update(parser.rejections - rejections)
+
+  def _update_counted(self, stats, ticket_id, query):
+    # Same as update(), counting the outcome of the query into stats.
+    data = self._get_or_create_ticket_data(ticket_id)
+    type_code = query.type.value
+    collision = data.collision
+    filled = _num_filled_chunks(data, type_code)
+    reason = data.update(query)
+    self._reindex(ticket_id)
+    if reason is None:
+      stats.queries[query.type.name] += 1
+    else:
+      stats.drops[reason] += 1
+    if data.collision and not collision:
+      stats.collisions += 1
+    if _num_filled_chunks(data, type_code) > filled:
+      if type_code == _REQUEST_DATA:
+        stats.request_bytes += len(query.variables['bf'])
+      else:
+        stats.response_bytes += len(query.payload.data)
+
+  def stream_from_records(self, records, max_idle_records=None,
+                          max_idle_time=None, clock=time.monotonic,
+                          max_evicted_keys=_MAX_EVICTED_KEYS):
+    """Apply records and yield tickets as soon as they are finished.
+
+    A ticket is finished when it is closed, or when both its request and
+    response are completely assembled. Tickets which have not been updated
+    within the idle window are yielded as well. Yielded tickets are evicted
+    from the database, so memory usage is bounded by the number of tickets in
+    progress rather than by the length of the input.
+
+    Records arriving for a recently evicted ticket, such as the close_ticket
+    query following the last chunk of the response, retries and duplicates,
+    are dropped and counted as 'late' rejections, rather than starting an
+    empty ticket under the same key. Only an open_ticket reply with the id and
+    a new random number starts a new ticket.
+
+    records may contain None as heartbeats, such as those of
+    dnsrecord.follow_dump(). On a heartbeat, tickets idle for max_idle_time
+    are yielded without waiting for the next record, and None is yielded
+    afterwards, so that the caller can do periodic work while the input is
+    idle.
+
+    Tickets already in the database, e.g. in progress when a checkpoint was
+    saved, are streamed as if updated right before the first record. All
+    tickets still in progress are yielded once the records are exhausted.
+
+    Args:
+      records: iterable of dnsrecord.DnsRecord objects, or None.
+      max_idle_records (int, optional): Yield tickets not updated by this many
+        subsequent parsed records.
+      max_idle_time (float, optional): Yield tickets not updated for this many
+        seconds, as measured by clock.
+      clock (callable, optional): Returns the current time in seconds. Only
+        used with max_idle_time; time.monotonic by default.
+      max_evicted_keys (int, optional): Number of the most recently evicted
+        tickets whose late records are dropped.
+    """
+    # Maps the keys of the most recently evicted tickets to their random
+    # numbers, in the order of eviction.
+    evicted = collections.OrderedDict()
+    # Maps ticket id to (record count, time) of its last update, ordered from
+    # the least recently updated ticket.
+    start = (clock() if max_idle_time is not None and self._ticket_data
+             else None)
+    last_update = collections.OrderedDict(
+        (ticket_id, (0, start)) for ticket_id in self._ticket_data)
+    parser = self._create_parser()
+    count = 0
+    now = None
+    splitter = _HeartbeatSplitter(records)
+    while not splitter.exhausted:
+      for ticket_id, query in parse_records(splitter.run(), parser):
+        count += 1
+        if max_idle_time is not None:
+          now = clock()
+        if ticket_id in evicted and not _reopens(query, evicted[ticket_id]):
+          self._rejections['late'] += 1
+        else:
+          evicted.pop(ticket_id, None)
+          self.update(ticket_id, query)
+          if self._ticket_data[ticket_id].finished:
+            last_update.pop(ticket_id, None)
+            yield self._evict_streamed(ticket_id, evicted, max_evicted_keys)
+          else:
+            last_update[ticket_id] = (count, now)
+            last_update.move_to_end(ticket_id)
+        yield from self._evict_idle(last_update, evicted, count, now,
+                                    max_idle_records, max_idle_time,
+                                    max_evicted_keys)
+      if splitter.heartbeat:
+        if max_idle_time is not None:
+          now = clock()
+          yield from self._evict_idle(last_update, evicted, count, now,
+                                      max_idle_records, max_idle_time,
+                                      max_evicted_keys)
+        yield None
+
+    for ticket_id in last_update:
+      yield self._evict(ticket_id)
+
+  def _evict_idle(self, last_update, evicted, count, now, max_idle_records,
+                  max_idle_time, max_evicted_keys):
+    while last_update:
+      idle_id, (idle_count, idle_time) = next(iter(last_update.items()))
+      if ((max_idle_records is not None
+           and count - idle_count >= max_idle_records)
+          or (max_idle_time is not None
+              and now - idle_time >= max_idle_time)):
+        del last_update[idle_id]
+        yield self._evict_streamed(idle_id, evicted, max_evicted_keys)
+      else:
+        break
+
+  def _evict_streamed(self, ticket_id, evicted, max_evicted_keys):
+    # Same as _evict(), remembering the ticket in evicted.
+    evicted[ticket_id] = self._ticket_data[ticket_id].rn
+    if len(evicted) > max_evicted_keys:
+      evicted.popitem(last=False)
+    return self._evict(ticket_id)
+
+  def add(self, ticket):
+    """Add a Ticket evicted from another database.
+
+    Tickets yielded by stream_from_records() can thereby be collected into a
+    database, e.g. to be saved. They keep their first_seen ranks, so that they
+    are ordered as in the other database rather than by their eviction.
+
+    Raises:
+      ValueError: If a ticket with the same key is already in the database.
+    """
+    key = ticket.key
+    if key in self._tickets:
+      raise ValueError('ticket {!r} already exists'.format(key))
+    self._tickets[key] = ticket
+    self._ticket_data[key] = ticket._ticket_data
+    self._num_first_seen = max(self._num_first_seen, ticket.first_seen + 1)
+    self._reindex(key)
+
+  def _evict(self, ticket_id):
+    self._stale.pop(ticket_id, None)
+    self._index.remove(ticket_id)
+    del self._ticket_data[ticket_id]
+    return self._tickets.pop(ticket_id)
+
+  def _create_parser(self):
     parser = protocol.QueryParser(self._fqdn_suffix)
-    for r in records:
+    # Count rejections directly into the database.
+    parser.rejections = self._rejections
+    return parser
+
+  def update(self, ticket_id, query):
+    """Apply a parsed query to the ticket with given id.
+
+    Args:
+      ticket_id: Id of the ticket, or (suffix, ticket id) tuple in databases
+        of multiple suffixes.
+      query: protocol.Query or protocol.CompactQuery.
+    """
+    ticket_data = self._get_or_create_ticket_data(ticket_id)
+    ticket_data.update(query)
+    self._reindex(ticket_id)
+
+  def find(self, message_type=None, uuid=None, socket_id=None, complete=None,
+           collision=None, fqdn_suffix=None):
+    """Find tickets matching all the given criteria with the indexes.
+
+    Criteria on the request message only match tickets whose request has been
+    completely assembled.
+
+    Args:
+      message_type (str, optional): Type of the request message, e.g.
+        'SocketData'.
+      uuid (int, optional): UUID in the request message.
+      socket_id (int, optional): Socket id in a SocketData request message.
+      complete (bool, optional): Whether both the request and the response
+        are completely assembled.
+      collision (bool, optional): Whether the ticket has collisions.
+      fqdn_suffix (str, optional): Suffix of the ticket, in databases of
+        multiple suffixes.
+
+    Returns:
+      List of matching Ticket objects, in no particular order.
+    """
+    criteria = [(field, value) for field, value in (
+        ('message_type', message_type), ('uuid', uuid),
+        ('socket_id', socket_id), ('complete', complete),
+        ('collision', collision), ('fqdn_suffix', fqdn_suffix))
+        if value is not None]
+    if not criteria:
+      return list(self)
+    self._flush_index()
+    id_sets = sorted((self._index.lookup(key) for key in criteria), key=len)
+    return [self._tickets[ticket_id] for ticket_id in id_sets[0]
+            if all(ticket_id in ids for ids in id_sets[1:])]
+
+  def index_values(self, field):
+    """Return the distinct values of an indexed field, such as 'uuid'."""
+    self._flush_index()
+    return self._index.values(field)
+
+  def _reindex(self, ticket_id):
+    # Called whenever the ticket may have changed; see _flush_index().
+    self._stale[ticket_id] = None
+
+  def _flush_index(self):
+    for ticket_id in self._stale:
+      self._index_ticket(ticket_id)
+    self._stale = {}
+
+  def _index_ticket(self, ticket_id):
+    data = self._ticket_data[ticket_id]
+    message_keys = self._index.message_keys(ticket_id)
+    if message_keys is None and _assembled(data.request_data):
       try:
-        query = parser.parse(r)
-      except ValueError:
-        # Just ignore unparseable record.
-        continue
+        message_keys = _message_keys(self._tickets[ticket_id].request_message)
+      except (util.IncompleteDataError, IndexError, UnicodeDecodeError):
+        message_keys = ()
+      self._index.set_message_keys(ticket_id, message_keys)
+    complete = (_assembled(data.request_data)
+                and _assembled(data.response_data))
+    keys = (('complete', complete), ('collision', data.collision))
+    if data.fqdn_suffix is not None:
+      keys += (('fqdn_suffix', data.fqdn_suffix),)
+    self._index.update(ticket_id, keys + (message_keys or ()))
 
-      if query.error:
-        # ignore error
-        continue
+  def _build_from_records_parallel(self, records, processes, batch_size):
+    # Batches of records are parsed by a pool, and the resulting queries are
+    # routed by ticket id to shard processes, which assemble them as they
+    # arrive. Only a bounded number of batches is in flight at once, so memory
+    # does not grow with the input, and only the assembled tickets are sent
+    # back at the end. Since queries for a single ticket always go to the same
+    # shard in their original order, the merged tickets are identical to the
+    # serial build.
+    num_shards = processes
+    first_seen = dict.fromkeys(self._ticket_data)
+    # Tickets already in the database are sent to their shard along with their
+    # first queries, so that new records are applied on top of them.
+    sent = set()
+    parse_batch = functools.partial(_parse_batch,
+                                    fqdn_suffix=self._fqdn_suffix,
+                                    num_shards=num_shards)
+    shard_queues = [multiprocessing.Queue(_SHARD_QUEUE_SIZE)
+                    for _ in range(num_shards)]
+    results = multiprocessing.Queue()
+    shards = [multiprocessing.Process(target=_assemble_shard,
+                                      args=(shard_queue, results))
+              for shard_queue in shard_queues]
+    for shard in shards:
+      shard.start()
 
-      if 'rn' in query.variables:
-        ticket_id = int.from_bytes(query.payload.data, byteorder='big')
-      elif 'id' in query.variables:
-        ticket_id = query.variables['id']
-      else:
-        # Cannot map the record with any tickets; ignore
-        continue
+    def route(parsed):
+      ticket_ids, shard_queries, rejections = parsed
+      self._rejections.update(rejections)
+      for ticket_id in ticket_ids:
+        first_seen.setdefault(ticket_id)
+      for shard_queue, queries in zip(shard_queues, shard_queries):
+        if not queries:
+          continue
+        existing = {}
+        for ticket_id, _ in queries:
+          if ticket_id in self._ticket_data and ticket_id not in sent:
+            existing[ticket_id] = self._ticket_data[ticket_id]
+            sent.add(ticket_id)
+        # Blocks while the shard is behind.
+        _put_to_shard(shard_queue, (existing, queries), shards)
+
+    merged = {}
+    try:
+      with multiprocessing.Pool(processes) as pool:
+        pending = collections.deque()
+        for batch in _batched(records, batch_size):
+          pending.append(pool.apply_async(parse_batch, (batch,)))
+          if len(pending) >= _PENDING_BATCHES_PER_PROCESS * processes:
+            route(_get_parsed(pending.popleft(), shards))
+        while pending:
+          route(_get_parsed(pending.popleft(), shards))
+      for shard_queue in shard_queues:
+        _put_to_shard(shard_queue, None, shards)
+      for _ in shards:
+        merged.update(_get_shard_result(results, shards))
+    except BaseException:
+      # The pool is terminated by its context manager. Queries still buffered
+      # for the shards are discarded, rather than waited for on exit.
+      for shard_queue in shard_queues:
+        shard_queue.cancel_join_thread()
+      for shard in shards:
+        shard.terminate()
+      raise
+    finally:
+      for shard in shards:
+        shard.join()
 
-      ticket_data = self._get_or_create_ticket_data(ticket_id)
-      ticket_data.update(query)
+    for ticket_id in first_seen:
+      if ticket_id not in merged:
+        continue
+      data = merged[ticket_id]
+      if ticket_id in self._ticket_data:
+        # Keep the existing Ticket objects valid.
+        self._ticket_data[ticket_id].__dict__.update(data.__dict__)
+        # Streams are not sent to the shards.
+        self._ticket_data[ticket_id].update_response_stream()
+      else:
+        # Added in the order of first_seen, as in the serial build.
+        self._add_ticket_data(ticket_id, data)
+      self._reindex(ticket_id)
 
   def _get_or_create_ticket_data(self, ticket_id):
     if ticket_id not in self._tickets:
-      data = _TicketData(ticket_id)
-      self._tickets[ticket_id] = Ticket(data)
-      self._ticket_data[ticket_id] = data
+      self._add_ticket_data(ticket_id, _TicketData(ticket_id))
     return self._ticket_data[ticket_id]
+
+  def _add_ticket_data(self, ticket_id, data):
+    data.first_seen = self._num_first_seen
+    self._num_first_seen += 1
+    self._tickets[ticket_id] = Ticket(data)
+    self._ticket_data[ticket_id] = data
+
+
+def _reopens(query, random_number):
+  # Whether query opens a new ticket with the id of an evicted one, rather than
+  # repeating the open_ticket query of the evicted ticket.
+  return (query.type is protocol.QueryType.open_ticket
+          and query.variables['rn'] != random_number)
+
+
+class _HeartbeatSplitter:
+  """Splits records into runs ending at None heartbeats.
+
+  run() iterates over the records up to the next heartbeat. Once a run is
+  exhausted, heartbeat tells whether it ended at a heartbeat, and exhausted
+  whether the records ran out.
+  """
+  def __init__(self, records):
+    self._records = iter(records)
+    self.heartbeat = False
+    self.exhausted = False
+
+  def run(self):
+    self.heartbeat = False
+    for record in self._records:
+      if record is None:
+        self.heartbeat = True
+        return
+      yield record
+    self.exhausted = True
+
+
+def query_ticket_id(query):
+  """Return the id of the ticket the query belongs to, or None if unknown.
+
+  Args:
+    query: protocol.Query or protocol.CompactQuery.
+  """
+  if isinstance(query, protocol.CompactQuery):
+    if query.rn is not None:
+      return int.from_bytes(query.data, byteorder='big')
+    return query.id
+  if 'rn' in query.variables:
+    # Reply to open_ticket is the id of the new ticket.
+    return int.from_bytes(query.payload.data, byteorder='big')
+  elif 'id' in query.variables:
+    return query.variables['id']
+  return None
+
+
+def parse_records(records, parser=None, batch_size=1):
+  """Parse DNS records into (ticket_id, query) pairs.
+
+  Records that cannot be parsed, error replies and records that cannot be
+  mapped to any ticket are ignored.
+
+  Args:
+    records: iterable of dnsrecord.DnsRecord objects.
+    parser (protocol.QueryParser, optional): Parser used for the records,
+      which also counts rejected records. Parser for the default suffix is
+      used if not provided.
+    batch_size (int, optional): If greater than 1, records are parsed in
+      batches by QueryParser.parse_batch(). Batching is faster, but delays the
+      results until a batch is filled.
+
+  Yields:
+    Pairs of the ticket id and the query, which is a protocol.CompactQuery if
+    the parser is compact.
+  """
+  parser = parser or protocol.QueryParser()
+  if batch_size > 1:
+    queries = itertools.chain.from_iterable(
+        map(parser.parse_batch, _batched(records, batch_size)))
+  else:
+    queries = map(parser.try_parse, records)
+  return _query_pairs(queries)
+
+
+def _query_pairs(queries, drops=None):
+  # drops, if given, counts the queries ignored by reason.
+  for query in queries:
+    if query is None:
+      # Just ignore unparseable record. The parser counts it.
+      continue
+
+    if query.error:
+      # ignore error
+      if drops is not None:
+        drops['error'] += 1
+      continue
+
+    ticket_id = query_ticket_id(query)
+    if ticket_id is None:
+      # Cannot map the record with any tickets; ignore
+      if drops is not None:
+        drops['no_ticket'] += 1
+      continue
+    if query.fqdn_suffix is not None:
+      # Ticket ids are only unique within a suffix.
+      ticket_id = (query.fqdn_suffix, ticket_id)
+    yield ticket_id, query
+
+
+def _batched(iterable, size):
+  iterator = iter(iterable)
+  while True:
+    batch = list(itertools.islice(iterator, size))
+    if not batch:
+      return
+    yield batch
+
+
+def parse_record_batch(records, fqdn_suffix=None):
+  """Parse a batch of records, e.g. in a worker process.
+
+  Args:
+    records: sequence of dnsrecord.DnsRecord objects.
+    fqdn_suffix (str, optional): Suffix of the queries.
+
+  Returns:
+    Tuple of the list of (ticket_id, protocol.CompactQuery) pairs, as yielded
+    by parse_records(), and the Counter of rejected records.
+  """
+  # The pairs are sent between processes and held in flight, so keep them
+  # compact.
+  parser = protocol.QueryParser(fqdn_suffix, compact=True)
+  pairs = list(parse_records(records, parser, batch_size=_PARSE_BATCH_SIZE))
+  return pairs, parser.rejections
+
+
+def _parse_batch(records, fqdn_suffix, num_shards):
+  # Runs in worker processes.
+  ticket_ids = {}
+  shard_queries = [[] for _ in range(num_shards)]
+  pairs, rejections = parse_record_batch(records, fqdn_suffix)
+  for ticket_id, query in pairs:
+    ticket_ids[ticket_id] = None
+    shard_queries[_shard(ticket_id, num_shards)].append((ticket_id, query))
+  return list(ticket_ids), shard_queries, rejections
+
+
+def _shard(key, num_shards):
+  # Hashes of strings differ between processes, so the suffix is not used.
+  ticket_id = key[1] if isinstance(key, tuple) else key
+  return ticket_id % num_shards
+
+
+def _check_shards(shards):
+  # Shards exit with 0 once their results are sent; any other exit code means
+  # that they died, e.g. killed when out of memory, and never will.
+  for shard in shards:
+    if shard.exitcode not in (None, 0):
+      raise ShardError('shard process {} exited with code {}'.format(
+          shard.pid, shard.exitcode))
+
+
+def _put_to_shard(shard_queue, item, shards):
+  while True:
+    try:
+      return shard_queue.put(item, timeout=_SHARD_POLL_INTERVAL)
+    except queue.Full:
+      _check_shards(shards)
+
+
+def _get_parsed(async_result, shards):
+  while True:
+    try:
+      return async_result.get(_SHARD_POLL_INTERVAL)
+    except multiprocessing.TimeoutError:
+      _check_shards(shards)
+
+
+def _get_shard_result(results, shards):
+  while True:
+    try:
+      return results.get(timeout=_SHARD_POLL_INTERVAL)
+    except queue.Empty:
+      _check_shards(shards)
+
+
+def _assemble_shard(queue, results):
+  # Runs in shard processes, applying queries as they arrive until None.
+  ticket_data = {}
+  for existing, queries in iter(queue.get, None):
+    ticket_data.update(existing)
+    for ticket_id, query in queries:
+      if ticket_id not in ticket_data:
+        ticket_data[ticket_id] = _TicketData(ticket_id)
+      ticket_data[ticket_id].update(query)
+  results.put(ticket_data)
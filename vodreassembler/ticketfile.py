@@ -0,0 +1,593 @@
+"""Binary file format for saving ticket databases.
+
+A ticket file consists of the following sections, in order. All integers are
+little endian.
+
+1. Header: magic, format version, number of tickets and offsets of the other
+   sections.
+2. Metadata: UTF-8 encoded JSON object, holding the FQDN suffix and the
+   rejection counts of the database, and optional user metadata.
+3. Entries: one fixed-size entry per ticket, in the iteration order of the
+   database, which is the order their first records were seen in (see
+   ticket.Ticket.first_seen). Each entry holds the ticket id, flags, lengths and the location of
+   the request and response blobs in the data section.
+4. Index: (ticket id, entry number) pairs sorted by ticket id, allowing lookup
+   of a single ticket without reading the other entries.
+5. Data: request and response blobs of every ticket. Blobs of partially
+   assembled data are followed by the bitmap of chunks added so far.
+
+In databases of multiple suffixes, the ticket ids of entries and the index
+are packed with the position of the ticket's suffix in the list of suffixes in
+the metadata, which is stored above the lowest 48 bits. Single-suffix files
+are identical to those of format version 1, except for the version.
+
+Metadata of every ticket can be read without touching the data section.
+MappedTicketDatabase memory-maps a ticket file for random access, without
+reading anything but the header on open.
+"""
+
+import bitarray
+import collections
+import json
+import mmap
+import struct
+from vodreassembler import protocol
+from vodreassembler import ticket
+from vodreassembler import util
+
+MAGIC = b'VODT'
+VERSION = 2
+# Version 2 added databases of multiple suffixes.
+_SUPPORTED_VERSIONS = (1, 2)
+
+_HEADER = struct.Struct('<4sHxxQQQQQ')
+_ENTRY = struct.Struct('<QHQQQQQQQQQQQ')
+_INDEX = struct.Struct('<QQ')
+
+# Bits of packed ids holding the ticket id; see _KeyPacker.
+_SUFFIX_SHIFT = 48
+
+# Entry flags.
+_COLLISION = 0x1
+_CLOSED = 0x2
+_RN = 0x4
+_REQUEST_LENGTH = 0x8
+_RESPONSE_LENGTH = 0x10
+_REQUEST_DATA = 0x20
+_REQUEST_DATA_LENGTH = 0x40
+_REQUEST_PARTIAL = 0x80
+_RESPONSE_DATA = 0x100
+_RESPONSE_DATA_LENGTH = 0x200
+_RESPONSE_PARTIAL = 0x400
+
+# Alignments of DataAssembler used by _TicketData.
+_REQUEST_ALIGNMENT = 30
+_RESPONSE_ALIGNMENT = 3
+
+
+class Error(Exception):
+  pass
+
+
+class FormatError(Error):
+  pass
+
+
+class UnsupportedVersionError(FormatError):
+  pass
+
+
+class BlobEntry(collections.namedtuple('BlobEntry', [
+    'length', 'offset', 'size', 'num_chunks', 'partial'])):
+  """Location of request or response data in the data section.
+
+  Attributes:
+    length (int): Length of the entire data if known, or None.
+    offset (int): Absolute file offset of the data.
+    size (int): Number of bytes stored.
+    num_chunks (int): Length of the bitmap of added chunks.
+    partial (bool): Whether the data is partially assembled. If True, the
+      bitmap of added chunks follows the data.
+  """
+
+  @property
+  def bitmap_offset(self):
+    return self.offset + self.size
+
+  @property
+  def bitmap_size(self):
+    return (self.num_chunks + 7) // 8 if self.partial else 0
+
+
+class TicketEntry(collections.namedtuple('TicketEntry', [
+    'ticket_id', 'collision', 'closed', 'random_number', 'request_length',
+    'response_length', 'request', 'response', 'fqdn_suffix'])):
+  """Metadata of a single ticket.
+
+  request and response are BlobEntry objects, or None if no data is present.
+  fqdn_suffix is the suffix of the ticket in databases of multiple suffixes,
+  or None.
+  """
+
+  @property
+  def key(self):
+    """Key of the ticket in the database; see ticket.TicketDatabase."""
+    if self.fqdn_suffix is None:
+      return self.ticket_id
+    return (self.fqdn_suffix, self.ticket_id)
+
+  @property
+  def raw_request_length(self):
+    if self.request_length is None and self.request is not None:
+      return self.request.length
+    return self.request_length
+
+  @property
+  def raw_response_length(self):
+    if self.response_length is None and self.response is not None:
+      return self.response.length
+    return self.response_length
+
+
+def save(ticket_db, fileobj, metadata=None):
+  """Write ticket_db into a binary file object.
+
+  The data section is streamed into fileobj, while only the fixed-size
+  entries are held in memory. The header, entries and index are written last,
+  over the space left for them before the data.
+
+  Args:
+    ticket_db (ticket.TicketDatabase): Database to be saved.
+    fileobj: Seekable binary file object to write to. The file is written
+      from its current position, which is left at the end of the file.
+    metadata (dict, optional): JSON serializable user metadata stored along
+      with the database.
+  """
+  packer = _KeyPacker(ticket_db.fqdn_suffix)
+  metadata_bytes = json.dumps({'fqdn_suffix': ticket_db.fqdn_suffix,
+                               'rejections': dict(ticket_db.rejections),
+                               'metadata': metadata}).encode('utf-8')
+  num_tickets = len(ticket_db)
+  entries_offset = _HEADER.size + len(metadata_bytes)
+  index_offset = entries_offset + _ENTRY.size * num_tickets
+  data_offset = index_offset + _INDEX.size * num_tickets
+
+  start = fileobj.tell()
+  fileobj.seek(start + data_offset)
+  entries = bytearray()
+  index = []
+  for i, state in enumerate(ticket_db.ticket_states()):
+    packed_id = packer.pack(state.key)
+    index.append((packed_id, i))
+    flags = 0
+    if state.collision:
+      flags |= _COLLISION
+    if state.closed:
+      flags |= _CLOSED
+    if state.random_number is not None:
+      flags |= _RN
+    if state.request_length is not None:
+      flags |= _REQUEST_LENGTH
+    if state.response_length is not None:
+      flags |= _RESPONSE_LENGTH
+    request_flags, request = _write_blob(
+        fileobj, start, state.request_data,
+        _REQUEST_DATA, _REQUEST_DATA_LENGTH, _REQUEST_PARTIAL)
+    response_flags, response = _write_blob(
+        fileobj, start, state.response_data,
+        _RESPONSE_DATA, _RESPONSE_DATA_LENGTH, _RESPONSE_PARTIAL)
+    try:
+      entries += _ENTRY.pack(
+          packed_id, flags | request_flags | response_flags,
+          state.random_number or 0, state.request_length or 0,
+          state.response_length or 0, *(request + response))
+    except struct.error as e:
+      raise ValueError(
+          'ticket {!r} cannot be represented'.format(state.key)) from e
+  end = fileobj.tell()
+
+  index.sort()
+  fileobj.seek(start)
+  fileobj.write(_HEADER.pack(MAGIC, VERSION, num_tickets,
+                             entries_offset, index_offset, data_offset,
+                             end - start))
+  fileobj.write(metadata_bytes)
+  fileobj.write(entries)
+  fileobj.write(b''.join(_INDEX.pack(*item) for item in index))
+  fileobj.seek(end)
+
+
+def _write_blob(fileobj, start, assembler, data_flag, length_flag,
+                partial_flag):
+  if assembler is None:
+    return 0, (0, 0, 0, 0)
+  flags = data_flag
+  if assembler.length is not None:
+    flags |= length_flag
+  blob = assembler.getbytes(incomplete=True)
+  bitmap = assembler.chunk_bitmap
+  offset = fileobj.tell() - start
+  fileobj.write(blob)
+  if not assembler.complete:
+    flags |= partial_flag
+    big_endian_bitmap = bitarray.bitarray(endian='big')
+    big_endian_bitmap.extend(bitmap)
+    fileobj.write(big_endian_bitmap.tobytes())
+  return flags, (assembler.length or 0, offset, len(blob), len(bitmap))
+
+
+def load(fileobj):
+  """Load the entire ticket database from a binary file object."""
+  return TicketFileReader(fileobj).load()
+
+
+class TicketFileReader:
+  """Reader for ticket files.
+
+  Only the header, metadata and entries are read on construction. Request and
+  response data are read on demand.
+  """
+  def __init__(self, fileobj):
+    self._file = fileobj
+    (magic, version, self._num_tickets, self._entries_offset,
+     self._index_offset, self._data_offset, self._end_offset) = (
+         _unpack_header(self._read(0, _HEADER.size)))
+    self._fqdn_suffix, self._rejections, self._metadata = _unpack_metadata(
+        self._read(_HEADER.size, self._entries_offset - _HEADER.size))
+    self._packer = _KeyPacker(self._fqdn_suffix)
+    self._entries = self._read(self._entries_offset,
+                               _ENTRY.size * self._num_tickets)
+
+  def _read(self, offset, length):
+    self._file.seek(offset)
+    data = self._file.read(length)
+    if len(data) != length:
+      raise FormatError('unexpected end of file')
+    return data
+
+  @property
+  def fqdn_suffix(self):
+    return self._fqdn_suffix
+
+  @property
+  def metadata(self):
+    return self._metadata
+
+  @property
+  def rejections(self):
+    """Counter of records rejected by the parser, keyed by reason."""
+    return self._rejections
+
+  def __len__(self):
+    return self._num_tickets
+
+  def __iter__(self):
+    for fields in _ENTRY.iter_unpack(self._entries):
+      yield _unpack_entry(fields, self._packer)
+
+  def find(self, ticket_id):
+    """Return TicketEntry for the ticket_id, or None if not found.
+
+    ticket_id is a (suffix, ticket id) tuple in databases of multiple
+    suffixes.
+    """
+    packed_id = self._packer.try_pack(ticket_id)
+    if packed_id is None:
+      return None
+    entry_number = _bisect_index(
+        lambda i: _INDEX.unpack(self._read(
+            self._index_offset + _INDEX.size * i, _INDEX.size)),
+        self._num_tickets, packed_id)
+    if entry_number is None:
+      return None
+    return _unpack_entry(_ENTRY.unpack_from(self._entries,
+                                            _ENTRY.size * entry_number),
+                         self._packer)
+
+  def read_request(self, entry):
+    """Return the raw request bytes of the entry, padded if partial."""
+    return self._read_blob(entry.request)
+
+  def read_response(self, entry):
+    """Return the raw response bytes of the entry, padded if partial."""
+    return self._read_blob(entry.response)
+
+  def _read_blob(self, blob):
+    if blob is None:
+      return None
+    return self._read(blob.offset, blob.size)
+
+  def _read_assembler(self, blob, alignment):
+    if blob is None:
+      return None
+    data = self._read(blob.offset, blob.size)
+    bitmap = _read_bitmap(
+        blob, lambda: self._read(blob.bitmap_offset, blob.bitmap_size))
+    return util.DataAssembler.restore(alignment, data, bitmap, blob.length)
+
+  def load(self):
+    """Load the entire database as ticket.TicketDatabase."""
+    ticket_db = ticket.TicketDatabase(self._fqdn_suffix)
+    ticket_db.rejections.update(self._rejections)
+    for entry in self:
+      ticket_db.restore(ticket.TicketState(
+          entry.key, entry.collision, entry.closed, entry.random_number,
+          entry.request_length, entry.response_length,
+          self._read_assembler(entry.request, _REQUEST_ALIGNMENT),
+          self._read_assembler(entry.response, _RESPONSE_ALIGNMENT)))
+    return ticket_db
+
+
+class MappedTicketDatabase:
+  """Read-only ticket database backed by a memory-mapped ticket file.
+
+  Implements the read interface of ticket.TicketDatabase. Opening the file only
+  reads its header and metadata; tickets are looked up through the id index on
+  demand. Raw request and response data of the returned tickets are memoryview
+  slices into the mapping, so no payload is copied until it is decoded.
+
+  The mapping cannot be closed while any of those memoryview objects are
+  alive. Pickling the database only stores the path of the file, which is
+  mapped again on unpickling.
+  """
+  def __init__(self, path):
+    self._path = path
+    with open(path, 'rb') as f:
+      self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self._buffer = memoryview(self._mmap)
+    (magic, version, self._num_tickets, self._entries_offset,
+     self._index_offset, self._data_offset, self._end_offset) = (
+         _unpack_header(self._buffer[:_HEADER.size]))
+    if len(self._buffer) < self._end_offset:
+      raise FormatError('unexpected end of file')
+    self._fqdn_suffix, self._rejections, self._metadata = _unpack_metadata(
+        self._buffer[_HEADER.size:self._entries_offset])
+    self._packer = _KeyPacker(self._fqdn_suffix)
+
+  def close(self):
+    self._buffer.release()
+    self._mmap.close()
+
+  def __reduce__(self):
+    # The file is mapped again, e.g. by worker processes.
+    return MappedTicketDatabase, (self._path,)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  @property
+  def fqdn_suffix(self):
+    return self._fqdn_suffix
+
+  @property
+  def metadata(self):
+    return self._metadata
+
+  @property
+  def rejections(self):
+    """Counter of records rejected by the parser, keyed by reason."""
+    return self._rejections
+
+  def _entry(self, entry_number):
+    return _unpack_entry(_ENTRY.unpack_from(
+        self._buffer, self._entries_offset + _ENTRY.size * entry_number),
+                         self._packer)
+
+  def _find_entry_number(self, ticket_id):
+    packed_id = self._packer.try_pack(ticket_id)
+    if packed_id is None:
+      return None
+    return _bisect_index(
+        lambda i: _INDEX.unpack_from(self._buffer,
+                                     self._index_offset + _INDEX.size * i),
+        self._num_tickets, packed_id)
+
+  def _ticket(self, entry_number):
+    # Entries are in the order of first_seen.
+    return ticket.Ticket(_MappedTicketData(self._entry(entry_number),
+                                           self._buffer, entry_number))
+
+  def __getitem__(self, ticket_id):
+    entry_number = self._find_entry_number(ticket_id)
+    if entry_number is None:
+      raise KeyError(ticket_id)
+    return self._ticket(entry_number)
+
+  def __contains__(self, ticket_id):
+    return self._find_entry_number(ticket_id) is not None
+
+  def __len__(self):
+    return self._num_tickets
+
+  def __repr__(self):
+    return '{' + ', '.join(map(repr, self)) + '}'
+
+  def __iter__(self):
+    for i in range(self._num_tickets):
+      yield self._ticket(i)
+
+
+class _MappedTicketData:
+  """Read-only counterpart of ticket._TicketData for a TicketEntry."""
+  # Never updated, so cached values of Ticket stay valid.
+  version = 0
+
+  def __init__(self, entry, buffer, first_seen):
+    self.id = entry.ticket_id
+    self.fqdn_suffix = entry.fqdn_suffix
+    self.first_seen = first_seen
+    self.collision = entry.collision
+    self.closed = entry.closed
+    self.rn = entry.random_number
+    self.request_length = entry.request_length
+    self.request_data = _MappedData.create(entry.request, buffer,
+                                           _REQUEST_ALIGNMENT)
+    self.response_length = entry.response_length
+    self.response_data = _MappedData.create(entry.response, buffer,
+                                            _RESPONSE_ALIGNMENT)
+
+
+class _MappedData:
+  """Read-only counterpart of util.DataAssembler for a BlobEntry."""
+  def __init__(self, blob, buffer, alignment):
+    self._blob = blob
+    self._buffer = buffer
+    self._alignment = alignment
+
+  @classmethod
+  def create(cls, blob, buffer, alignment):
+    return cls(blob, buffer, alignment) if blob is not None else None
+
+  @property
+  def length(self):
+    return self._blob.length
+
+  @property
+  def complete(self):
+    return not self._blob.partial
+
+  @property
+  def filled_prefix_length(self):
+    if self.complete:
+      return self._blob.size
+    bitmap = _read_bitmap(self._blob, lambda: self._buffer[
+        self._blob.bitmap_offset:
+        self._blob.bitmap_offset + self._blob.bitmap_size])
+    try:
+      prefix_chunks = bitmap.index(False)
+    except ValueError:
+      prefix_chunks = len(bitmap)
+    return min(prefix_chunks * self._alignment, self._blob.size)
+
+  def getbytes(self, incomplete=False):
+    if not incomplete and not self.complete:
+      raise util.IncompleteDataError('cannot return incomplete data')
+    return self._buffer[self._blob.offset:self._blob.offset + self._blob.size]
+
+  def getrange(self, offset, length):
+    start = self._blob.offset + offset
+    return self._buffer[start:start + min(length, self._blob.size - offset)]
+
+  def getbuffer(self, incomplete=False):
+    # Slices of the mapped buffer are not copies already.
+    return self.getbytes(incomplete)
+
+
+def _unpack_header(header):
+  if len(header) < _HEADER.size:
+    raise FormatError('file is too short')
+  fields = _HEADER.unpack(header)
+  if fields[0] != MAGIC:
+    raise FormatError('not a ticket file')
+  if fields[1] not in _SUPPORTED_VERSIONS:
+    raise UnsupportedVersionError(
+        'unsupported format version {}'.format(fields[1]))
+  return fields
+
+
+def _unpack_metadata(data):
+  metadata = json.loads(bytes(data).decode('utf-8'))
+  fqdn_suffix = metadata['fqdn_suffix']
+  if isinstance(fqdn_suffix, list):
+    fqdn_suffix = tuple(fqdn_suffix)
+  # Rejections are absent from files written by earlier versions.
+  return (fqdn_suffix,
+          collections.Counter(metadata.get('rejections', {})),
+          metadata['metadata'])
+
+
+def _unpack_entry(fields, packer):
+  (packed_id, flags, rn, request_length, response_length,
+   *blobs) = fields
+  fqdn_suffix, ticket_id = packer.unpack(packed_id)
+  return TicketEntry(
+      ticket_id,
+      bool(flags & _COLLISION),
+      bool(flags & _CLOSED),
+      rn if flags & _RN else None,
+      request_length if flags & _REQUEST_LENGTH else None,
+      response_length if flags & _RESPONSE_LENGTH else None,
+      _unpack_blob(flags, blobs[:4], _REQUEST_DATA, _REQUEST_DATA_LENGTH,
+                   _REQUEST_PARTIAL),
+      _unpack_blob(flags, blobs[4:], _RESPONSE_DATA, _RESPONSE_DATA_LENGTH,
+                   _RESPONSE_PARTIAL),
+      fqdn_suffix)
+
+
+def _unpack_blob(flags, fields, data_flag, length_flag, partial_flag):
+  if not flags & data_flag:
+    return None
+  length, offset, size, num_chunks = fields
+  return BlobEntry(length if flags & length_flag else None, offset, size,
+                   num_chunks, bool(flags & partial_flag))
+
+
+class _KeyPacker:
+  """Packs ticket keys into the 64-bit ids stored in entries and the index.
+
+  Keys of single-suffix databases are ticket ids, stored as is. Keys of
+  databases of multiple suffixes are (suffix, ticket id) tuples, stored as the
+  ticket id with the position of the suffix above _SUFFIX_SHIFT bits.
+  """
+  def __init__(self, fqdn_suffix):
+    if protocol.is_suffix_set(fqdn_suffix):
+      self._suffixes = tuple(fqdn_suffix)
+      self._numbers = {s: i for i, s in enumerate(self._suffixes)}
+    else:
+      self._suffixes = None
+
+  def pack(self, key):
+    if self._suffixes is None:
+      return key
+    fqdn_suffix, ticket_id = key
+    if not 0 <= ticket_id < 1 << _SUFFIX_SHIFT:
+      raise ValueError('ticket {!r} cannot be represented'.format(key))
+    return (self._numbers[fqdn_suffix] << _SUFFIX_SHIFT) | ticket_id
+
+  def try_pack(self, key):
+    """Return the packed key, or None if no ticket can have the key."""
+    if self._suffixes is None:
+      return key if isinstance(key, int) else None
+    if (not isinstance(key, tuple) or len(key) != 2
+        or key[0] not in self._numbers):
+      return None
+    try:
+      return self.pack(key)
+    except (TypeError, ValueError):
+      return None
+
+  def unpack(self, packed_id):
+    """Return the (suffix, ticket id) tuple; suffix is None if single."""
+    if self._suffixes is None:
+      return None, packed_id
+    return (self._suffixes[packed_id >> _SUFFIX_SHIFT],
+            packed_id & ((1 << _SUFFIX_SHIFT) - 1))
+
+
+def _read_bitmap(blob, read_bitmap_bytes):
+  if blob.partial:
+    bitmap = bitarray.bitarray(endian='big')
+    bitmap.frombytes(bytes(read_bitmap_bytes()))
+    del bitmap[blob.num_chunks:]
+  else:
+    bitmap = bitarray.bitarray(blob.num_chunks, endian='big')
+    bitmap.setall(True)
+  return bitmap
+
+
+def _bisect_index(read_index, num_entries, ticket_id):
+  """Binary search the sorted index; return the entry number or None."""
+  low, high = 0, num_entries
+  while low < high:
+    mid = (low + high) // 2
+    mid_id, entry_number = read_index(mid)
+    if mid_id < ticket_id:
+      low = mid + 1
+    elif mid_id > ticket_id:
+      high = mid
+    else:
+      return entry_number
+  return None
@@ -4,6 +4,7 @@ import bitarray
 import collections
 import io
 import types
+import zlib
 
 
 class Error(Exception):
@@ -64,8 +65,9 @@ class DataAssembler:
         be divisible by this number. Also, every chunk but the last must have
         the same length as alignment.
       storage (optional): binary file object used as data storage for the
-        assembler. Must support both read and write. If not provided, io.BytesIO
-        is used.
+        assembler. Must support both read and write. If not provided, a
+        preallocated bytearray is used once the length is known, and io.BytesIO
+        until then.
       length (int, optional): Length of the entire data. Used to perform extra
         validations.
     """
@@ -86,10 +88,41 @@ class DataAssembler:
     self._alignment = alignment
     bitarray_length = self._bitarray_length(length) if length is not None else 0
     self._has_chunk = bitarray.bitarray(bitarray_length)
-    self._storage = storage or io.BytesIO()
     self._length = length
+    # Exactly one of _storage and _buffer is used as the storage.
+    self._storage = storage
+    self._buffer = None
+    if storage is None:
+      if length is not None:
+        self._buffer = bytearray(length)
+      else:
+        self._storage = io.BytesIO()
+    self._owns_storage = storage is None
 
     self._has_chunk.setall(False)
+    # Both are maintained by _update_bitmap(), so that neither completeness nor
+    # the filled prefix requires scanning the bitmap.
+    self._num_filled = 0
+    self._prefix_chunks = 0
+
+  @classmethod
+  def restore(cls, alignment, data, chunk_bitmap, length=None):
+    """Create DataAssembler from previously saved state.
+
+    Args:
+      alignment (int): Alignment of each chunk.
+      data (bytes): Data returned by getbytes(incomplete=True).
+      chunk_bitmap (bitarray.bitarray): Bitmap returned by chunk_bitmap.
+      length (int, optional): Length of the entire data, if known.
+    """
+    assembler = cls(alignment, length=length)
+    assembler._write_data(data, 0)
+    if len(chunk_bitmap) < len(assembler._has_chunk):
+      raise ValueError('chunk_bitmap is too short for the length')
+    assembler._has_chunk = bitarray.bitarray(chunk_bitmap)
+    assembler._num_filled = assembler._has_chunk.count()
+    assembler._advance_prefix()
+    return assembler
 
   def _bitarray_length(self, data_length):
     assert data_length is not None
@@ -99,9 +132,18 @@ class DataAssembler:
   def alignment(self):
     return self._alignment
 
+  @property
+  def chunk_bitmap(self):
+    """Copy of the bitmap indicating which chunks have been added."""
+    return bitarray.bitarray(self._has_chunk)
+
   @property
   def complete(self):
-    return self._has_chunk.all()
+    return self._num_filled == len(self._has_chunk)
+
+  @property
+  def num_filled_chunks(self):
+    return self._num_filled
 
   @property
   def length(self):
@@ -113,13 +155,52 @@ class DataAssembler:
       if value is not None:
         self._length = value
         self._extend_bitmap(self._bitarray_length(value))
+        self._preallocate()
     elif value != self._length:
       raise ValueError('length cannot be changed once set')
 
+  @property
+  def filled_prefix_length(self):
+    """Length of the contiguous data from the beginning filled by chunks."""
+    prefix_length = self._prefix_chunks * self._alignment
+    if self._length is not None:
+      prefix_length = min(prefix_length, self._length)
+    return prefix_length
+
+  def missing_ranges(self):
+    """Return the ranges of data not filled by chunks yet.
+
+    If the length is unknown, missing data past the last chunk added is not
+    included, as its extent is unknown.
+
+    Returns:
+      List of (offset, length) tuples in ascending order of offset.
+    """
+    ranges = []
+    bitmap = self._has_chunk
+    start = self._prefix_chunks
+    while start < len(bitmap):
+      try:
+        end = bitmap.index(True, start)
+      except ValueError:
+        end = len(bitmap)
+      offset = start * self._alignment
+      end_offset = end * self._alignment
+      if self._length is not None:
+        end_offset = min(end_offset, self._length)
+      ranges.append((offset, end_offset - offset))
+      try:
+        start = bitmap.index(False, end)
+      except ValueError:
+        break
+    return ranges
+
   def getbytes(self, incomplete=False):
     if not incomplete and not self.complete:
       raise IncompleteDataError('cannot return incomplete data')
 
+    if self._buffer is not None:
+      return bytes(self._buffer)
     curr = self._storage.seek(0)
     if curr != 0:
       raise RuntimeError('seek(0) failed')
@@ -130,6 +211,26 @@ class DataAssembler:
       result += b'\x00' * (self._length - len(result))
     return result
 
+  def getrange(self, offset, length):
+    """Return length bytes of data from offset as a bytes-like object.
+
+    The range is not checked for being filled. Unlike getbytes() and
+    getbuffer(), the rest of the data is not read.
+    """
+    return self._read_data(offset, length)
+
+  def getbuffer(self, incomplete=False):
+    """Return the data as a read-only memoryview.
+
+    The data is not copied when the storage is a preallocated buffer. The view
+    reflects chunks added afterwards.
+    """
+    if self._buffer is None:
+      return memoryview(self.getbytes(incomplete))
+    if not incomplete and not self.complete:
+      raise IncompleteDataError('cannot return incomplete data')
+    return memoryview(self._buffer).toreadonly()
+
   def add(self, data, offset):
     self._verify_chunk_params(data, offset)
     if self._data_already_added(data, offset):
@@ -177,10 +278,33 @@ class DataAssembler:
       # Extend the bitarray to ensure chunk_index is a valid index.
       self._extend_bitmap(chunk_index + 1)
 
-    self._has_chunk[chunk_index] = True
+    if not self._has_chunk[chunk_index]:
+      self._has_chunk[chunk_index] = True
+      self._num_filled += 1
+      if chunk_index == self._prefix_chunks:
+        self._advance_prefix()
     if self._length is None and length < self._alignment:
       # This must be the last chunk; now we know the length.
       self._length = offset + length
+      self._preallocate()
+
+  def _advance_prefix(self):
+    try:
+      self._prefix_chunks = self._has_chunk.index(False, self._prefix_chunks)
+    except ValueError:
+      self._prefix_chunks = len(self._has_chunk)
+
+  def _preallocate(self):
+    # Move data into a preallocated buffer once the length is known.
+    if self._buffer is not None or not self._owns_storage:
+      return
+    data = self._storage.getvalue()
+    if len(data) > self._length:
+      # Chunks past the end have been added; keep them as is.
+      return
+    self._buffer = bytearray(self._length)
+    self._buffer[:len(data)] = data
+    self._storage = None
 
   def _extend_bitmap(self, length):
     assert length >= len(self._has_chunk)
@@ -204,11 +328,16 @@ class DataAssembler:
     return True
 
   def _read_data(self, offset, length):
+    if self._buffer is not None:
+      return self._buffer[offset:offset+length]
     curr = self._storage.seek(offset)
     assert curr == offset
     return self._storage.read(length)
 
   def _write_data(self, data, offset):
+    if self._buffer is not None:
+      self._buffer[offset:offset+len(data)] = data
+      return
     curr = self._storage.seek(offset)
     if curr < offset:
       # Seek to the offset failed somehow. Try padding to fill in the gap.
@@ -220,3 +349,75 @@ class DataAssembler:
 
   def add_chunk(self, chunk):
     self.add(*chunk)
+
+
+class PrefixDecompressor:
+  """Incremental zlib decompressor for data being assembled.
+
+  Contiguous data at the beginning of an assembler is decompressed as soon as
+  it is filled, and the decompressed data is handed to a consumer, or dropped
+  if there is none. Only the state of the decompressor is kept, which is
+  bounded by the zlib window, rather than the decompressed data. Each byte of
+  the compressed data is read from the assembler and fed to the decompressor
+  only once.
+
+  The assembler is passed to every update(), so that it may be replaced by a
+  copy holding the same prefix. It may be anything providing
+  filled_prefix_length and getrange(), such as DataAssembler.
+  """
+  def __init__(self, consumer=None, wbits=zlib.MAX_WBITS):
+    """Initialize the decompressor.
+
+    Args:
+      consumer (callable, optional): Called with every piece of decompressed
+        data, in order.
+      wbits (int, optional): Passed to zlib.decompressobj().
+    """
+    self._consumer = consumer
+    self._decompressor = zlib.decompressobj(wbits)
+    self._consumed = 0
+    self._decompressed_length = 0
+    self._error = None
+
+  @property
+  def consumed(self):
+    """Length of the compressed data fed to the decompressor so far."""
+    return self._consumed
+
+  @property
+  def decompressed_length(self):
+    """Length of the data decompressed so far."""
+    return self._decompressed_length
+
+  @property
+  def eof(self):
+    """Whether the end of the compressed stream has been reached."""
+    return self._decompressor.eof
+
+  @property
+  def error(self):
+    """zlib.error raised by an earlier update(), or None."""
+    return self._error
+
+  def update(self, assembler):
+    """Decompress data filled since the last update.
+
+    Raises:
+      zlib.error: If the compressed data is corrupted. Later updates raise
+        the same error.
+    """
+    if self._error is not None:
+      raise self._error
+    end = assembler.filled_prefix_length
+    if end <= self._consumed or self._decompressor.eof:
+      return
+    try:
+      data = self._decompressor.decompress(
+          assembler.getrange(self._consumed, end - self._consumed))
+    except zlib.error as e:
+      self._error = e
+      raise
+    self._consumed = end
+    self._decompressed_length += len(data)
+    if data and self._consumer is not None:
+      self._consumer(data)